@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import gzip
+import json
+import math
+import time
+import base64
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+
+import wegene_utils
+from haplotyping import Haplotyping
+from subtree_pool import SubtreePool
+from main import haplotype_inputs
+from haplo_resource import HaploResource
+
+"""
+性能基准测试，使用合成的单倍群树、用户基因数据和芯片数据，结果以JSON输出，用于比较不同版本的性能:
+    python benchmark.py -o bench.json
+    python benchmark.py --nodes 60000 --baseline bench.json     与上次结果比较，变慢超过容差时返回1
+相同的参数和随机种子生成相同的数据。
+"""
+
+# 合成数据的单倍群树数据源名
+BENCH_SOURCE = "bench"
+# 合成芯片的基因数据格式名
+BENCH_FORMAT = "bench_chip"
+# 结果格式版本
+BENCH_RESULT_VERSION = 1
+# mtDNA长度
+MT_LENGTH = 16569
+# 合成Y-SNP的hg19位置范围
+Y_POS_RANGE = (2649521, 28800000)
+
+
+# 生成合成单倍群树，与真实的单倍群树使用相同的键名: n单倍群名、c子节点、m SNP列表、v SNP名、p19/p38/p位置、a ancestral、d derived。
+# 返回 (单倍群树JSON, 节点列表, 父节点下标列表)，节点列表按生成顺序排列
+def generate_tree(
+    rng: random.Random,
+    is_y_mt: str,
+    node_count: int,
+    max_depth: int,
+    max_children: int,
+    snps_per_node: int,
+) -> tuple:
+    snp_counter = [0]
+
+    def new_node(name: str) -> dict:
+        tree_node = {"n": name}
+        r = rng.random()
+        # 少量节点没有SNP列表或SNP列表为空，与真实的单倍群树一致
+        if r < 0.02:
+            return tree_node
+        if r < 0.05:
+            tree_node["m"] = []
+            return tree_node
+        snp_list = []
+        for _ in range(rng.randint(1, snps_per_node)):
+            snp_counter[0] += 1
+            ancestral, derived = rng.sample("ATGC", 2)
+            if is_y_mt == "y":
+                pos19 = rng.randint(*Y_POS_RANGE)
+                snp_dict = {
+                    "v": "BY{}".format(snp_counter[0]),
+                    "p19": pos19,
+                    "p38": pos19 + rng.randint(-200000, 200000),
+                    "a": ancestral,
+                    "d": derived,
+                }
+            else:
+                snp_dict = {
+                    "v": "{}{}".format(ancestral, snp_counter[0]),
+                    "p": rng.randint(1, MT_LENGTH),
+                    "a": ancestral,
+                    "d": derived,
+                }
+            snp_list.append(snp_dict)
+        tree_node["m"] = snp_list
+        return tree_node
+
+    root = new_node("{}-ROOT".format(is_y_mt.upper()))
+    node_list = [root]
+    node_parent = [-1]
+    node_depth = [0]
+    # 随机选择待展开的节点，树的形状介于宽而浅和窄而深之间
+    frontier = [0]
+    while len(node_list) < node_count and len(frontier) > 0:
+        node_idx = frontier.pop(rng.randrange(len(frontier)))
+        if node_depth[node_idx] >= max_depth:
+            continue
+        children = []
+        for _ in range(rng.randint(1, max_children)):
+            if len(node_list) >= node_count:
+                break
+            child_idx = len(node_list)
+            child = new_node("{}{}".format(is_y_mt.upper(), child_idx))
+            children.append(child)
+            node_list.append(child)
+            node_parent.append(node_idx)
+            node_depth.append(node_depth[node_idx] + 1)
+            frontier.append(child_idx)
+        node_list[node_idx]["c"] = children
+
+    haplo_tree = {"timestamp": "bench-{}".format(rng.getrandbits(32)), "tree": root}
+    return haplo_tree, node_list, node_parent
+
+
+# 生成合成Y家族字典，部分单倍群有关联家族
+def generate_family_dict(rng: random.Random, node_list: list) -> dict:
+    y_dict = {}
+    for tree_node in node_list:
+        entry = {"a": rng.randint(100, 60000)}
+        if rng.random() < 0.1:
+            entry["hf"] = [
+                {
+                    "fi": rng.randint(1, 100000),
+                    "ft": "F{}".format(rng.randint(1, 99999)),
+                }
+                for _ in range(rng.randint(1, 3))
+            ]
+        y_dict[tree_node["n"]] = entry
+    return {"dict": y_dict}
+
+
+# 选择芯片检测的位置，所有样本使用同一组位置。真实芯片优先检测主干上的SNP，SNP被选中的概率与其节点子树大小的对数成正比，
+# 平均比例为coverage，另外加入extra_count个树上没有的位置
+def generate_chip_positions(
+    rng: random.Random,
+    node_list: list,
+    node_parent: list,
+    pos_key: str,
+    coverage: float,
+    extra_count: int = 0,
+) -> set:
+    # 子节点总在父节点之后生成，逆序累加即可得到子树大小
+    subtree_size = [1] * len(node_list)
+    for node_idx in range(len(node_list) - 1, 0, -1):
+        subtree_size[node_parent[node_idx]] += subtree_size[node_idx]
+
+    weight_list = []
+    for node_idx, tree_node in enumerate(node_list):
+        for snp_dict in tree_node.get("m", []):
+            weight_list.append(
+                (math.log2(1 + subtree_size[node_idx]), snp_dict[pos_key])
+            )
+    if len(weight_list) == 0:
+        return set()
+    mean_weight = statistics.mean(weight for weight, _ in weight_list)
+
+    chip_pos_set = set()
+    for weight, pos in weight_list:
+        if rng.random() < coverage * weight / mean_weight:
+            chip_pos_set.add(str(pos))
+    pos_range = Y_POS_RANGE if pos_key != "p" else (1, MT_LENGTH)
+    for _ in range(extra_count):
+        chip_pos_set.add(str(rng.randint(*pos_range)))
+    return chip_pos_set
+
+
+# 生成一个样本在芯片位置上的Y或mt-SNP: {位置: 基因型}。样本属于随机的一个终端单倍群，路径上的SNP为derived突变，其余为ancestral，
+# 树上没有的位置为随机基因型；nocall_rate是未检出比例，error_rate是基因型错误率
+def generate_genome(
+    rng: random.Random,
+    node_list: list,
+    node_parent: list,
+    pos_key: str,
+    chip_pos_set: set,
+    nocall_rate: float = 0.02,
+    error_rate: float = 0.005,
+) -> dict:
+    leaf_list = [
+        node_idx
+        for node_idx, tree_node in enumerate(node_list)
+        if len(tree_node.get("c", [])) == 0
+    ]
+    path_set = set()
+    node_idx = rng.choice(leaf_list)
+    while node_idx != -1:
+        path_set.add(node_idx)
+        node_idx = node_parent[node_idx]
+
+    user_genome = {}
+    for node_idx, tree_node in enumerate(node_list):
+        for snp_dict in tree_node.get("m", []):
+            pos = str(snp_dict[pos_key])
+            if pos in chip_pos_set and pos not in user_genome:
+                allele = snp_dict["d"] if node_idx in path_set else snp_dict["a"]
+                if rng.random() < error_rate:
+                    allele = rng.choice("ATGC")
+                user_genome[pos] = allele + allele
+    for pos in chip_pos_set:
+        if pos not in user_genome:
+            allele = rng.choice("ATGC")
+            user_genome[pos] = allele + allele
+
+    # 未检出的位置不在基因数据中，与extract_positions的结果一致
+    for pos in list(user_genome):
+        if rng.random() < nocall_rate:
+            del user_genome[pos]
+    return user_genome
+
+
+# 生成合成芯片的基因索引文件内容和一个样本的WeGene输入 {"data": base64(gzip(基因数据)), "format": 格式名}，
+# Y和mt位点使用样本的Y和mt-SNP，其余位点随机分布在常染色体和X上
+def generate_chip(
+    rng: random.Random, record_count: int, user_y_dict: dict, user_mt_dict: dict
+) -> tuple:
+    record_list = []
+    for chromosome, user_dict in (("Y", user_y_dict), ("MT", user_mt_dict)):
+        for pos, genotype in user_dict.items():
+            record_list.append((chromosome, pos, genotype))
+    chromosome_list = [str(c) for c in range(1, 23)] + ["X"]
+    while len(record_list) < record_count:
+        record_list.append(
+            (
+                rng.choice(chromosome_list),
+                str(rng.randint(1, 200000000)),
+                "".join(sorted(rng.choice("ATGC") + rng.choice("ATGC"))),
+            )
+        )
+    rng.shuffle(record_list)
+
+    index_lines = ["NA\tNA\tNA\tNA"]
+    genome_list = []
+    for index_pos, (chromosome, pos, genotype) in enumerate(record_list):
+        index_lines.append(
+            "{}\trs{}\t{}\t{}".format(index_pos, index_pos + 1, chromosome, pos)
+        )
+        genome_list.append(genotype)
+    genome_str = "".join(genome_list)
+    raw_inputs = {
+        "data": base64.b64encode(gzip.compress(genome_str.encode("utf-8"))).decode(
+            "ascii"
+        ),
+        "format": BENCH_FORMAT,
+    }
+    return "\n".join(index_lines) + "\n", genome_str, raw_inputs
+
+
+# 重复执行并计时，返回 {median, min, max, repeat}，单位为秒
+def measure(func, repeat: int) -> dict:
+    time_list = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        time_list.append(time.perf_counter() - start_time)
+    return {
+        "median": statistics.median(time_list),
+        "min": min(time_list),
+        "max": max(time_list),
+        "repeat": repeat,
+    }
+
+
+# 在临时目录中生成合成数据并运行各项基准测试，返回结果字典
+def run_benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    work_dir = tempfile.mkdtemp(prefix="haplo_bench_")
+    cwd = os.getcwd()
+    # 单倍群树和基因索引按相对路径查找，切换到临时目录
+    os.chdir(work_dir)
+    try:
+        os.makedirs("haplotree")
+        os.makedirs("indexes")
+
+        y_tree, y_node_list, y_node_parent = generate_tree(
+            rng, "y", args.nodes, args.depth, args.children, args.snps_per_node
+        )
+        mt_tree, mt_node_list, mt_node_parent = generate_tree(
+            rng, "mt", args.mt_nodes, args.depth, args.children, args.snps_per_node
+        )
+        y_tree_file_name = "haplotree/{}_y_snp_tree.json".format(BENCH_SOURCE)
+        mt_tree_file_name = "haplotree/{}_mt_snp_tree.json".format(BENCH_SOURCE)
+        for file_name, content in (
+            (y_tree_file_name, y_tree),
+            (mt_tree_file_name, mt_tree),
+            (
+                "haplotree/{}_y_dict.json".format(BENCH_SOURCE),
+                generate_family_dict(rng, y_node_list),
+            ),
+        ):
+            with open(file_name, "w", encoding="utf-8") as json_file:
+                json.dump(content, json_file, ensure_ascii=False)
+
+        y_chip_pos_set = generate_chip_positions(
+            rng, y_node_list, y_node_parent, "p19", args.coverage, extra_count=200
+        )
+        mt_chip_pos_set = generate_chip_positions(
+            rng, mt_node_list, mt_node_parent, "p", args.mt_coverage
+        )
+        y_genome_list = [
+            generate_genome(rng, y_node_list, y_node_parent, "p19", y_chip_pos_set)
+            for _ in range(args.samples)
+        ]
+        mt_genome_list = [
+            generate_genome(rng, mt_node_list, mt_node_parent, "p", mt_chip_pos_set)
+            for _ in range(args.samples)
+        ]
+        index_text, genome_str, raw_inputs = generate_chip(
+            rng, args.chip_size, y_genome_list[0], mt_genome_list[0]
+        )
+        with open("indexes/index_{}.idx".format(BENCH_FORMAT), "w") as idx_file:
+            idx_file.write(index_text)
+
+        results = {}
+        repeat = args.repeat
+
+        # 单倍群树加载：解析JSON并编译、首次加载并保存预编译缓存、从预编译缓存加载
+        results["tree_load_json"] = measure(
+            lambda: Haplotyping(y_tree_file_name, BENCH_SOURCE, "y", useTreeCache=False),
+            repeat,
+        )
+        results["tree_load_build_cache"] = measure(
+            lambda: (
+                os.remove(y_tree_file_name + ".cache")
+                if os.access(y_tree_file_name + ".cache", os.F_OK)
+                else None,
+                Haplotyping(y_tree_file_name, BENCH_SOURCE, "y"),
+            ),
+            repeat,
+        )
+        results["tree_load_cached"] = measure(
+            lambda: Haplotyping(y_tree_file_name, BENCH_SOURCE, "y"), repeat
+        )
+
+        # 单倍群分析，每次测量分析全部样本，结果换算为每个样本的时间
+        y_haplo = Haplotyping(y_tree_file_name, BENCH_SOURCE, "y")
+        mt_haplo = Haplotyping(mt_tree_file_name, BENCH_SOURCE, "mt")
+        y_haplo.analyse(y_genome_list[0])
+        mt_haplo.analyse(mt_genome_list[0])
+        for name, func in (
+            ("analyse_y", lambda: [y_haplo.analyse(g) for g in y_genome_list]),
+            ("analyse_mt", lambda: [mt_haplo.analyse(g) for g in mt_genome_list]),
+            ("analyse_batch_y", lambda: y_haplo.analyse_batch(y_genome_list)),
+        ):
+            measured = measure(func, repeat)
+            for key in ("median", "min", "max"):
+                measured[key] /= args.samples
+            measured["per"] = "sample"
+            results[name] = measured
+
+        # 子树进程池分析，不限制交集大小，与analyse_y比较即可看出进程间传递的开销和并行节省的时间
+        if args.subtree_workers > 1:
+            with SubtreePool(y_haplo, args.subtree_workers, minHits=0) as subtree_pool:
+                y_haplo.analyse(y_genome_list[0], subtreePool=subtree_pool)
+                measured = measure(
+                    lambda: [
+                        y_haplo.analyse(g, subtreePool=subtree_pool)
+                        for g in y_genome_list
+                    ],
+                    repeat,
+                )
+            for key in ("median", "min", "max"):
+                measured[key] /= args.samples
+            measured["per"] = "sample"
+            results["analyse_subtree_y"] = measured
+
+        # 基因数据解析：基因索引加载、完整解析、只提取Y和mt位点
+        results["genome_index_load"] = measure(
+            lambda: (
+                wegene_utils._genome_index_cache.clear(),
+                wegene_utils.load_genome_index(BENCH_FORMAT),
+            ),
+            repeat,
+        )
+        results["parse_genome_string"] = measure(
+            lambda: wegene_utils.parse_genome_string(genome_str, BENCH_FORMAT), repeat
+        )
+        results["extract_positions"] = measure(
+            lambda: wegene_utils.extract_positions(raw_inputs, chromosomes=("Y", "MT")),
+            repeat,
+        )
+
+        # HTML输出：分型结果表格，以及main.py处理一个完整请求
+        y_haplo_list = y_haplo.analyse(y_genome_list[0])
+        results["to_html"] = measure(lambda: y_haplo.to_html(y_haplo_list), repeat)
+        resource = HaploResource(BENCH_SOURCE)
+        haplotype_inputs(raw_inputs, resource)
+        results["request_warm"] = measure(
+            lambda: haplotype_inputs(raw_inputs, resource), repeat
+        )
+
+        return {
+            "version": BENCH_RESULT_VERSION,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {
+                key: getattr(args, key)
+                for key in (
+                    "seed",
+                    "nodes",
+                    "mt_nodes",
+                    "depth",
+                    "children",
+                    "snps_per_node",
+                    "samples",
+                    "coverage",
+                    "mt_coverage",
+                    "chip_size",
+                    "repeat",
+                    "subtree_workers",
+                )
+            },
+            "data": {
+                "y_haplo_count": y_haplo.HaploCount,
+                "y_snp_count": y_haplo.SNPCount,
+                "mt_haplo_count": mt_haplo.HaploCount,
+                "mt_snp_count": mt_haplo.SNPCount,
+                "y_sample_snp_count": statistics.mean(len(g) for g in y_genome_list),
+                "mt_sample_snp_count": statistics.mean(len(g) for g in mt_genome_list),
+            },
+            "results": results,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# 与基准结果比较，返回变慢超过容差的测试项 [(名称, 基准时间, 当前时间)]
+def compare_results(baseline: dict, current: dict, tolerance: float) -> list:
+    regression_list = []
+    for name, measured in current["results"].items():
+        if name in baseline.get("results", {}):
+            baseline_median = baseline["results"][name]["median"]
+            if measured["median"] > baseline_median * (1 + tolerance):
+                regression_list.append((name, baseline_median, measured["median"]))
+    return regression_list
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="单倍群分型性能基准测试")
+    parser.add_argument("-o", "--output", help="结果JSON文件，默认输出到stdout")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子，默认为1")
+    parser.add_argument("--nodes", type=int, default=20000, help="Y单倍群树节点数，默认为20000")
+    parser.add_argument("--mt-nodes", type=int, default=5000, help="mt单倍群树节点数，默认为5000")
+    parser.add_argument("--depth", type=int, default=60, help="单倍群树最大深度，默认为60")
+    parser.add_argument("--children", type=int, default=6, help="每个节点最多子节点数，默认为6")
+    parser.add_argument("--snps-per-node", type=int, default=4, help="每个节点最多SNP数，默认为4")
+    parser.add_argument("--samples", type=int, default=50, help="样本数，默认为50")
+    parser.add_argument(
+        "--coverage", type=float, default=0.03, help="芯片覆盖的Y树SNP比例，默认为0.03"
+    )
+    parser.add_argument(
+        "--mt-coverage", type=float, default=0.3, help="芯片覆盖的mt树SNP比例，默认为0.3"
+    )
+    parser.add_argument("--chip-size", type=int, default=700000, help="芯片位点数，默认为700000")
+    parser.add_argument("--repeat", type=int, default=5, help="每项测试重复次数，默认为5")
+    parser.add_argument(
+        "--subtree-workers",
+        type=int,
+        default=2,
+        help="子树进程池分析的工作进程数，小于2时不测试，默认为2",
+    )
+    parser.add_argument("--baseline", help="用于比较的基准结果JSON文件")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="比较时允许变慢的比例，默认为0.2"
+    )
+    args = parser.parse_args()
+    args.repeat = max(args.repeat, 1)
+    args.samples = max(args.samples, 1)
+
+    bench_result = run_benchmark(args)
+    bench_json = json.dumps(bench_result, ensure_ascii=False, indent=2)
+    if args.output != None:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(bench_json + "\n")
+    else:
+        print(bench_json)
+
+    for name, measured in bench_result["results"].items():
+        sys.stderr.write(
+            "{:<24}{:>12.3f} ms{}\n".format(
+                name,
+                measured["median"] * 1000,
+                "/" + measured["per"] if "per" in measured else "",
+            )
+        )
+
+    if args.baseline != None:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        regression_list = compare_results(baseline, bench_result, args.tolerance)
+        for name, baseline_median, current_median in regression_list:
+            sys.stderr.write(
+                "变慢：{} {:.3f} ms -> {:.3f} ms\n".format(
+                    name, baseline_median * 1000, current_median * 1000
+                )
+            )
+        if len(regression_list) > 0:
+            exit(1)
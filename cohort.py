@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import wegene_utils
+from haplo_resource import HaploResource
+from tree_registry import TreeRegistry
+from haplotyping import Haplotyping
+from tree_diff import diff_trees
+
+"""
+批量单倍群分型，用于单倍群树更新后重新分型全部样本:
+    python cohort.py samples/ -o results.jsonl
+    python cohort.py manifest.txt -o results.csv --workers 8
+样本可以是目录（其中的 .json/.tsv/.txt/.csv/.vcf/.gz 文件）或清单文件（每行一个样本文件路径）。
+样本文件可以是 get_genome_from_json 能读取的基因数据或 WeGene 的 {"inputs": ...} 输入，
+也可以是 23andMe、AncestryDNA、FTDNA/MyHeritage CSV 或 VCF 格式的原始数据（可以用gzip压缩），只流式读取其中的Y和mt位点。
+结果逐个样本追加写入，中断后重新运行同一命令会跳过已完成的样本。
+单倍群树更新后，可以只重新分型受影响的样本，其它样本沿用上次的结果:
+    python cohort.py samples/ -o results_new.jsonl --previous results.jsonl --old-tree-dir old_haplotree/
+"""
+
+# 样本文件扩展名
+SAMPLE_EXTENSIONS = (".json", ".tsv", ".txt", ".csv", ".vcf", ".gz")
+
+# CSV结果的列
+CSV_FIELDS = [
+    "sample",
+    "y_haplo",
+    "y_snp_derived_count",
+    "y_haplo_depth",
+    "y_haplo_score",
+    "mt_haplo",
+    "mt_snp_derived_count",
+    "mt_haplo_depth",
+    "mt_haplo_score",
+    "error",
+]
+
+# 工作进程的单倍群分型资源，每个进程只加载一次
+_worker_resource: HaploResource = None
+# 工作进程分析所用的参考基因组
+_worker_genome_ref: str = "hg19"
+# 新旧版本单倍群树的差异，{y|mt: TreeDiff}，没有上次结果时为None
+_worker_tree_diff_dict: dict = None
+
+
+# 列出样本文件，返回 [(样本名, 文件路径)]，样本名用于断点续跑
+def list_samples(sample_path: str) -> list:
+    sample_list = []
+    if os.path.isdir(sample_path):
+        for dir_path, dir_names, file_names in os.walk(sample_path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name.lower().endswith(SAMPLE_EXTENSIONS):
+                    file_path = os.path.join(dir_path, file_name)
+                    sample_list.append(
+                        (os.path.relpath(file_path, sample_path), file_path)
+                    )
+    else:
+        # 清单中的相对路径相对于清单文件所在目录
+        manifest_dir = os.path.dirname(os.path.abspath(sample_path))
+        with open(sample_path, "r", encoding="utf-8-sig") as manifest_file:
+            for line in manifest_file:
+                line = line.strip()
+                if len(line) > 0 and not line.startswith("#"):
+                    sample_list.append((line, os.path.join(manifest_dir, line)))
+    return sample_list
+
+
+# 染色体名统一为Y和MT
+def _normalize_chromosome(chromosome: str) -> str:
+    chromosome = str(chromosome).upper()
+    if chromosome.startswith("CHR"):
+        chromosome = chromosome[3:]
+    return "MT" if chromosome == "M" else chromosome
+
+
+# 从 {rsid: {chromosome, position, genotype}} 格式的基因数据中筛选Y和mt位点，不包含nocall和indel位点
+def _split_y_mt(user_genome: dict) -> tuple:
+    user_y_dict = {}
+    user_mt_dict = {}
+    for snp in user_genome.values():
+        if not isinstance(snp, dict) or "genotype" not in snp:
+            continue
+        genotype = snp["genotype"]
+        if len(genotype) == 0 or genotype[0] not in {"A", "T", "G", "C"}:
+            continue
+        chromosome = _normalize_chromosome(snp.get("chromosome", ""))
+        if chromosome == "Y":
+            user_y_dict[str(snp["position"])] = genotype
+        elif chromosome == "MT":
+            user_mt_dict[str(snp["position"])] = genotype
+    return user_y_dict, user_mt_dict
+
+
+# 加载样本文件，返回用户的Y和mt-SNP: ({位置: 基因型}, {位置: 基因型})
+def load_sample(file_path: str) -> tuple:
+    if file_path.lower().endswith(".json"):
+        user_genome = wegene_utils.get_genome_from_json(file_path)
+        if "inputs" in user_genome:
+            user_chrom_dict = wegene_utils.extract_positions(
+                user_genome["inputs"], chromosomes=("Y", "MT")
+            )
+            return user_chrom_dict["Y"], user_chrom_dict["MT"]
+        return _split_y_mt(user_genome)
+    # 原始数据文件按文件头检测格式，一次流式读取只保留Y和mt位点
+    user_chrom_dict = wegene_utils.get_positions_from_file(
+        file_path, chromosomes=("Y", "MT")
+    )
+    return user_chrom_dict["Y"], user_chrom_dict["MT"]
+
+
+# 工作进程初始化，加载单倍群分型树；指定了共享映像目录时映射主进程发布的映像
+def _init_worker(
+    source: str,
+    genome_ref: str,
+    tree_diff_dict: dict = None,
+    shared_tree_dir: str = None,
+):
+    global _worker_resource, _worker_genome_ref, _worker_tree_diff_dict
+    _worker_resource = HaploResource(
+        source, TreeRegistry(sharedTreeDir=shared_tree_dir)
+    )
+    _worker_resource.get_haplo("y")
+    _worker_resource.get_haplo("mt")
+    _worker_genome_ref = genome_ref
+    _worker_tree_diff_dict = tree_diff_dict
+
+
+# 分型结果摘要，不包含分型路径
+def _summarize(haplo_list: list) -> list:
+    return [haplo.to_dict(withPath=False) for haplo in haplo_list]
+
+
+# 上次的分型结果是否可以沿用：上次分型成功、用户检测的位置数相同，且单倍群树的变化不影响已有结果和用户检测的位置
+def _can_reuse(previous_record: dict, is_y_mt: str, user_genome: dict) -> bool:
+    if previous_record == None or _worker_tree_diff_dict == None:
+        return False
+    if "error" in previous_record or is_y_mt not in previous_record:
+        return False
+    if previous_record.get(is_y_mt + "_snp_count") != len(user_genome):
+        return False
+    return not _worker_tree_diff_dict[is_y_mt].needs_retyping(
+        [haplo["haplo"] for haplo in previous_record[is_y_mt]],
+        user_genome,
+        _worker_genome_ref,
+    )
+
+
+# 错误记录中的错误信息
+def _error_message(e: Exception) -> str:
+    return "".join(str(msg) for msg in e.args) or type(e).__name__
+
+
+# 批量分型已加载样本中loaded_idx_list的Y或mt，能沿用上次结果的样本不重新分型。
+# 返回 {已加载样本下标: 分型结果摘要}，重新分型的样本下标加入typed_set
+def _type_chromosome(
+    loaded_list: list, loaded_idx_list: list, is_y_mt: str, typed_set: set
+) -> dict:
+    genome_pos = 1 if is_y_mt == "y" else 2
+    haplo_list_dict = {}
+    todo_list = []
+    for loaded_idx in loaded_idx_list:
+        loaded = loaded_list[loaded_idx]
+        if _can_reuse(loaded[3], is_y_mt, loaded[genome_pos]):
+            haplo_list_dict[loaded_idx] = loaded[3][is_y_mt]
+        else:
+            todo_list.append(loaded_idx)
+    if len(todo_list) > 0:
+        haplo_list_list = _worker_resource.get_haplo(is_y_mt).analyse_batch(
+            [loaded_list[loaded_idx][genome_pos] for loaded_idx in todo_list],
+            _worker_genome_ref,
+        )
+        for loaded_idx, haplo_list in zip(todo_list, haplo_list_list):
+            haplo_list_dict[loaded_idx] = _summarize(haplo_list)
+        typed_set.update(todo_list)
+    return haplo_list_dict
+
+
+# 工作进程分型一组样本 [(样本名, 文件路径, 上次的结果记录或None)]，返回每个样本的结果记录和重新分型的样本数。
+# 有上次的结果时，Y和mt分别判断能否沿用，只分析受单倍群树变化影响的部分。
+# 一组样本的批量分型出错时逐个重新分型，出错的样本记录错误信息，不影响同组的其它样本
+def _type_samples(sample_list: list) -> tuple:
+    record_list = []
+    loaded_list = []
+    for sample_name, file_path, previous_record in sample_list:
+        try:
+            user_y_dict, user_mt_dict = load_sample(file_path)
+            loaded_list.append((sample_name, user_y_dict, user_mt_dict, previous_record))
+        except Exception as e:
+            record_list.append({"sample": sample_name, "error": _error_message(e)})
+
+    typed_set = set()
+    # 分型出错的样本，{已加载样本下标: 错误信息}
+    error_dict = {}
+    haplo_list_dict = {}
+    for is_y_mt in ("y", "mt"):
+        loaded_idx_list = [
+            loaded_idx
+            for loaded_idx in range(len(loaded_list))
+            if loaded_idx not in error_dict
+        ]
+        try:
+            chrom_haplo_list_dict = _type_chromosome(
+                loaded_list, loaded_idx_list, is_y_mt, typed_set
+            )
+        except Exception:
+            chrom_haplo_list_dict = {}
+            for loaded_idx in loaded_idx_list:
+                try:
+                    chrom_haplo_list_dict.update(
+                        _type_chromosome(loaded_list, [loaded_idx], is_y_mt, typed_set)
+                    )
+                except Exception as e:
+                    error_dict[loaded_idx] = _error_message(e)
+        for loaded_idx, haplo_list in chrom_haplo_list_dict.items():
+            haplo_list_dict[(loaded_idx, is_y_mt)] = haplo_list
+
+    for loaded_idx, (sample_name, user_y_dict, user_mt_dict, _) in enumerate(
+        loaded_list
+    ):
+        if loaded_idx in error_dict:
+            record_list.append({"sample": sample_name, "error": error_dict[loaded_idx]})
+            continue
+        record_list.append(
+            {
+                "sample": sample_name,
+                "y_snp_count": len(user_y_dict),
+                "mt_snp_count": len(user_mt_dict),
+                "y": haplo_list_dict[(loaded_idx, "y")],
+                "mt": haplo_list_dict[(loaded_idx, "mt")],
+            }
+        )
+    return (
+        record_list,
+        len(typed_set.union(error_dict)) + len(sample_list) - len(loaded_list),
+    )
+
+
+# 读取上次的JSONL分型结果，{样本名: 结果记录}
+def load_previous_results(file_name: str) -> dict:
+    if file_name.lower().endswith(".csv"):
+        raise Exception("上次的结果需要是JSONL格式，CSV结果只有首个分型结果")
+    previous_dict = {}
+    with open(file_name, "r", encoding="utf-8") as result_file:
+        for line in result_file:
+            # 被中断时最后一行可能不完整
+            if line.endswith("\n") and len(line.strip()) > 0:
+                record = json.loads(line)
+                previous_dict[record["sample"]] = record
+    return previous_dict
+
+
+# 比较旧版本和当前的Y和mt单倍群分型树，{y|mt: TreeDiff}
+def diff_source_trees(source: str, old_tree_dir: str) -> dict:
+    resource = HaploResource(source)
+    tree_diff_dict = {}
+    for is_y_mt in ("y", "mt"):
+        old_haplo = Haplotyping(
+            os.path.join(
+                old_tree_dir, "{}_{}_snp_tree.json".format(source.lower(), is_y_mt)
+            ),
+            source,
+            is_y_mt,
+        )
+        tree_diff_dict[is_y_mt] = diff_trees(old_haplo, resource.get_haplo(is_y_mt))
+    return tree_diff_dict
+
+
+# 结果文件的写入器，JSONL每行一个样本，CSV每行一个样本的首个Y和mt分型结果
+class ResultWriter:
+    def __init__(self, file_name: str, result_format: str):
+        self.__result_format = result_format
+        self.__file_name = file_name
+        self.__truncate_partial_line()
+        is_new = not os.access(file_name, os.F_OK) or os.path.getsize(file_name) == 0
+        self.__file = open(file_name, "a", encoding="utf-8", newline="")
+        self.__csv_writer = None
+        if result_format == "csv":
+            self.__csv_writer = csv.DictWriter(self.__file, fieldnames=CSV_FIELDS)
+            if is_new:
+                self.__csv_writer.writeheader()
+
+    # 上次运行在写入一行的中途被中断时，去掉不完整的最后一行
+    def __truncate_partial_line(self):
+        if not os.access(self.__file_name, os.F_OK):
+            return
+        with open(self.__file_name, "rb+") as result_file:
+            content = result_file.read()
+            if len(content) > 0 and not content.endswith(b"\n"):
+                result_file.truncate(content.rfind(b"\n") + 1)
+
+    # 读取已完成的样本名
+    def done_samples(self) -> set:
+        done_set = set()
+        with open(self.__file_name, "r", encoding="utf-8", newline="") as result_file:
+            if self.__result_format == "csv":
+                for row in csv.DictReader(result_file):
+                    done_set.add(row["sample"])
+            else:
+                for line in result_file:
+                    if len(line.strip()) > 0:
+                        done_set.add(json.loads(line)["sample"])
+        return done_set
+
+    def write(self, record: dict):
+        if self.__csv_writer == None:
+            self.__file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            return
+
+        row = {"sample": record["sample"], "error": record.get("error", "")}
+        for is_y_mt in ("y", "mt"):
+            if len(record.get(is_y_mt, [])) > 0:
+                haplo = record[is_y_mt][0]
+                for key in ("haplo", "snp_derived_count", "haplo_depth", "haplo_score"):
+                    row["{}_{}".format(is_y_mt, key)] = haplo[key]
+        self.__csv_writer.writerow(row)
+
+    # 检查点，把已写入的结果落盘
+    def checkpoint(self):
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+    def close(self):
+        self.checkpoint()
+        self.__file.close()
+
+
+def run(
+    sample_path: str,
+    output_file_name: str,
+    result_format: str,
+    workers: int,
+    source: str,
+    genome_ref: str,
+    chunk_size: int,
+    checkpoint_every: int,
+    previous_file_name: str = None,
+    old_tree_dir: str = None,
+    shared_tree_dir: str = None,
+):
+    sample_list = list_samples(sample_path)
+
+    # 先在主进程发布共享映像，工作进程启动时直接映射，不再各自加载和编译
+    if shared_tree_dir != None:
+        shared_resource = HaploResource(
+            source, TreeRegistry(sharedTreeDir=shared_tree_dir)
+        )
+        shared_resource.get_haplo("y")
+        shared_resource.get_haplo("mt")
+
+    # 有上次的结果和旧版本的单倍群树时，只重新分型受单倍群树变化影响的样本
+    previous_dict = {}
+    tree_diff_dict = None
+    if previous_file_name != None:
+        if old_tree_dir == None:
+            raise Exception("沿用上次的结果需要指定旧版本的单倍群树目录")
+        if os.path.abspath(previous_file_name) == os.path.abspath(output_file_name):
+            raise Exception("上次的结果文件不能与结果文件相同")
+        previous_dict = load_previous_results(previous_file_name)
+        tree_diff_dict = diff_source_trees(source, old_tree_dir)
+        for is_y_mt, tree_diff in tree_diff_dict.items():
+            diff_dict = tree_diff.to_dict()
+            sys.stderr.write(
+                "{}单倍群树：新增{}个，删除{}个，移动{}个，SNP变化{}个单倍群\n".format(
+                    is_y_mt.upper(),
+                    len(diff_dict["added"]),
+                    len(diff_dict["removed"]),
+                    len(diff_dict["moved"]),
+                    len(diff_dict["changed"]),
+                )
+            )
+
+    writer = ResultWriter(output_file_name, result_format)
+    done_set = writer.done_samples()
+    todo_list = [
+        (sample_name, file_path, previous_dict.get(sample_name))
+        for sample_name, file_path in sample_list
+        if sample_name not in done_set
+    ]
+    sys.stderr.write(
+        "共{}个样本，已完成{}个，待分型{}个\n".format(
+            len(sample_list), len(sample_list) - len(todo_list), len(todo_list)
+        )
+    )
+
+    chunk_list = [
+        todo_list[chunk_start : chunk_start + chunk_size]
+        for chunk_start in range(0, len(todo_list), chunk_size)
+    ]
+    start_time = time.time()
+    typed_count = 0
+    retyped_count = 0
+    uncheckpointed_count = 0
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(source, genome_ref, tree_diff_dict, shared_tree_dir),
+        ) as executor:
+            # 同时提交的任务数有上限，避免一次把全部样本名放进任务队列
+            pending_set = set()
+            chunk_iter = iter(chunk_list)
+            for chunk in chunk_iter:
+                pending_set.add(executor.submit(_type_samples, chunk))
+                if len(pending_set) >= workers * 2:
+                    break
+            while len(pending_set) > 0:
+                finished_set, pending_set = wait(
+                    pending_set, return_when=FIRST_COMPLETED
+                )
+                for task in finished_set:
+                    record_list, task_retyped_count = task.result()
+                    retyped_count += task_retyped_count
+                    for record in record_list:
+                        writer.write(record)
+                        typed_count += 1
+                        uncheckpointed_count += 1
+                    next_chunk = next(chunk_iter, None)
+                    if next_chunk != None:
+                        pending_set.add(executor.submit(_type_samples, next_chunk))
+
+                if uncheckpointed_count >= checkpoint_every:
+                    writer.checkpoint()
+                    uncheckpointed_count = 0
+                    elapsed = time.time() - start_time
+                    sys.stderr.write(
+                        "已分型{}/{}个样本，{:.1f}个样本/秒\n".format(
+                            typed_count,
+                            len(todo_list),
+                            typed_count / elapsed if elapsed > 0 else 0,
+                        )
+                    )
+    finally:
+        writer.close()
+
+    elapsed = time.time() - start_time
+    sys.stderr.write(
+        "完成，分型{}个样本，用时{:.1f}秒，{:.1f}个样本/秒\n".format(
+            typed_count, elapsed, typed_count / elapsed if elapsed > 0 else 0
+        )
+    )
+    if tree_diff_dict != None:
+        sys.stderr.write(
+            "其中重新分型{}个样本，沿用上次结果{}个样本\n".format(
+                retyped_count, typed_count - retyped_count
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量Y/mtDNA单倍群分型")
+    parser.add_argument("samples", help="样本目录，或每行一个样本文件路径的清单文件")
+    parser.add_argument(
+        "-o", "--output", required=True, help="结果文件，已存在时跳过其中已完成的样本"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["jsonl", "csv"],
+        help="结果格式，默认按结果文件扩展名判断",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="进程数，默认为CPU核数"
+    )
+    parser.add_argument("--source", default="mf", help="单倍群树数据源，默认为mf")
+    parser.add_argument(
+        "--genome-ref", default="hg19", help="样本的参考基因组：hg19或hg38，默认为hg19"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=32, help="每个任务批量分型的样本数，默认为32"
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=256,
+        help="每写入多少个样本的结果落盘一次并报告进度，默认为256",
+    )
+    parser.add_argument(
+        "--previous",
+        metavar="RESULTS",
+        help="上次的JSONL分型结果，单倍群树的变化不影响的样本沿用其中的结果",
+    )
+    parser.add_argument(
+        "--old-tree-dir",
+        metavar="DIR",
+        help="上次分型所用的旧版本单倍群树目录，与--previous一起使用",
+    )
+    parser.add_argument(
+        "--shared-tree-dir",
+        metavar="DIR",
+        help="单倍群树共享映像目录，工作进程映射同一份编译结果，如/dev/shm/haplotree",
+    )
+    args = parser.parse_args()
+
+    result_format = args.format
+    if result_format == None:
+        result_format = "csv" if args.output.lower().endswith(".csv") else "jsonl"
+
+    try:
+        run(
+            args.samples,
+            args.output,
+            result_format,
+            max(args.workers, 1),
+            args.source,
+            args.genome_ref,
+            max(args.chunk_size, 1),
+            max(args.checkpoint_every, 1),
+            args.previous,
+            args.old_tree_dir,
+            args.shared_tree_dir,
+        )
+    except KeyboardInterrupt:
+        sys.stderr.write("已中断，重新运行同一命令可继续分型\n")
+        exit(130)
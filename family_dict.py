@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+
+# Y家族字典，{单倍群: {"a": 共祖年代, "hf": [{"fi": 家族ID, "ft": 家族名}]}}。
+# 首次使用时由JSON文件建立SQLite索引文件，之后按单倍群名查询，不必每次解析整个JSON文件；查询过的单倍群缓存在内存中，常驻运行时共享
+class YFamilyDict:
+    # SQLite索引文件的格式版本，结构变化时需要增加，使旧索引失效
+    __index_version: int = 1
+    # Y家族字典JSON文件名
+    __dict_file_name: str = None
+    # SQLite连接，索引不可用时为None
+    __conn: sqlite3.Connection = None
+    # 索引不可用时，直接使用解析后的整个字典
+    __memory_dict: dict = None
+    # 已查询的单倍群，不存在的单倍群缓存为None
+    __cache_dict: dict = None
+    __lock: threading.Lock = None
+
+    def __init__(self, dictFileName: str = None):
+        if dictFileName == None:
+            raise Exception("请指定Y家族字典文件名")
+
+        if not os.access(dictFileName, os.F_OK):
+            raise Exception("Y家族字典文件不可访问：" + dictFileName)
+
+        self.__dict_file_name = dictFileName
+        self.__cache_dict = {}
+        self.__lock = threading.Lock()
+        if not self.__open_index():
+            self.__build_index()
+
+    def __del__(self):
+        if self.__conn != None:
+            self.__conn.close()
+            self.__conn = None
+
+    # SQLite索引文件放在Y家族字典文件旁边
+    def __index_file_name(self) -> str:
+        return self.__dict_file_name + ".sqlite"
+
+    # 索引文件的校验键，Y家族字典文件的修改时间和大小任一变化都会使索引失效
+    def __index_key(self) -> str:
+        dict_stat = os.stat(self.__dict_file_name)
+        return json.dumps(
+            [self.__index_version, dict_stat.st_mtime_ns, dict_stat.st_size]
+        )
+
+    # 打开已有的索引文件，索引可用时返回True
+    def __open_index(self) -> bool:
+        index_file_name = self.__index_file_name()
+        if not os.access(index_file_name, os.F_OK):
+            return False
+        try:
+            conn = sqlite3.connect(
+                "file:{}?mode=ro".format(index_file_name),
+                uri=True,
+                check_same_thread=False,
+            )
+            row = conn.execute("SELECT value FROM meta WHERE name = 'key'").fetchone()
+            if row != None and row[0] == self.__index_key():
+                self.__conn = conn
+                return True
+            conn.close()
+        except sqlite3.Error:
+            logging.warning("Y家族字典索引不可用，重新建立：{}".format(index_file_name))
+        return False
+
+    # 解析JSON文件并建立索引文件，先写临时文件再替换，避免并发打开读到不完整的索引；无法保存时使用内存中的字典
+    def __build_index(self):
+        with open(self.__dict_file_name, "r", encoding="utf-8-sig") as dict_file:
+            y_dict = json.load(dict_file)
+            y_dict = y_dict if "dict" not in y_dict else y_dict["dict"]
+
+        index_file_name = self.__index_file_name()
+        tmp_file_name = "{}.{}.tmp".format(index_file_name, os.getpid())
+        try:
+            if os.access(tmp_file_name, os.F_OK):
+                os.remove(tmp_file_name)
+            conn = sqlite3.connect(tmp_file_name)
+            try:
+                conn.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+                conn.execute(
+                    "CREATE TABLE haplo (name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID"
+                )
+                conn.execute(
+                    "INSERT INTO meta VALUES ('key', ?)", (self.__index_key(),)
+                )
+                conn.executemany(
+                    "INSERT INTO haplo VALUES (?, ?)",
+                    (
+                        (haplo, json.dumps(value, ensure_ascii=False))
+                        for haplo, value in y_dict.items()
+                    ),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            os.replace(tmp_file_name, index_file_name)
+        except (OSError, sqlite3.Error):
+            logging.warning("Y家族字典索引无法保存：{}".format(index_file_name))
+            if os.access(tmp_file_name, os.F_OK):
+                os.remove(tmp_file_name)
+            self.__memory_dict = y_dict
+            return
+
+        if not self.__open_index():
+            self.__memory_dict = y_dict
+
+    # 查询单倍群的家族信息，不存在时返回None
+    def get(self, haplo: str) -> dict:
+        with self.__lock:
+            if haplo not in self.__cache_dict:
+                if self.__memory_dict != None:
+                    self.__cache_dict[haplo] = self.__memory_dict.get(haplo)
+                else:
+                    row = self.__conn.execute(
+                        "SELECT value FROM haplo WHERE name = ?", (haplo,)
+                    ).fetchone()
+                    self.__cache_dict[haplo] = json.loads(row[0]) if row != None else None
+            return self.__cache_dict[haplo]
+
+    def __getitem__(self, haplo: str) -> dict:
+        value = self.get(haplo)
+        if value == None:
+            raise KeyError(haplo)
+        return value
+
+    def __contains__(self, haplo: str) -> bool:
+        return self.get(haplo) != None
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from haplotyping import Haplotyping
+from family_dict import YFamilyDict
+from tree_registry import TreeRegistry
+from instrument import Instrument
+
+
+# 一个数据源的单倍群分型树和Y家族字典，首次使用时由单倍群树注册表加载，常驻模式下被所有请求共享
+class HaploResource:
+    def __init__(
+        self,
+        source: str,
+        registry: TreeRegistry = None,
+        timeBudget: float = None,
+        sourceWorkers: int = 1,
+    ):
+        self.__source = source
+        self.__registry = registry if registry != None else TreeRegistry()
+        self.__time_budget = timeBudget
+        self.__source_workers = sourceWorkers
+
+    @property
+    def Source(self):
+        return self.__source
+
+    @property
+    def Registry(self):
+        return self.__registry
+
+    # 每个单倍群分型树的分析时间预算，秒，None表示不限时间
+    @property
+    def TimeBudget(self):
+        return self.__time_budget
+
+    # 一个请求指定多个数据源时同时分析的单倍群分型树数
+    @property
+    def SourceWorkers(self):
+        return self.__source_workers
+
+    # 同一注册表中另一个数据源的资源
+    def with_source(self, source: str) -> "HaploResource":
+        if source.lower() == self.__source.lower():
+            return self
+        return HaploResource(
+            source, self.__registry, self.__time_budget, self.__source_workers
+        )
+
+    # 获取Y或mt单倍群分型对象，单倍群分型树只读，可被并发的请求共享
+    def get_haplo(self, is_y_mt: str) -> Haplotyping:
+        return self.__registry.get_haplo(self.__source, is_y_mt)
+
+    # 获取Y或mt单倍群分型树的子树进程池，未指定子树工作进程数时为None
+    def get_subtree_pool(self, is_y_mt: str):
+        return self.__registry.get_subtree_pool(self.__source, is_y_mt)
+
+    # 获取Y家族字典，按单倍群名查询，不加载整个字典；数据源没有家族字典时返回None
+    def get_y_dict(self) -> YFamilyDict:
+        return self.__registry.get_y_dict(self.__source)
+
+    # 用Y或mt单倍群分型对象分析用户基因数据。有时间预算时逐步分析，预算用完时返回当前最好的结果；否则使用子树进程池（如有）
+    def analyse(
+        self,
+        haplo: Haplotyping,
+        is_y_mt: str,
+        user_genome: dict,
+        instrument: Instrument = None,
+    ) -> list:
+        if self.__time_budget != None:
+            return haplo.analyse(
+                user_genome, instrument=instrument, timeBudget=self.__time_budget
+            )
+        return haplo.analyse(
+            user_genome,
+            instrument=instrument,
+            subtreePool=self.get_subtree_pool(is_y_mt),
+        )
+
+    # 用多个数据源的单倍群分型树分析同一个用户的Y和mt基因数据，各棵树同时加载和分析。返回 {(来源, y|mt): 分型结果列表}
+    def analyse_sources(
+        self,
+        user_chrom_dict: dict,
+        source_list: list,
+        instrument: Instrument = None,
+    ) -> dict:
+        return self.__registry.analyse_sources(
+            user_chrom_dict,
+            source_list,
+            workers=self.__source_workers,
+            timeBudget=self.__time_budget,
+            instrument=instrument,
+        )
@@ -1,24 +1,238 @@
 # -*- coding: utf-8 -*-
 import os
+import gc
+import sys
 import re
 import json
+import time
+import heapq
+import pickle
+import hashlib
 import logging
+from array import array
+from bisect import bisect_left
+from itertools import repeat
+from operator import itemgetter
+
+from instrument import Instrument, instrument_enabled, timed
+from result_cache import ResultCache
+from shared_tree import (
+    SharedTree,
+    SharedPosIndex,
+    encode_allele_code,
+    encode_pos_index,
+    encode_string_list,
+    write_shared_tree,
+)
 
 # logging.basicConfig(level=logging.INFO)
 
 
+# 估算对象及其引用的容器和字符串占用的内存，字节。共享的对象只计一次，用显式栈遍历，不受嵌套深度限制
+def _object_size(obj) -> int:
+    total_size = 0
+    seen_set = set()
+    obj_stack = [obj]
+    while len(obj_stack) > 0:
+        obj = obj_stack.pop()
+        if id(obj) in seen_set:
+            continue
+        seen_set.add(id(obj))
+        total_size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            obj_stack.extend(obj.keys())
+            obj_stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            obj_stack.extend(obj)
+    return total_size
+
+
+# 单次单倍群分析的上下文，保存用户在树上的突变情况和分型结果。单倍群分型树本身只读，可被多个分析并发共享
+class HaploContext:
+    # 用户基因数据，{位置: 基因型}
+    user_genome: dict = None
+    # 用户基因数据所用的SNP位置索引
+    snp_pos_index: dict = None
+    # 用户已检测SNP的突变值，{SNP下标: 用户突变}
+    user_snp_dict: dict = None
+    # 单倍群节点中用户已检测SNP数，{节点下标: SNP数}
+    node_var_count: dict = None
+    # 单倍群节点中用户突变SNP数，{节点下标: SNP数}
+    node_der_count: dict = None
+    # 单倍群分型结果，HaploResult列表
+    haplogroup_list: list = None
+    # 用户位置与树上SNP位置的交集，[(SNP下标列表, 用户突变)]
+    pos_hit_list: list = None
+    # 用户位置与树上SNP位置的交集数
+    pos_hit_count: int = 0
+    # 有分型结果的阳性节点的(终端节点下标, 阳性节点下标)，按终端节点先序排列
+    end_node_list: list = None
+    # 因不可能进入前maxHaploCount个结果而跳过的已检测节点数
+    pruned_node_count: int = 0
+
+    def __init__(self, user_genome: dict, snp_pos_index: dict):
+        self.user_genome = user_genome
+        self.snp_pos_index = snp_pos_index
+        self.user_snp_dict = {}
+        self.node_var_count = {}
+        self.node_der_count = {}
+        self.haplogroup_list = []
+        self.end_node_list = []
+
+
+# 单倍群分型结果，只保存终端节点下标、分型结果和评分。分型路径和用户突变在使用时才从单倍群分型树生成，每次生成的都是副本；
+# 结果本身只读，可以被缓存和多个请求共享。也可以像原来的结果字典一样用"haplo"、"snp_derived_count"、"haplo_depth"、"haplo_score"、"haplo_path"键访问
+class HaploResult:
+    __slots__ = (
+        # 生成结果的单倍群分型对象
+        "__haplo_obj",
+        # 单倍群名
+        "__haplo",
+        # 终端节点下标
+        "__end_node",
+        # 分型结果，(单倍群节点下标, derived SNP数, 分型深度, 已检测SNP数, 有derived突变的单倍群数)
+        "__haplo_result",
+        # 可信度评分
+        "__haplo_score",
+        # 用户已检测SNP的突变值，{SNP下标: 用户突变}，同一次分析的结果共享，至少包括分型路径上的SNP
+        "__user_snp_dict",
+    )
+
+    # 字典键对应的属性
+    __item_getter_dict = {
+        "haplo": lambda result: result.Haplo,
+        "snp_derived_count": lambda result: result.SNPDerivedCount,
+        "haplo_depth": lambda result: result.HaploDepth,
+        "haplo_score": lambda result: result.HaploScore,
+        "haplo_path": lambda result: result.HaploPath,
+    }
+
+    @property
+    def Haplo(self):
+        return self.__haplo
+
+    @property
+    def SNPDerivedCount(self):
+        return self.__haplo_result[1]
+
+    @property
+    def HaploDepth(self):
+        return self.__haplo_result[2]
+
+    @property
+    def HaploScore(self):
+        return self.__haplo_score
+
+    @property
+    def EndNode(self):
+        return self.__end_node
+
+    # 分型路径上的每个单倍群和突变情况，从终端节点到根节点，[{"haplo": 单倍群名, "mutation": [SNP字典]}]，用户已检测的SNP附带用户突变值
+    @property
+    def HaploPath(self):
+        return self.__haplo_obj.make_haplo_path(self.__end_node, self.__user_snp_dict)
+
+    # 分型路径上的单倍群名，从终端节点到根节点，不生成突变列表
+    @property
+    def PathHaplo(self):
+        return self.__haplo_obj.path_haplo(self.__end_node)
+
+    def __init__(
+        self,
+        haploObj,
+        endNode: int,
+        haploResult: tuple,
+        haploScore: float,
+        userSnpDict: dict,
+    ):
+        self.__haplo_obj = haploObj
+        self.__haplo = haploObj.node_name(haploResult[0])
+        self.__end_node = endNode
+        self.__haplo_result = haploResult
+        self.__haplo_score = haploScore
+        self.__user_snp_dict = userSnpDict
+
+    def __getitem__(self, key: str):
+        return self.__item_getter_dict[key](self)
+
+    def __repr__(self):
+        return "HaploResult({}, {}, {}, {:.4f})".format(
+            self.__haplo,
+            self.__haplo_result[1],
+            self.__haplo_result[2],
+            self.__haplo_score,
+        )
+
+    # 转换为结果字典，withPath为False时不生成分型路径
+    def to_dict(self, withPath: bool = True) -> dict:
+        haplo_dict = {
+            "haplo": self.__haplo,
+            "snp_derived_count": self.__haplo_result[1],
+            "haplo_depth": self.__haplo_result[2],
+            "haplo_score": self.__haplo_score,
+        }
+        if withPath:
+            haplo_dict["haplo_path"] = self.HaploPath
+        return haplo_dict
+
+
+# 逐步分析的单倍群分型结果，本身是HaploResult列表，另外记录是否因时间或工作量预算用完而没有搜索全部子树。
+# 没有搜索的子树中可能有更好的结果，Partial为False时与不限时间的分析结果相同
+class HaploSnapshot(list):
+    __slots__ = (
+        # 是否没有搜索全部子树
+        "__partial",
+        # 已搜索的子树数
+        "__explored_clades",
+        # 需要搜索的子树数，没有derived SNP的子树不计
+        "__total_clades",
+    )
+
+    @property
+    def Partial(self):
+        return self.__partial
+
+    @property
+    def ExploredClades(self):
+        return self.__explored_clades
+
+    @property
+    def TotalClades(self):
+        return self.__total_clades
+
+    def __init__(
+        self, haploList: list, partial: bool, exploredClades: int, totalClades: int
+    ):
+        super().__init__(haploList)
+        self.__partial = partial
+        self.__explored_clades = exploredClades
+        self.__total_clades = totalClades
+
+    def __repr__(self):
+        return "HaploSnapshot({}, partial={}, {}/{})".format(
+            list.__repr__(self),
+            self.__partial,
+            self.__explored_clades,
+            self.__total_clades,
+        )
+
+
 # Y/mtDNA单倍群分型
 class Haplotyping:
-    # 单倍群分型结果
-    __haplogroup_list: list = None
-    # 单倍群分型树
+    # 单倍群分型树，编译后只读
     __haplo_tree: dict = None
+    # 单倍群分型树文件名
+    __haplo_tree_file_name: str = None
+    # 预编译缓存的格式版本，编译结果的结构变化时需要增加，使旧缓存失效
+    __tree_cache_version: int = 2
     # 单倍群分型树的时间戳
     __timestamp: str = None
     # 单倍群分型树的来源
     __source: str = ""
     # 单倍群分型树是Y或mt
     __is_y_mt: str = ""
+    # 单倍群分型树是否为Y树，加载时判断一次，分析时不再匹配树类型
+    __is_y: bool = False
     # 单倍群分型树的单倍群总数
     __total_haplo_count: int = 0
     # 单倍群分型树的SNP总数
@@ -49,9 +263,68 @@ class Haplotyping:
     __derived_key: str = ""
     # 单倍群分型树的用户突变键名
     __user_geno_key: str = "u"
+    # 编译后的单倍群节点名，按先序遍历排列，以下节点数组的下标与其一致
+    __node_name_list: list = None
+    # 编译后的单倍群节点的父节点下标，根节点为-1
+    __node_parent: array = None
+    # 编译后的单倍群节点的子树结束下标（不含），子树范围是[idx, end)
+    __node_end: array = None
+    # 编译后的单倍群节点的深度，根节点为0
+    __node_depth: array = None
+    # 编译后的单倍群节点是否有snp列表键
+    __node_has_snp: array = None
+    # 编译后的从根节点到单倍群节点（含）路径上有snp列表键的单倍群数
+    __node_snp_depth: array = None
+    # 编译后的单倍群节点的SNP在SNP数组中的起始下标，节点idx的SNP范围是[offset[idx], offset[idx+1])
+    __node_snp_offset: array = None
+    # 编译后的SNP所属单倍群节点下标
+    __snp_node: array = None
+    # 单倍群节点名是否唯一，唯一时才能按前maxHaploCount个结果剪枝，否则同名结果的先后顺序可能改变
+    __unique_node_name: bool = False
+    # SNP位置到SNP下标列表的倒排索引，Y树按hg19和hg38的pos19、pos38建立，mt树按mt的pos建立
+    __pos_index_dict: dict = None
+    # 从预编译缓存加载、尚未反序列化的倒排索引，首次分析对应的参考基因组时再反序列化
+    __pos_index_cache_dict: dict = None
+    # 编译后的SNP derived突变列
+    __snp_derived_list: list = None
+    # 映射共享映像时的SNP derived突变码位，代替__snp_derived_list，用户突变按首字符的码位比较
+    __snp_derived_code: memoryview = None
+    # 编译后的SNP字典，从预编译缓存加载时为None
+    __snp_dict_list: list = None
+    # 编译后的SNP字典的JSON文本，仅从预编译缓存加载时使用
+    __snp_json_list: list = None
+    # 批量分析使用的数组索引，按参考基因组首次批量分析时建立
+    __batch_index_dict: dict = None
+    # 批量分析时每组样本的中间数组内存上限，样本按此分组计算
+    __batch_memory: int = 64 << 20
+    # 是否统计每次分析的阶段耗时和计数，未传入性能统计对象时由分析自行输出到stderr
+    __instrument: bool = False
+    # 单倍群分型树的加载耗时，秒
+    __load_seconds: float = 0
+    # 分型结果缓存，None表示不缓存
+    __result_cache: ResultCache = None
+    # 分型结果缓存键的前缀，包括数据源、单倍群分型树的版本和分型规则参数
+    __result_key_prefix: str = ""
+    # 映射的单倍群分型树共享映像，编译结果直接使用映像中的数组，None表示编译结果在本进程内存中
+    __shared_tree: SharedTree = None
+    # 单倍群分型树的构造参数，子树进程池的工作进程用相同的参数加载同一棵树
+    __tree_option_dict: dict = None
+    # 逐步分析时至少拆分出的子树数，子树越多，每次检查预算之间的工作量越少
+    __progressive_clade_count: int = 64
+    # 逐步分析的子树拆分，(拆分层级, [(子树根节点下标, 子树结束下标)])，首次逐步分析时计算
+    __progressive_split: tuple = None
+    # 最近一次完成的分析结果，只用于兼容HaplogroupList和str()，并发分析时是其中任意一个的结果，应使用analyse的返回值
+    __haplogroup_list: list = None
+
+    @property
+    def HaplogroupList(self):
+        return self.__haplogroup_list
 
     @property
     def HaploTree(self):
+        # 从预编译缓存加载时不解析JSON，首次访问时再加载
+        if self.__haplo_tree == None:
+            self.__load_tree_json()
         return self.__haplo_tree
 
     @property
@@ -87,8 +360,21 @@ class Haplotyping:
         return self.__max_haplo_count
 
     @property
-    def HaplogroupList(self):
-        return self.__haplogroup_list
+    def LoadSeconds(self):
+        return self.__load_seconds
+
+    @property
+    def SharedTreeFileName(self):
+        return self.__shared_tree.FileName if self.__shared_tree != None else None
+
+    @property
+    def TreeOptions(self):
+        return dict(self.__tree_option_dict)
+
+    # 估算的内存占用，字节，包括编译后的数组、位置索引和访问HaploTree后加载的单倍群分型树，随分析建立的索引增加
+    @property
+    def MemorySize(self):
+        return _object_size(self.__dict__)
 
     def __init__(
         self,
@@ -107,7 +393,13 @@ class Haplotyping:
         posKey: str = "p",
         ancestralKey: str = "a",
         derivedKey: str = "d",
+        useTreeCache: bool = True,
+        instrument: bool = None,
+        resultCache: ResultCache = None,
+        sharedTreeFileName: str = None,
     ):
+        load_start_time = time.perf_counter()
+        self.__instrument = instrument_enabled() if instrument == None else instrument
         self.__source = source
         self.__is_y_mt = isYorMt
         self.__confirmed_positive_haplo = confirmedPositiveHaplo
@@ -135,8 +427,80 @@ class Haplotyping:
         if not re.match("y|mt", isYorMt, re.IGNORECASE):
             raise Exception("请指定单倍群树是：y或mt")
 
-        # 加载单倍群分型树
-        with open(haploTreeFileName, "r", encoding="utf-8-sig") as haplo_tree_file:
+        self.__haplo_tree_file_name = haploTreeFileName
+        self.__is_y = re.match("y", isYorMt, re.IGNORECASE) != None
+        self.__tree_option_dict = {
+            "haploTreeFileName": haploTreeFileName,
+            "source": source,
+            "isYorMt": isYorMt,
+            "confirmedPositiveHaplo": confirmedPositiveHaplo,
+            "allowedNegativeHaplo": allowedNegativeHaplo,
+            "maxHaploCount": maxHaploCount,
+            "haploKey": haploKey,
+            "childrenKey": childrenKey,
+            "snpListKey": snpListKey,
+            "snpKey": snpKey,
+            "pos19Key": pos19Key,
+            "pos38Key": pos38Key,
+            "posKey": posKey,
+            "ancestralKey": ancestralKey,
+            "derivedKey": derivedKey,
+            "useTreeCache": useTreeCache,
+            "sharedTreeFileName": sharedTreeFileName,
+        }
+
+        # 加载和编译时会创建大量没有循环引用的容器对象，暂停循环垃圾回收，避免反复扫描整棵树
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            # 指定了共享映像时优先映射已发布的映像；映像不存在或过期时照常加载，发布后改为映射，不保留本进程的编译结果
+            if sharedTreeFileName == None or not self.__attach_shared_tree(
+                sharedTreeFileName
+            ):
+                # 优先使用预编译缓存，缓存不存在、过期或损坏时重新加载单倍群分型树并编译
+                if not useTreeCache or not self.__load_tree_cache():
+                    self.__load_tree_json()
+                    self.__compile_tree()
+                    # 编译后分析只使用数组，不再保留解析的单倍群分型树，访问HaploTree时再加载
+                    self.__haplo_tree = None
+                    if useTreeCache:
+                        self.__save_tree_cache()
+                if sharedTreeFileName != None:
+                    try:
+                        self.publish_shared_tree(sharedTreeFileName)
+                        self.__attach_shared_tree(sharedTreeFileName)
+                    except OSError:
+                        logging.warning(
+                            "单倍群树共享映像无法发布：{}".format(sharedTreeFileName)
+                        )
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.__unique_node_name = len(set(self.__node_name_list)) == len(
+            self.__node_name_list
+        )
+        self.__result_cache = resultCache
+        self.__result_key_prefix = json.dumps(
+            [
+                self.__source,
+                self.__timestamp,
+                self.__tree_cache_key(),
+                self.__confirmed_positive_haplo,
+                self.__allowed_negative_haplo,
+                self.__max_haplo_count,
+            ],
+            ensure_ascii=False,
+        )
+        self.__load_seconds = time.perf_counter() - load_start_time
+
+    def __del__(self):
+        self.__haplo_tree = None
+
+    # 加载单倍群分型树JSON文件
+    def __load_tree_json(self):
+        with open(
+            self.__haplo_tree_file_name, "r", encoding="utf-8-sig"
+        ) as haplo_tree_file:
             haplo_tree_json = json.load(haplo_tree_file)
             # 单倍群树的时间戳
             if "timestamp" in haplo_tree_json:
@@ -148,231 +512,1710 @@ class Haplotyping:
                 else haplo_tree_json
             )
         if self.__haplo_tree == None:
-            raise Exception("单倍群树文件为空：" + haploTreeFileName)
+            raise Exception("单倍群树文件为空：" + self.__haplo_tree_file_name)
 
-    def __del__(self):
-        self.__haplo_tree = None
-        self.__haplogroup_list = None
+    # 预编译缓存文件放在单倍群分型树文件旁边
+    def __tree_cache_file_name(self) -> str:
+        return self.__haplo_tree_file_name + ".cache"
+
+    # 预编译缓存的校验键，单倍群分型树文件的修改时间和大小、树类型、键名任一变化都会使缓存失效
+    def __tree_cache_key(self) -> tuple:
+        tree_stat = os.stat(self.__haplo_tree_file_name)
+        return (
+            self.__tree_cache_version,
+            tree_stat.st_mtime_ns,
+            tree_stat.st_size,
+            self.__is_y_mt.lower(),
+            self.__haplo_key,
+            self.__children_key,
+            self.__snp_list_key,
+            self.__snp_key,
+            self.__pos19_key,
+            self.__pos38_key,
+            self.__pos_key,
+            self.__ancestral_key,
+            self.__derived_key,
+        )
+
+    # 不解析整个文件，从单倍群分型树文件开头读取时间戳，时间戳不在文件开头时返回None
+    def __read_tree_timestamp(self):
+        with open(
+            self.__haplo_tree_file_name, "r", encoding="utf-8-sig"
+        ) as haplo_tree_file:
+            head = haplo_tree_file.read(4096)
+        timestamp_match = re.search(
+            r'"timestamp"\s*:\s*("(?:[^"\\]|\\.)*"|[-+.\w]+)', head
+        )
+        if timestamp_match == None:
+            return None
+        return json.loads(timestamp_match.group(1))
+
+    # 加载预编译缓存，缓存可用时返回True
+    def __load_tree_cache(self) -> bool:
+        try:
+            with open(self.__tree_cache_file_name(), "rb") as cache_file:
+                tree_cache = pickle.load(cache_file)
 
-    # 单倍群分析
-    def analyse(self, user_genome: dict, genome_ref: str = "hg19") -> list:
+            if tree_cache["key"] != self.__tree_cache_key():
+                return False
+
+            timestamp = self.__read_tree_timestamp()
+            if timestamp != None and timestamp != tree_cache["timestamp"]:
+                return False
+
+            self.__timestamp = tree_cache["timestamp"]
+            self.__node_name_list = tree_cache["node_name_list"]
+            self.__node_parent = tree_cache["node_parent"]
+            self.__node_end = tree_cache["node_end"]
+            self.__node_depth = tree_cache["node_depth"]
+            self.__node_has_snp = tree_cache["node_has_snp"]
+            self.__node_snp_depth = tree_cache["node_snp_depth"]
+            self.__node_snp_offset = tree_cache["node_snp_offset"]
+            self.__snp_node = tree_cache["snp_node"]
+            self.__pos_index_dict = {}
+            self.__pos_index_cache_dict = tree_cache["pos_index_dict"]
+            self.__snp_derived_list = tree_cache["snp_derived_list"]
+            self.__snp_json_list = tree_cache["snp_json_list"]
+            self.__total_haplo_count = len(self.__node_name_list)
+            self.__total_snp_count = len(self.__snp_derived_list)
+            return True
+        except Exception as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(
+                    "单倍群树预编译缓存不可用，重新编译：{}".format(
+                        self.__tree_cache_file_name()
+                    )
+                )
+            return False
+
+    # 保存预编译缓存，先写临时文件再替换，避免并发加载读到不完整的缓存
+    def __save_tree_cache(self):
+        snp_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+        tree_cache = {
+            "key": self.__tree_cache_key(),
+            "timestamp": self.__timestamp,
+            "node_name_list": self.__node_name_list,
+            "node_parent": self.__node_parent,
+            "node_end": self.__node_end,
+            "node_depth": self.__node_depth,
+            "node_has_snp": self.__node_has_snp,
+            "node_snp_depth": self.__node_snp_depth,
+            "node_snp_offset": self.__node_snp_offset,
+            "snp_node": self.__snp_node,
+            "pos_index_dict": {
+                genome_ref: pickle.dumps(pos_index, protocol=pickle.HIGHEST_PROTOCOL)
+                for genome_ref, pos_index in self.__pos_index_dict.items()
+                if isinstance(genome_ref, str)
+            },
+            "snp_derived_list": self.__snp_derived_list,
+            # SNP字典只在输出分型路径时使用，保存为JSON文本，加载缓存时不必创建大量字典
+            "snp_json_list": [
+                snp_json_encoder.encode(snp_dict) for snp_dict in self.__snp_dict_list
+            ],
+        }
+        cache_file_name = self.__tree_cache_file_name()
+        tmp_file_name = "{}.{}.tmp".format(cache_file_name, os.getpid())
+        try:
+            with open(tmp_file_name, "wb") as cache_file:
+                pickle.dump(tree_cache, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file_name, cache_file_name)
+        except OSError:
+            logging.warning("单倍群树预编译缓存无法保存：{}".format(cache_file_name))
+            if os.access(tmp_file_name, os.F_OK):
+                os.remove(tmp_file_name)
+
+    # 把编译结果发布为共享映像文件，其它进程指定同一文件名时直接映射，不再加载和编译。已映射映像的对象也可以发布到其它文件
+    def publish_shared_tree(self, sharedTreeFileName: str):
+        if self.__snp_dict_list != None:
+            snp_json_encoder = json.JSONEncoder(
+                ensure_ascii=False, separators=(",", ":")
+            )
+            snp_json_iter = (
+                snp_json_encoder.encode(snp_dict) for snp_dict in self.__snp_dict_list
+            )
+        else:
+            snp_json_iter = iter(self.__snp_json_list)
+
+        section_dict = {
+            "node_parent": array("i", self.__node_parent),
+            "node_end": array("i", self.__node_end),
+            "node_depth": array("i", self.__node_depth),
+            "node_has_snp": array("b", self.__node_has_snp),
+            "node_snp_depth": array("i", self.__node_snp_depth),
+            "node_snp_offset": array("i", self.__node_snp_offset),
+            "snp_node": array("i", self.__snp_node),
+            "snp_derived": (
+                array("i", self.__snp_derived_code)
+                if self.__snp_derived_code != None
+                else encode_allele_code(self.__snp_derived_list)
+            ),
+        }
+        (
+            section_dict["node_name_offset"],
+            section_dict["node_name_data"],
+        ) = encode_string_list(self.__node_name_list)
+        (
+            section_dict["snp_json_offset"],
+            section_dict["snp_json_data"],
+        ) = encode_string_list(snp_json_iter)
+
+        pos_extra_dict = {}
+        for genome_ref in ("hg19", "hg38") if self.__is_y else ("mt",):
+            (
+                section_dict[genome_ref + "_pos"],
+                section_dict[genome_ref + "_start"],
+                section_dict[genome_ref + "_snp"],
+                section_dict[genome_ref + "_hash_pos"],
+                section_dict[genome_ref + "_hash_entry"],
+                pos_extra_dict[genome_ref],
+            ) = encode_pos_index(self.__get_pos_index(genome_ref))
+
+        write_shared_tree(
+            sharedTreeFileName,
+            {
+                "key": self.__tree_cache_key(),
+                "timestamp": self.__timestamp,
+                "pos_extra": pos_extra_dict,
+            },
+            section_dict,
+        )
+
+    # 映射共享映像，映像与单倍群分型树文件和键名一致时使用映像中的编译结果并返回True
+    def __attach_shared_tree(self, shared_tree_file_name: str) -> bool:
+        try:
+            shared_tree = SharedTree(shared_tree_file_name)
+            header = shared_tree.Header
+            if header["key"] != list(self.__tree_cache_key()):
+                return False
+
+            timestamp = self.__read_tree_timestamp()
+            if timestamp != None and timestamp != header["timestamp"]:
+                return False
+
+            self.__timestamp = header["timestamp"]
+            self.__node_name_list = shared_tree.string_list("node_name")
+            self.__node_parent = shared_tree.array("node_parent")
+            self.__node_end = shared_tree.array("node_end")
+            self.__node_depth = shared_tree.array("node_depth")
+            self.__node_has_snp = shared_tree.array("node_has_snp")
+            self.__node_snp_depth = shared_tree.array("node_snp_depth")
+            self.__node_snp_offset = shared_tree.array("node_snp_offset")
+            self.__snp_node = shared_tree.array("snp_node")
+            self.__snp_derived_list = None
+            self.__snp_derived_code = shared_tree.array("snp_derived")
+            self.__snp_json_list = shared_tree.string_list("snp_json")
+            self.__snp_dict_list = None
+            self.__pos_index_dict = {
+                genome_ref: shared_tree.pos_index(genome_ref)
+                for genome_ref in header["pos_extra"]
+            }
+            self.__pos_index_cache_dict = None
+            self.__batch_index_dict = None
+            # 单倍群分型树JSON只在访问HaploTree时再加载
+            self.__haplo_tree = None
+            self.__total_haplo_count = len(self.__node_name_list)
+            self.__total_snp_count = len(self.__snp_derived_code)
+            self.__shared_tree = shared_tree
+            return True
+        except Exception as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(
+                    "单倍群树共享映像不可用：{}".format(shared_tree_file_name)
+                )
+            return False
+
+    # 获取SNP字典，从预编译缓存加载时由JSON文本解析，返回的字典只读
+    def __get_snp_dict(self, snp_idx: int) -> dict:
+        if self.__snp_dict_list != None:
+            return self.__snp_dict_list[snp_idx]
+        return json.loads(self.__snp_json_list[snp_idx])
+
+    # 把单倍群分型树编译为按先序遍历排列的数组，遍历和评分只在数组上进行，不再递归字典树
+    def __compile_tree(self):
+        node_name_list = []
+        node_parent = array("i")
+        node_depth = array("i")
+        node_has_snp = array("b")
+        node_snp_offset = array("i")
+        snp_node = array("i")
+        snp_derived_list = []
+        snp_dict_list = []
+
+        # 用显式栈做先序遍历，子节点逆序压栈以保持原有的兄弟节点顺序
+        node_stack = [(self.__haplo_tree, -1, 0)]
+        while len(node_stack) > 0:
+            tree_node, parent_idx, depth = node_stack.pop()
+            node_idx = len(node_name_list)
+            node_name_list.append(tree_node[self.__haplo_key])
+            node_parent.append(parent_idx)
+            node_depth.append(depth)
+            node_snp_offset.append(len(snp_dict_list))
+
+            # 没有snp列表键的节点不参与分型评分，空snp列表的节点视为没有derived SNP的节点
+            if self.__snp_list_key in tree_node:
+                node_has_snp.append(1)
+                for snp_dict in tree_node[self.__snp_list_key]:
+                    snp_node.append(node_idx)
+                    snp_derived_list.append(
+                        self.__normalize_allele(snp_dict[self.__derived_key])
+                    )
+                    snp_dict_list.append(snp_dict)
+            else:
+                node_has_snp.append(0)
+
+            if self.__children_key in tree_node:
+                for child_node in reversed(tree_node[self.__children_key]):
+                    node_stack.append((child_node, node_idx, depth + 1))
+
+        node_count = len(node_name_list)
+        node_snp_offset.append(len(snp_dict_list))
+
+        # 先序数组中父节点总在子节点之前，顺序遍历即可累计路径上有snp列表键的单倍群数
+        node_snp_depth = array("i", node_has_snp)
+        for node_idx in range(1, node_count):
+            node_snp_depth[node_idx] += node_snp_depth[node_parent[node_idx]]
+
+        # 先序数组中每个节点的子树范围是[idx, end)，逆序遍历即可由子节点推出父节点的子树结束位置
+        node_end = array("i", range(1, node_count + 1))
+        for node_idx in range(node_count - 1, 0, -1):
+            parent_idx = node_parent[node_idx]
+            if node_end[node_idx] > node_end[parent_idx]:
+                node_end[parent_idx] = node_end[node_idx]
+
+        # 建立位置到SNP下标的倒排索引，Y树按hg19和hg38建立，mt树按pos建立
+        if self.__is_y:
+            self.__pos_index_dict = {
+                "hg19": self.__build_pos_index(snp_dict_list, self.__pos19_key),
+                "hg38": self.__build_pos_index(snp_dict_list, self.__pos38_key),
+            }
+        else:
+            self.__pos_index_dict = {
+                "mt": self.__build_pos_index(snp_dict_list, self.__pos_key)
+            }
+
+        self.__node_name_list = node_name_list
+        self.__node_parent = node_parent
+        self.__node_end = node_end
+        self.__node_depth = node_depth
+        self.__node_has_snp = node_has_snp
+        self.__node_snp_depth = node_snp_depth
+        self.__node_snp_offset = node_snp_offset
+        self.__snp_node = snp_node
+        self.__snp_derived_list = snp_derived_list
+        self.__snp_dict_list = snp_dict_list
+        self.__total_haplo_count = node_count
+        self.__total_snp_count = len(snp_dict_list)
+
+    # 建立SNP位置到SNP下标列表的倒排索引，位置转为字符串，与用户基因数据的位置键一致
+    @staticmethod
+    def __build_pos_index(snp_dict_list: list, pos_key: str) -> dict:
+        pos_index = {}
+        for snp_idx, snp_dict in enumerate(snp_dict_list):
+            pos = snp_dict.get(pos_key)
+            if pos != None:
+                pos = str(pos)
+                if pos in pos_index:
+                    pos_index[pos].append(snp_idx)
+                else:
+                    pos_index[pos] = [snp_idx]
+        return pos_index
+
+    # 突变值统一为大写，derived突变在编译时、用户突变在分析开始时转换，比较时不再区分大小写
+    @staticmethod
+    def __normalize_allele(allele):
+        return allele.upper() if isinstance(allele, str) else allele
+
+    # 用户基因数据的位置键类型，int键使用int键的位置索引，其它都按str键查找
+    @staticmethod
+    def __genome_key_type(user_genome: dict) -> type:
+        for pos in user_genome:
+            return int if type(pos) == int else str
+        return str
+
+    # 把str位置键的索引转换为int位置键，不是十进制数字的位置不会与int键相同
+    @staticmethod
+    def __convert_pos_keys(pos_dict: dict, key_type: type) -> dict:
+        return {
+            key_type(pos): value for pos, value in pos_dict.items() if pos.isdecimal()
+        }
+
+    # 获取参考基因组对应的位置倒排索引，位置键的类型与用户基因数据一致。从预编译缓存加载时首次使用才反序列化，int键的索引首次使用时由str键的索引转换
+    def __get_pos_index(self, genome_ref: str, key_type: type = str) -> dict:
+        if key_type != str:
+            index_key = (genome_ref, key_type)
+            if index_key not in self.__pos_index_dict:
+                pos_index = self.__get_pos_index(genome_ref)
+                self.__pos_index_dict[index_key] = (
+                    pos_index.with_key_type(key_type)
+                    if isinstance(pos_index, SharedPosIndex)
+                    else self.__convert_pos_keys(pos_index, key_type)
+                )
+            return self.__pos_index_dict[index_key]
+
+        if genome_ref not in self.__pos_index_dict:
+            self.__pos_index_dict[genome_ref] = pickle.loads(
+                self.__pos_index_cache_dict[genome_ref]
+            )
+        return self.__pos_index_dict[genome_ref]
+
+    # 用户基因数据的参考基因组对应的位置索引名，Y树为hg19或hg38，mt树为mt
+    def __pos_index_ref(self, genome_ref: str) -> str:
+        if not self.__is_y:
+            return "mt"
+        return "hg19" if genome_ref[:4].lower() == "hg19" else "hg38"
+
+    # 单倍群分析，每次分析的用户数据和结果都保存在独立的上下文中，同一个对象可以被多个线程并发调用
+    # instrument为性能统计对象时，阶段耗时和计数记录在其中；未传入且对象启用了性能统计时，分析结束后在stderr输出一行统计
+    # subtreePool为此树的子树进程池（subtree_pool.SubtreePool）时，交集位置数不少于进程池的MinHits的分析在工作进程中同时计算各组子树，结果与不拆分时相同。
+    # 指定了timeBudget（秒）或workBudget（已检测节点数）时按analyse_progressive逐步分析，预算用完时返回当前最好的结果，返回的HaploSnapshot标记是否完整
+    def analyse(
+        self,
+        user_genome: dict,
+        genome_ref: str = "hg19",
+        instrument: Instrument = None,
+        subtreePool=None,
+        timeBudget: float = None,
+        workBudget: int = None,
+    ) -> list:
+        emit_instrument = instrument == None and self.__instrument
+        if emit_instrument:
+            instrument = Instrument()
+
+        if subtreePool != None and subtreePool.HaploObj is not self:
+            raise Exception("子树进程池不属于此单倍群分型树")
+
+        if timeBudget != None or workBudget != None:
+            if subtreePool != None:
+                raise Exception("逐步分析不能使用子树进程池")
+            haplo_snapshot = None
+            for haplo_snapshot in self.analyse_progressive(
+                user_genome, genome_ref, timeBudget, workBudget, instrument
+            ):
+                pass
+            if emit_instrument:
+                instrument.emit(tree=self.__haplo_tree_file_name)
+            return haplo_snapshot
+
+        ctx, pos_index_ref = self.__new_context(user_genome, genome_ref)
+
+        stage_prefix = self.__is_y_mt.lower() + "."
+
+        with timed(instrument, stage_prefix + "check_snp"):
+            self.__find_pos_hits(ctx)
+
+        # 分型结果只取决于用户位置与树上SNP位置的交集，交集相同的分析直接使用缓存的结果，不再遍历单倍群分型树。
+        # 缓存的是与单倍群分型对象无关的紧凑结果，命中时再生成结果对象，单倍群分型树被重新加载后缓存仍然可用
+        if self.__result_cache != None:
+            compact_result, cache_hit = self.__result_cache.get_or_compute(
+                self.__result_key(ctx, pos_index_ref),
+                lambda: self.__compact_haplogroups(
+                    ctx,
+                    self.__analyse_hits(ctx, instrument, stage_prefix, subtreePool),
+                ),
+            )
+            if cache_hit:
+                ctx.haplogroup_list = self.__expand_haplogroups(compact_result)
+            if instrument != None:
+                instrument.count(
+                    stage_prefix + ("cache_hit" if cache_hit else "cache_miss")
+                )
+        else:
+            self.__analyse_hits(ctx, instrument, stage_prefix, subtreePool)
+
+        if instrument != None:
+            self.__count_context(ctx, instrument, stage_prefix)
+            if emit_instrument:
+                instrument.emit(tree=self.__haplo_tree_file_name)
+
+        self.__haplogroup_list = ctx.haplogroup_list
+        return ctx.haplogroup_list
+
+    # 校验用户基因数据和参考基因组，返回分析上下文和所用的位置索引名
+    def __new_context(self, user_genome: dict, genome_ref: str) -> tuple:
         if user_genome == None or len(user_genome) == 0:
             raise Exception("用户基因数据为空")
 
         if not re.match("hg19|hg38", genome_ref, re.IGNORECASE):
             raise Exception("请指定用户基因数据的参考基因组是：hg19或hg38")
 
-        # 遍历单倍群分型树
-        self.__haplogroup_list = []
-        self.__check_snp(self.__haplo_tree, user_genome, genome_ref, [])
+        # 整个分析只需判断一次使用哪个位置索引
+        pos_index_ref = self.__pos_index_ref(genome_ref)
+        snp_pos_index = self.__get_pos_index(
+            pos_index_ref, self.__genome_key_type(user_genome)
+        )
+        return HaploContext(user_genome, snp_pos_index), pos_index_ref
 
-        return self.__haplogroup_list
+    # 记录一次分析的计数
+    def __count_context(
+        self, ctx: HaploContext, instrument: Instrument, stage_prefix: str
+    ):
+        instrument.count(stage_prefix + "user_pos", len(ctx.user_genome))
+        instrument.count(stage_prefix + "pos_hit", ctx.pos_hit_count)
+        instrument.count(stage_prefix + "snp_compared", len(ctx.user_snp_dict))
+        instrument.count(
+            stage_prefix + "snp_derived", sum(ctx.node_der_count.values())
+        )
+        instrument.count(stage_prefix + "node_visited", len(ctx.node_var_count))
+        instrument.count(stage_prefix + "node_pruned", ctx.pruned_node_count)
+        instrument.count(stage_prefix + "node_positive", len(ctx.node_der_count))
+        instrument.count(stage_prefix + "candidate", len(ctx.end_node_list))
+        instrument.count(stage_prefix + "result", len(ctx.haplogroup_list))
 
-    # 递归单倍群树，检测用户每个SNP的突变情况。所有参数必须显式赋值，不能使用参数默认值，否则在多线程中，参数的默认值会在进程中共享，导致数据混乱
-    def __check_snp(
+    # 逐步单倍群分析，生成器，每当前maxHaploCount个结果变好时产生一个HaploSnapshot，最后总是产生一个标记是否完整的HaploSnapshot。
+    # 用户交集和根部（拆分层级以上）的单倍群总是完整计算；之后按子树中用户derived SNP数从多到少依次搜索子树，先搜索的子树的结果用于后搜索的子树剪枝。
+    # timeBudget（秒，从调用开始计算）或workBudget（已检测节点数）用完时不再搜索其余子树；预算足够时搜索全部子树，最后的结果与analyse相同，完整的结果才加入结果缓存
+    def analyse_progressive(
         self,
-        tree_node: dict,
         user_genome: dict,
-        genome_ref: str,
-        root_end_node_list: list,
+        genome_ref: str = "hg19",
+        timeBudget: float = None,
+        workBudget: int = None,
+        instrument: Instrument = None,
     ):
-        # 累计单倍群数量
-        self.__total_haplo_count += 1
-
-        # 记录从终端节点到根节点的路径，因此此递归函数会在每层遍历所有子节点，所以要判断每个父节点只记录一次
-        if tree_node[self.__haplo_key] not in {
-            haplo_node[self.__haplo_key] for haplo_node in root_end_node_list
-        }:
-            root_end_node_list.insert(0, tree_node)
-
-        if self.__snp_list_key in tree_node and len(tree_node[self.__snp_list_key]) > 0:
-            # 累计SNP数量
-            self.__total_snp_count += len(tree_node[self.__snp_list_key])
-
-            # 检测每个SNP的突变情况
-            for snp_dict in tree_node[self.__snp_list_key]:
-                pos = ""
-                if re.match("y", self.__is_y_mt, re.IGNORECASE):
-                    if re.match("hg19", genome_ref, re.IGNORECASE):
-                        pos = str(snp_dict[self.__pos19_key])
-                    elif re.match("hg38", genome_ref, re.IGNORECASE):
-                        pos = str(snp_dict[self.__pos38_key])
-                elif re.match("mt", self.__is_y_mt, re.IGNORECASE):
-                    pos = str(snp_dict[self.__pos_key])
-
-                # 如果用户检测了此SNP，把用户突变值放在树上
-                if pos in user_genome:
-                    snp_dict[self.__user_geno_key] = user_genome[pos][0]
-                    if snp_dict[self.__user_geno_key] == snp_dict[self.__derived_key]:
-                        logging.info(
-                            "\t{} 单倍群 {}，SNP位点 {} 产生突变：{} -> {}".format(
-                                self.__is_y_mt.upper(),
-                                tree_node[self.__haplo_key],
-                                snp_dict[self.__snp_key],
-                                snp_dict[self.__ancestral_key],
-                                snp_dict[self.__derived_key],
-                            )
-                        )
-                elif self.__user_geno_key in snp_dict:
-                    # 如果用户未检测此SNP，但还有其他用户SNP值，则删除，避免数据混淆影响
-                    del snp_dict[self.__user_geno_key]
-
-        # 递归子节点
-        if self.__children_key in tree_node and len(tree_node[self.__children_key]) > 0:
-            for child_node in tree_node[self.__children_key]:
-                self.__check_snp(
-                    child_node,
-                    user_genome,
-                    genome_ref,
-                    root_end_node_list,
+        start_time = time.perf_counter()
+        ctx, pos_index_ref = self.__new_context(user_genome, genome_ref)
+        stage_prefix = self.__is_y_mt.lower() + "."
+
+        with timed(instrument, stage_prefix + "check_snp"):
+            self.__find_pos_hits(ctx)
+
+        result_key = None
+        if self.__result_cache != None:
+            result_key = self.__result_key(ctx, pos_index_ref)
+            compact_result = self.__result_cache.get(result_key)
+            if instrument != None:
+                instrument.count(
+                    stage_prefix
+                    + ("cache_hit" if compact_result != None else "cache_miss")
                 )
+            if compact_result != None:
+                ctx.haplogroup_list = self.__expand_haplogroups(compact_result)
+                if instrument != None:
+                    self.__count_context(ctx, instrument, stage_prefix)
+                self.__haplogroup_list = HaploSnapshot(ctx.haplogroup_list, False, 0, 0)
+                yield self.__haplogroup_list
+                return
+
+        with timed(instrument, stage_prefix + "check_snp"):
+            self.__check_snp(ctx)
+
+        node_var_count = ctx.node_var_count
+        node_der_count = ctx.node_der_count
+        node_depth = self.__node_depth
+        max_haplo_count = self.__max_haplo_count
+        split_depth, clade_list = self.__get_progressive_split()
+        rank_state = ([], set())
+
+        # 根部的单倍群用完整的统计计算
+        with timed(instrument, stage_prefix + "check_haplo_path"):
+            haplo_result_dict = self.__check_haplo_path(
+                ctx, split_depth, None, rank_state
+            )
+        end_result_list = [
+            (end_node_idx, haplo_result_dict[node_idx])
+            for end_node_idx, node_idx in ctx.end_node_list
+        ]
+
+        # 只搜索有derived SNP的子树，按子树中的derived SNP数从多到少排列，相同时按先序
+        positive_node_list = sorted(node_der_count)
+        der_prefix_list = [0]
+        for node_idx in positive_node_list:
+            der_prefix_list.append(der_prefix_list[-1] + node_der_count[node_idx])
+        clade_order_list = []
+        for clade_start, clade_end in clade_list:
+            clade_der = (
+                der_prefix_list[bisect_left(positive_node_list, clade_end)]
+                - der_prefix_list[bisect_left(positive_node_list, clade_start)]
+            )
+            if clade_der > 0:
+                clade_order_list.append((-clade_der, clade_start, clade_end))
+        clade_order_list.sort()
 
-        else:  # 此节点没有子节点，是终端节点，开始计算单倍群分型
-
-            # 当前单倍群路径上的每个单倍群和突变情况
-            haplo_path_list = []
-            # 此单倍群路径的单倍群分型结果
-            haplogroup = None
-            # 单倍群分型深度
-            haplo_depth = 0
-            # 单倍群路径中的累计用户derived SNP突变数
-            total_user_der_count = 0
-            # 单倍群路径中的累计用户SNP位点数
-            total_user_var_count = 0
-            # 测试覆盖的单倍群节点数
-            tested_haplo = 0
-            # 单倍群分型后出现的存在连续derived SNP单倍群数
-            positive_haplo_count = 0
-            # 单倍群分型后出现的存在连续无derived SNP单倍群数
-            negative_haplo_count = 0
-
-            # 遍历从终端节点到根节点的每个单倍群
-            for haplo_node in root_end_node_list:
-                if self.__snp_list_key in haplo_node:
-                    # 当前单倍群节点中的用户已检测SNP数
-                    user_var_count = 0
-                    # 当前单倍群节点中的用户突变SNP数
-                    user_der_count = 0
-
-                    # 遍历当前单倍群节点的SNP突变情况，作为分型评分依据
-                    for snp_dict in haplo_node[self.__snp_list_key]:
-                        if self.__user_geno_key in snp_dict:
-                            # 用户已检测SNP数
-                            user_var_count += 1
-                            if (
-                                snp_dict[self.__user_geno_key]
-                                == snp_dict[self.__derived_key]
-                            ):
-                                # 用户突变SNP数
-                                user_der_count += 1
-
-                    # 如果用户在当前单倍群节点有derived突变
-                    if user_der_count > 0:
-                        # 如果还未分型，则以此单倍群暂定分型（后续可能会因为上游节点存在无突变的单倍群节点，按照分型规则判断此处是假阳，则取消此分型结果）
-                        if haplogroup == None:
-                            haplogroup = haplo_node[self.__haplo_key]
-
-                        # 连续阳性单倍群数量+1
-                        positive_haplo_count += 1
-
-                        # 连续阴性单倍群数量重置0
-                        negative_haplo_count = 0
-
-                        # 累计用户SNP位点汇总数
-                        total_user_var_count += user_var_count
-
-                        # 累计用户所有单倍群的derived SNP突变数
-                        total_user_der_count += user_der_count
-
-                    else:  # 如果用户在当前单倍群节点没有derived突变
-                        # 判断下游连续阳性突变单倍群数量是否小于阈值
-                        if positive_haplo_count < self.__confirmed_positive_haplo:
-                            # 连续阳性单倍群数量重置0
-                            positive_haplo_count = 0
-
-                            # 连续阴性单倍群数量+1
-                            negative_haplo_count += 1
-
-                            # 如果当前单倍群节点的下游连续阴性单倍群数量大于阈值，且已经分型，则判断分型结果是跳变假阳，取消此前的分型结果
-                            if (
-                                self.__allowed_negative_haplo != -1
-                                and negative_haplo_count > self.__allowed_negative_haplo
-                                and haplogroup != None
-                            ):
-                                haplogroup = None
-                                haplo_depth = 0
-                                tested_haplo = 0
-                                total_user_var_count = 0
-                                total_user_der_count = 0
-
-                    # 如果此时已分型
-                    if haplogroup != None:
-                        # 累计分型深度
-                        haplo_depth += 1
-
-                        # 如果当前单倍群节点中有用户已检测的SNP，则累计已检测的单倍群数
-                        if user_var_count > 0:
-                            tested_haplo += 1
-
-                    # 保存此节点的单倍群名和SNP列表
-                    haplo_path_list.append(
-                        {
-                            "haplo": haplo_node[self.__haplo_key],
-                            "mutation": haplo_node[self.__snp_list_key],
-                        }
+        # 当前最好的结果，[(derived SNP数, 分型深度, 评分, -终端节点下标, 终端节点下标, 分型结果)]，从好到差排列。
+        # 单倍群名唯一时同名结果的分型结果相同，只保留先序最前的终端节点，可以逐个加入；否则每次都从全部候选结果重新选择
+        top_entry_list = []
+
+        def add_candidate(end_node_idx: int, haplo_result: tuple) -> bool:
+            for entry_idx, entry in enumerate(top_entry_list):
+                if entry[5][0] == haplo_result[0]:
+                    if end_node_idx >= entry[4]:
+                        return False
+                    top_entry_list[entry_idx] = entry[:3] + (
+                        -end_node_idx,
+                        end_node_idx,
+                        haplo_result,
                     )
+                    top_entry_list.sort(reverse=True)
+                    return True
+            entry = (
+                haplo_result[1],
+                haplo_result[2],
+                self.__haplo_score(haplo_result),
+                -end_node_idx,
+                end_node_idx,
+                haplo_result,
+            )
+            if len(top_entry_list) < max_haplo_count:
+                top_entry_list.append(entry)
+            elif max_haplo_count > 0 and entry > top_entry_list[-1]:
+                top_entry_list[-1] = entry
+            else:
+                return False
+            top_entry_list.sort(reverse=True)
+            return True
 
-            # 如果此单倍群分型路径有用户derived突变，且此单倍群分型结果在结果集中不存在，则新增
-            if (
-                total_user_der_count > 0
-                and len(
-                    [
-                        haploObj
-                        for haploObj in self.__haplogroup_list
-                        if haploObj["haplo"] == haplogroup
-                    ]
+        def select_snapshot(partial: bool, explored_clades: int) -> HaploSnapshot:
+            if self.__unique_node_name:
+                haplo_result_list = [(entry[4], entry[5]) for entry in top_entry_list]
+            else:
+                haplo_result_list = self.__select_haplogroups(
+                    sorted(end_result_list, key=itemgetter(0))
                 )
-                == 0
-            ):
-                # 根据此单倍群分型路径突变情况，计算分型结果可靠性评分
-                haplo_score = 0
-                if total_user_var_count != 0 and haplo_depth != 0:
-                    # 用户derived SNP突变数/用户所有检测SNP数 * 有突变的单倍群节点数/单倍群分型深度
-                    haplo_score = (total_user_der_count / total_user_var_count) * (
-                        tested_haplo / haplo_depth
+            ctx.haplogroup_list = [
+                self.__make_haplogroup(ctx, end_node_idx, haplo_result)
+                for end_node_idx, haplo_result in haplo_result_list
+            ]
+            return HaploSnapshot(
+                ctx.haplogroup_list, partial, explored_clades, len(clade_order_list)
+            )
+
+        changed = False
+        for end_node_idx, haplo_result in end_result_list:
+            changed = add_candidate(end_node_idx, haplo_result) or changed
+        if changed and len(clade_order_list) > 0:
+            yield select_snapshot(True, 0)
+
+        # 各子树只需要根部和子树内的统计
+        spine_var_dict = {
+            node_idx: count
+            for node_idx, count in node_var_count.items()
+            if node_depth[node_idx] < split_depth
+        }
+        spine_der_dict = {
+            node_idx: count
+            for node_idx, count in node_der_count.items()
+            if node_idx in spine_var_dict
+        }
+        var_node_list = sorted(node_var_count)
+        explored_clades = 0
+        work_count = 0
+        with timed(instrument, stage_prefix + "check_clades"):
+            for _, clade_start, clade_end in clade_order_list:
+                if (
+                    timeBudget != None
+                    and time.perf_counter() - start_time >= timeBudget
+                ) or (workBudget != None and work_count >= workBudget):
+                    break
+
+                clade_ctx = HaploContext(None, None)
+                clade_ctx.node_var_count = dict(spine_var_dict)
+                clade_ctx.node_der_count = dict(spine_der_dict)
+                clade_node_list = var_node_list[
+                    bisect_left(var_node_list, clade_start) : bisect_left(
+                        var_node_list, clade_end
+                    )
+                ]
+                for node_idx in clade_node_list:
+                    clade_ctx.node_var_count[node_idx] = node_var_count[node_idx]
+                    if node_idx in node_der_count:
+                        clade_ctx.node_der_count[node_idx] = node_der_count[node_idx]
+                haplo_result_dict = self.__check_haplo_path(
+                    clade_ctx, split_depth, (clade_start, clade_end), rank_state
+                )
+                ctx.pruned_node_count += clade_ctx.pruned_node_count
+                ctx.end_node_list.extend(clade_ctx.end_node_list)
+                explored_clades += 1
+                work_count += len(clade_node_list)
+
+                changed = False
+                for end_node_idx, node_idx in clade_ctx.end_node_list:
+                    end_result_list.append(
+                        (end_node_idx, haplo_result_dict[node_idx])
+                    )
+                    changed = (
+                        add_candidate(end_node_idx, haplo_result_dict[node_idx])
+                        or changed
                     )
+                if changed and explored_clades < len(clade_order_list):
+                    yield select_snapshot(True, explored_clades)
 
-                # 加入单倍群分型结果列表
-                self.__haplogroup_list.append(
-                    {
-                        "haplo": haplogroup,
-                        "snp_derived_count": total_user_der_count,
-                        "haplo_depth": haplo_depth,
-                        "haplo_score": haplo_score,
-                        "haplo_path": haplo_path_list,
-                    }
+        ctx.end_node_list.sort()
+        partial = explored_clades < len(clade_order_list)
+        if partial:
+            haplo_snapshot = select_snapshot(True, explored_clades)
+        else:
+            # 完整搜索后按analyse的规则从全部候选结果选择
+            haplo_result_list = self.__select_haplogroups(
+                sorted(end_result_list, key=itemgetter(0))
+            )
+            ctx.haplogroup_list = [
+                self.__make_haplogroup(ctx, end_node_idx, haplo_result)
+                for end_node_idx, haplo_result in haplo_result_list
+            ]
+            haplo_snapshot = HaploSnapshot(
+                ctx.haplogroup_list, False, explored_clades, len(clade_order_list)
+            )
+            if result_key != None:
+                self.__result_cache.put(
+                    result_key, self.__compact_haplogroups(ctx, haplo_result_list)
                 )
 
-                # 按照规则排序单倍群分型结果
-                self.__haplogroup_list.sort(
-                    key=lambda haplo: (
-                        haplo["snp_derived_count"],
-                        haplo["haplo_depth"],
-                        haplo["haplo_score"],
-                    ),
-                    reverse=True,
+        if instrument != None:
+            instrument.count(stage_prefix + "clade_total", len(clade_order_list))
+            instrument.count(stage_prefix + "clade_explored", explored_clades)
+            if partial:
+                instrument.count(stage_prefix + "partial")
+            self.__count_context(ctx, instrument, stage_prefix)
+        self.__haplogroup_list = haplo_snapshot
+        yield haplo_snapshot
+
+    # 逐步分析的子树拆分，节点数不少于__progressive_clade_count的最浅层级的每个节点为一个子树
+    def __get_progressive_split(self) -> tuple:
+        if self.__progressive_split == None:
+            split_depth = self.__auto_split_depth(self.__progressive_clade_count)
+            node_depth = self.__node_depth
+            node_end = self.__node_end
+            self.__progressive_split = (
+                split_depth,
+                [
+                    (node_idx, node_end[node_idx])
+                    for node_idx in range(len(self.__node_name_list))
+                    if node_depth[node_idx] == split_depth
+                ],
+            )
+        return self.__progressive_split
+
+    # 由用户位置与树上SNP位置的交集分型，结果保存在上下文中，返回选出的(终端节点下标, 分型结果)列表
+    def __analyse_hits(
+        self,
+        ctx: HaploContext,
+        instrument: Instrument,
+        stage_prefix: str,
+        subtree_pool=None,
+    ) -> list:
+        # 交集较小时直接在本进程分析，不必在进程间传递
+        if subtree_pool != None and ctx.pos_hit_count >= subtree_pool.MinHits:
+            with timed(instrument, stage_prefix + "check_subtrees"):
+                end_result_list = self.__check_subtrees(ctx, subtree_pool)
+        else:
+            # 检测用户每个SNP的突变情况，统计用户检测到的单倍群节点中已检测和突变的SNP数
+            with timed(instrument, stage_prefix + "check_snp"):
+                self.__check_snp(ctx)
+
+            # 终端节点的分型结果只取决于路径上最深的有derived突变的单倍群节点，先沿先序计算每个阳性节点的分型结果，再按其第一个终端节点的先序顺序加入结果列表
+            with timed(instrument, stage_prefix + "check_haplo_path"):
+                haplo_result_dict = self.__check_haplo_path(ctx)
+                end_result_list = [
+                    (end_node_idx, haplo_result_dict[node_idx])
+                    for end_node_idx, node_idx in ctx.end_node_list
+                ]
+        with timed(instrument, stage_prefix + "select_haplogroups"):
+            haplo_result_list = self.__select_haplogroups(end_result_list)
+            ctx.haplogroup_list = [
+                self.__make_haplogroup(ctx, end_node_idx, haplo_result)
+                for end_node_idx, haplo_result in haplo_result_list
+            ]
+        return haplo_result_list
+
+    # 缓存用的紧凑分型结果：[[终端节点下标, 分型结果...]], [[SNP下标, 用户突变]]，只保留分型路径上的用户突变，可以直接保存为JSON
+    def __compact_haplogroups(self, ctx: HaploContext, haplo_result_list: list) -> list:
+        user_snp_dict = ctx.user_snp_dict
+        path_snp_list = []
+        path_node_set = set()
+        for end_node_idx, _ in haplo_result_list:
+            node_idx = end_node_idx
+            while node_idx != -1 and node_idx not in path_node_set:
+                path_node_set.add(node_idx)
+                for snp_idx in range(
+                    self.__node_snp_offset[node_idx],
+                    self.__node_snp_offset[node_idx + 1],
+                ):
+                    if snp_idx in user_snp_dict:
+                        path_snp_list.append([snp_idx, user_snp_dict[snp_idx]])
+                node_idx = self.__node_parent[node_idx]
+        return [
+            [
+                [end_node_idx, *haplo_result]
+                for end_node_idx, haplo_result in haplo_result_list
+            ],
+            path_snp_list,
+        ]
+
+    # 由紧凑分型结果生成结果对象，同一次分析的结果共享用户突变字典
+    def __expand_haplogroups(self, compact_result: list) -> list:
+        haplo_row_list, path_snp_list = compact_result
+        user_snp_dict = {snp_idx: allele for snp_idx, allele in path_snp_list}
+        haplogroup_list = []
+        for haplo_row in haplo_row_list:
+            haplo_result = tuple(haplo_row[1:])
+            haplogroup_list.append(
+                HaploResult(
+                    self,
+                    haplo_row[0],
+                    haplo_result,
+                    self.__haplo_score(haplo_result),
+                    user_snp_dict,
+                )
+            )
+        return haplogroup_list
+
+    # 分型结果缓存键：数据源、单倍群分型树版本、分型规则参数、位置索引和用户位置与树上SNP位置交集的摘要。
+    # 交集按SNP下标排序，同一位置的SNP下标列表的首个下标即可代表该位置
+    def __result_key(self, ctx: HaploContext, pos_index_ref: str) -> str:
+        key_hash = hashlib.sha256(self.__result_key_prefix.encode("utf-8"))
+        key_hash.update(pos_index_ref.encode("utf-8"))
+        for snp_idx, allele in sorted(
+            (snp_idx_list[0], allele) for snp_idx_list, allele in ctx.pos_hit_list
+        ):
+            key_hash.update("\n{}:{}".format(snp_idx, allele).encode("utf-8"))
+        return key_hash.hexdigest()
+
+    # 批量单倍群分析，返回与user_genome_list顺序一致的分型结果列表，每个样本的结果与analyse相同，没有基因数据的样本结果为空列表。
+    # 样本×单倍群节点的突变统计用数组运算完成，分型路径规则按已检测节点在树上的层级逐层对所有样本同时计算，适合单倍群树更新后重新分型全部样本
+    def analyse_batch(self, user_genome_list: list, genome_ref: str = "hg19") -> list:
+        # numpy只在批量分析时使用，单次分析不必加载
+        import numpy as np
+
+        if user_genome_list == None:
+            raise Exception("用户基因数据为空")
+
+        if not re.match("hg19|hg38", genome_ref, re.IGNORECASE):
+            raise Exception("请指定用户基因数据的参考基因组是：hg19或hg38")
+
+        pos_index_ref = self.__pos_index_ref(genome_ref)
+        batch_index = self.__get_batch_index(np, pos_index_ref)
+
+        # 每组样本的中间矩阵约为 样本数×(位置数+SNP数+7×(候选节点数+1))个int32
+        chunk_size = max(
+            1,
+            self.__batch_memory
+            // (
+                (
+                    len(batch_index["pos_col_dict"])
+                    + len(batch_index["snp_idx"])
+                    + 7 * (len(batch_index["cand_node"]) + 1)
                 )
+                * 4
+            ),
+        )
+        haplogroup_list_list = []
+        for chunk_start in range(0, len(user_genome_list), chunk_size):
+            haplogroup_list_list.extend(
+                self.__analyse_batch_chunk(
+                    np,
+                    batch_index,
+                    self.__get_pos_index(pos_index_ref),
+                    user_genome_list[chunk_start : chunk_start + chunk_size],
+                )
+            )
+        if len(haplogroup_list_list) > 0:
+            self.__haplogroup_list = haplogroup_list_list[-1]
+        return haplogroup_list_list
+
+    # 建立批量分析的数组索引：位置到矩阵列、树上有位置的SNP、这些SNP所在的已检测候选节点，以及候选节点之间的父子关系和层级
+    def __get_batch_index(self, np, pos_index_ref: str) -> dict:
+        if self.__batch_index_dict == None:
+            self.__batch_index_dict = {}
+        if pos_index_ref in self.__batch_index_dict:
+            return self.__batch_index_dict[pos_index_ref]
+
+        snp_pos_index = self.__get_pos_index(pos_index_ref)
+        pos_col_dict = {}
+        snp_col_list = []
+        for pos, snp_idx_list in snp_pos_index.items():
+            pos_col_dict[pos] = len(pos_col_dict)
+            for snp_idx in snp_idx_list:
+                snp_col_list.append((snp_idx, pos_col_dict[pos]))
+        # SNP按下标排序后，同一节点的SNP连续，且节点按先序排列
+        snp_col_list.sort()
+
+        snp_idx_arr = np.array([snp_idx for snp_idx, _ in snp_col_list], dtype=np.int64)
+        snp_col_arr = np.array([col for _, col in snp_col_list], dtype=np.int64)
+        # 用户突变按首字符的码位比较，非单字符的derived突变不会与用户突变相同
+        if self.__snp_derived_code != None:
+            snp_derived_code = np.frombuffer(self.__snp_derived_code, dtype=np.int32)[
+                snp_idx_arr
+            ]
+        else:
+            snp_derived_code = np.array(
+                [
+                    ord(derived)
+                    if isinstance(derived, str) and len(derived) == 1
+                    else -1
+                    for derived in (
+                        self.__snp_derived_list[snp_idx] for snp_idx, _ in snp_col_list
+                    )
+                ],
+                dtype=np.int32,
+            )
+        snp_node_arr = np.frombuffer(self.__snp_node, dtype=np.int32)[snp_idx_arr]
+        cand_node, snp_seg_start = np.unique(snp_node_arr, return_index=True)
+
+        # 候选节点的最近候选祖先（没有时为哨兵列），以及在候选节点之间的层级
+        cand_count = len(cand_node)
+        node_end = self.__node_end
+        node_parent = self.__node_parent
+        node_snp_depth = self.__node_snp_depth
+        cand_parent = np.full(cand_count, cand_count, dtype=np.int64)
+        cand_level = np.zeros(cand_count, dtype=np.int64)
+        parent_snp_depth = np.zeros(cand_count, dtype=np.int32)
+        cand_stack = []
+        for col, node_idx in enumerate(cand_node.tolist()):
+            while len(cand_stack) > 0 and node_end[cand_node[cand_stack[-1]]] <= node_idx:
+                cand_stack.pop()
+            if len(cand_stack) > 0:
+                cand_parent[col] = cand_stack[-1]
+                cand_level[col] = cand_level[cand_stack[-1]] + 1
+            cand_stack.append(col)
+            if node_parent[node_idx] != -1:
+                parent_snp_depth[col] = node_snp_depth[node_parent[node_idx]]
+
+        level_order = np.argsort(cand_level, kind="stable")
+        level_start = np.searchsorted(
+            cand_level[level_order], np.arange(int(cand_level.max(initial=-1)) + 2)
+        )
+
+        # SNP下标到样本×SNP矩阵列的映射，没有位置的SNP为-1
+        snp_k_arr = np.full(self.__total_snp_count, -1, dtype=np.int64)
+        snp_k_arr[snp_idx_arr] = np.arange(len(snp_idx_arr))
 
-                # 只保留指定数量的分型结果
-                if len(self.__haplogroup_list) > self.__max_haplo_count:
-                    self.__haplogroup_list.pop()
+        batch_index = {
+            "pos_col_dict": pos_col_dict,
+            # 按用户基因数据的位置键类型使用的位置到矩阵列映射，int键的映射首次使用时转换
+            "pos_col_dict_by_type": {str: pos_col_dict},
+            "snp_k_list": snp_k_arr.tolist(),
+            "snp_idx": snp_idx_arr,
+            "snp_col": snp_col_arr,
+            "snp_derived_code": snp_derived_code,
+            "snp_seg_start": snp_seg_start,
+            "cand_node": cand_node,
+            "cand_parent": cand_parent,
+            "cand_snp_depth": np.append(
+                np.frombuffer(node_snp_depth, dtype=np.int32)[cand_node], 0
+            ).astype(np.int32),
+            "parent_snp_depth": parent_snp_depth,
+            "cand_level": cand_level,
+            "level_list": [
+                level_order[level_start[level] : level_start[level + 1]]
+                for level in range(len(level_start) - 1)
+            ],
+        }
+        self.__batch_index_dict[pos_index_ref] = batch_index
+        return batch_index
 
-        # 处理完成每个节点后，删除这个节点，回到上层递归后，再压入下一个节点（兄弟节点或子节点）
-        root_end_node_list.pop(0)
+    # 批量分析一组样本。按候选节点的层级从上到下，每层对所有样本的阳性节点和所有连续阳性单倍群数状态同时计算，规则与__check_haplo_path相同
+    def __analyse_batch_chunk(
+        self, np, batch_index: dict, snp_pos_index: dict, user_genome_list: list
+    ) -> list:
+        sample_count = len(user_genome_list)
+        pos_col_dict = batch_index["pos_col_dict"]
+        cand_node = batch_index["cand_node"]
+        cand_count = len(cand_node)
+        confirmed_positive_haplo = self.__confirmed_positive_haplo
+        allowed_negative_haplo = self.__allowed_negative_haplo
+
+        # 样本×位置的用户突变码位矩阵，0表示用户没有检测此位置。位置查找和取首字符都在map中完成，不逐个位置执行Python代码
+        pos_col_dict_by_type = batch_index["pos_col_dict_by_type"]
+        allele = np.zeros((sample_count, len(pos_col_dict)), dtype=np.int32)
+        for sample_idx, user_genome in enumerate(user_genome_list):
+            if user_genome == None or len(user_genome) == 0:
+                continue
+            key_type = self.__genome_key_type(user_genome)
+            if key_type not in pos_col_dict_by_type:
+                pos_col_dict_by_type[key_type] = self.__convert_pos_keys(
+                    pos_col_dict, key_type
+                )
+            genome_col = np.fromiter(
+                map(pos_col_dict_by_type[key_type].get, user_genome.keys(), repeat(-1)),
+                dtype=np.int64,
+                count=len(user_genome),
+            )
+            genome_code = np.fromiter(
+                map(ord, map(itemgetter(0), user_genome.values())),
+                dtype=np.int32,
+                count=len(user_genome),
+            )
+            genome_hit = genome_col != -1
+            allele[sample_idx, genome_col[genome_hit]] = genome_code[genome_hit]
+        # 用户突变统一为大写，与编译时转换的derived突变一致
+        allele -= ((allele >= ord("a")) & (allele <= ord("z"))) * (ord("a") - ord("A"))
+
+        if cand_count == 0:
+            return [[] for _ in range(sample_count)]
+
+        # 样本×SNP的用户突变，再按节点累加为样本×候选节点的已检测SNP数和derived SNP数，末尾加一列哨兵
+        snp_allele = allele[:, batch_index["snp_col"]]
+        var_count = np.zeros((sample_count, cand_count + 1), dtype=np.int32)
+        der_count = np.zeros((sample_count, cand_count + 1), dtype=np.int32)
+        var_count[:, :cand_count] = np.add.reduceat(
+            snp_allele != 0, batch_index["snp_seg_start"], axis=1, dtype=np.int32
+        )
+        der_count[:, :cand_count] = np.add.reduceat(
+            snp_allele == batch_index["snp_derived_code"],
+            batch_index["snp_seg_start"],
+            axis=1,
+            dtype=np.int32,
+        )
+
+        state_count = confirmed_positive_haplo + 1
+        state_arr = np.arange(state_count)
+        state_below = state_arr < confirmed_positive_haplo
+        tentative_state = min(1, confirmed_positive_haplo)
+        cand_parent = batch_index["cand_parent"]
+        cand_level = batch_index["cand_level"]
+        level_list = batch_index["level_list"]
+
+        # 每个节点的最近阳性祖先（含自身）和从根节点起累计的已检测阴性单倍群数，逐层向下传递
+        nearest_positive = np.full(
+            (sample_count, cand_count + 1), cand_count, dtype=np.int64
+        )
+        tested_negative = np.zeros((sample_count, cand_count + 1), dtype=np.int32)
+        for cols in level_list:
+            parent_cols = cand_parent[cols]
+            positive = der_count[:, cols] > 0
+            nearest_positive[:, cols] = np.where(
+                positive, cols, nearest_positive[:, parent_cols]
+            )
+            tested_negative[:, cols] = tested_negative[:, parent_cols] + (
+                (var_count[:, cols] > 0) & ~positive
+            )
+
+        # 分型规则只需对每个样本的阳性节点计算，阳性节点按样本和先序编号，编号pair_count为哨兵，表示没有上游阳性节点
+        pair_sample, pair_col = np.nonzero(der_count[:, :cand_count])
+        pair_count = len(pair_sample)
+        pair_id = np.full((sample_count, cand_count + 1), pair_count, dtype=np.int64)
+        pair_id[pair_sample, pair_col] = np.arange(pair_count)
+        parent_cols = cand_parent[pair_col]
+        upper_positive = nearest_positive[pair_sample, parent_cols]
+        upper_pair = pair_id[pair_sample, upper_positive]
+        no_upper = (upper_pair == pair_count)[:, None]
+        pair_var = var_count[pair_sample, pair_col]
+        pair_der = der_count[pair_sample, pair_col]
+        upper_var = var_count[pair_sample, upper_positive][:, None]
+        upper_der = der_count[pair_sample, upper_positive][:, None]
+
+        # 此节点与最近阳性祖先之间的单倍群数和已检测单倍群数，这些单倍群都没有derived突变
+        negative_haplo = (
+            batch_index["parent_snp_depth"][pair_col]
+            - batch_index["cand_snp_depth"][upper_positive]
+        )[:, None]
+        tested_haplo = (
+            tested_negative[pair_sample, parent_cols]
+            - tested_negative[pair_sample, upper_positive]
+        )[:, None]
+
+        # 每个连续阳性单倍群数状态下是否判断为跳变假阳，以及向上游查询时的状态
+        if allowed_negative_haplo != -1:
+            reset = state_below & (negative_haplo > allowed_negative_haplo)
+        else:
+            reset = np.zeros((pair_count, state_count), dtype=bool)
+        upper_state = np.minimum(
+            np.where(state_below & (negative_haplo > 0), 1, state_arr + 1),
+            confirmed_positive_haplo,
+        )
+
+        # 按连续阳性单倍群数状态缓存的上游累计结果，重新分型目标为-1表示上游累计结果有效
+        up_reset = np.full((pair_count + 1, state_count), -1, dtype=np.int64)
+        up_depth = np.zeros((pair_count + 1, state_count), dtype=np.int32)
+        up_tested = np.zeros((pair_count + 1, state_count), dtype=np.int32)
+        up_var = np.zeros((pair_count + 1, state_count), dtype=np.int32)
+        up_der = np.zeros((pair_count + 1, state_count), dtype=np.int32)
+        # 以每个阳性节点为最深阳性节点时的分型结果，分型节点列为-1表示没有分型结果
+        res_col = np.full(pair_count + 1, -1, dtype=np.int64)
+        res_der = np.zeros(pair_count + 1, dtype=np.int32)
+        res_depth = np.zeros(pair_count + 1, dtype=np.int32)
+        res_var = np.zeros(pair_count + 1, dtype=np.int32)
+        res_tested = np.zeros(pair_count + 1, dtype=np.int32)
+
+        # 上游阳性节点总在更浅的层级，按层级从上到下计算
+        pair_level = cand_level[pair_col]
+        pair_order = np.argsort(pair_level, kind="stable")
+        level_start = np.searchsorted(
+            pair_level[pair_order], np.arange(len(level_list) + 1)
+        )
+        for level in range(len(level_list)):
+            pairs = pair_order[level_start[level] : level_start[level + 1]]
+            if len(pairs) == 0:
+                continue
+            upper = upper_pair[pairs][:, None]
+            state = upper_state[pairs]
+            level_no_upper = no_upper[pairs]
+            level_negative = negative_haplo[pairs]
+            level_tested = tested_haplo[pairs]
+
+            up_reset[pairs] = np.where(
+                reset[pairs],
+                upper,
+                np.where(level_no_upper, -1, up_reset[upper, state]),
+            )
+            up_depth[pairs] = np.where(
+                level_no_upper,
+                level_negative,
+                level_negative + 1 + up_depth[upper, state],
+            )
+            up_tested[pairs] = np.where(
+                level_no_upper, level_tested, level_tested + 1 + up_tested[upper, state]
+            )
+            up_var[pairs] = np.where(
+                level_no_upper, 0, upper_var[pairs] + up_var[upper, state]
+            )
+            up_der[pairs] = np.where(
+                level_no_upper, 0, upper_der[pairs] + up_der[upper, state]
+            )
+
+            # 以此节点暂定分型，连续阳性单倍群数量为1；跳变假阳时取上游阳性节点的分型结果
+            tentative_reset = up_reset[pairs, tentative_state]
+            valid = tentative_reset == -1
+            target = np.where(valid, pair_count, tentative_reset)
+            res_col[pairs] = np.where(valid, pair_col[pairs], res_col[target])
+            res_der[pairs] = np.where(
+                valid, pair_der[pairs] + up_der[pairs, tentative_state], res_der[target]
+            )
+            res_depth[pairs] = np.where(
+                valid, up_depth[pairs, tentative_state] + 1, res_depth[target]
+            )
+            res_var[pairs] = np.where(
+                valid, pair_var[pairs] + up_var[pairs, tentative_state], res_var[target]
+            )
+            res_tested[pairs] = np.where(
+                valid, up_tested[pairs, tentative_state] + 1, res_tested[target]
+            )
+
+        # 逐个样本按终端节点先序汇总分型结果
+        snp_k_list = batch_index["snp_k_list"]
+        node_snp_offset = self.__node_snp_offset
+        node_parent = self.__node_parent
+        pair_node_list = cand_node[pair_col].tolist()
+        pair_result_list = [
+            (haplo_idx, der, depth, var, tested) if col != -1 else None
+            for col, haplo_idx, der, depth, var, tested in zip(
+                res_col[:pair_count].tolist(),
+                cand_node[res_col[:pair_count]].tolist(),
+                res_der[:pair_count].tolist(),
+                res_depth[:pair_count].tolist(),
+                res_var[:pair_count].tolist(),
+                res_tested[:pair_count].tolist(),
+            )
+        ]
+        sample_start = np.searchsorted(pair_sample, np.arange(sample_count + 1)).tolist()
+        haplogroup_list_list = []
+        for sample_idx, user_genome in enumerate(user_genome_list):
+            if sample_start[sample_idx] == sample_start[sample_idx + 1]:
+                haplogroup_list_list.append([])
+                continue
+
+            # 阳性节点的分型结果，与__check_haplo_path的返回值相同
+            haplo_result_dict = {
+                pair_node_list[pair]: pair_result_list[pair]
+                for pair in range(sample_start[sample_idx], sample_start[sample_idx + 1])
+            }
+
+            # 选出最终结果，只为最终结果生成分型路径
+            haplo_result_list = self.__select_haplogroups(
+                (end_node_idx, haplo_result_dict[node_idx])
+                for end_node_idx, node_idx in self.__find_end_nodes(haplo_result_dict)
+                if haplo_result_dict[node_idx] != None
+            )
+
+            # 只为最终结果路径上的SNP记录用户突变值
+            ctx = HaploContext(user_genome, snp_pos_index)
+            sample_allele = snp_allele[sample_idx]
+            path_node_set = set()
+            for end_node_idx, _ in haplo_result_list:
+                node_idx = end_node_idx
+                while node_idx != -1 and node_idx not in path_node_set:
+                    path_node_set.add(node_idx)
+                    for snp_idx in range(
+                        node_snp_offset[node_idx], node_snp_offset[node_idx + 1]
+                    ):
+                        snp_k = snp_k_list[snp_idx]
+                        if snp_k != -1 and sample_allele[snp_k] != 0:
+                            ctx.user_snp_dict[snp_idx] = chr(sample_allele[snp_k])
+                    node_idx = node_parent[node_idx]
+            haplogroup_list_list.append(
+                [
+                    self.__make_haplogroup(ctx, end_node_idx, haplo_result)
+                    for end_node_idx, haplo_result in haplo_result_list
+                ]
+            )
+
+        return haplogroup_list_list
+
+    # 查找用户位置与树上SNP位置的交集，记录在上下文中
+    def __find_pos_hits(self, ctx: HaploContext):
+        user_genome = ctx.user_genome
+        snp_pos_index = ctx.snp_pos_index
+
+        # 从用户位置和树位置中较少的一方查找两者的交集
+        # 用户突变只取首字符，并统一为大写
+        if isinstance(snp_pos_index, SharedPosIndex):
+            ctx.pos_hit_list = snp_pos_index.find_hits(user_genome)
+        elif len(user_genome) <= len(snp_pos_index):
+            ctx.pos_hit_list = [
+                (snp_pos_index[pos], genotype[0].upper())
+                for pos, genotype in user_genome.items()
+                if pos in snp_pos_index
+            ]
+        else:
+            ctx.pos_hit_list = [
+                (snp_idx_list, user_genome[pos][0].upper())
+                for pos, snp_idx_list in snp_pos_index.items()
+                if pos in user_genome
+            ]
+        ctx.pos_hit_count = len(ctx.pos_hit_list)
+
+    # 检测用户每个SNP的突变情况，只访问用户检测到的位置，用户突变值和每个单倍群节点中用户已检测SNP数和突变SNP数记录在上下文中，不修改单倍群分型树。
+    # pos_hit_list为None时检测上下文中的全部交集
+    def __check_snp(self, ctx: HaploContext, pos_hit_list: list = None):
+        snp_node = self.__snp_node
+        snp_derived_list = self.__snp_derived_list
+        if pos_hit_list == None:
+            pos_hit_list = ctx.pos_hit_list
+        # 映射共享映像时derived突变为码位，用户突变也按码位比较
+        compare_by_code = self.__snp_derived_code != None
+        if compare_by_code:
+            snp_derived_list = self.__snp_derived_code
+
+        # 只在输出INFO日志时才记录每个derived SNP，否则不必解析SNP字典和格式化日志
+        log_derived = logging.getLogger().isEnabledFor(logging.INFO)
+        user_snp_dict = ctx.user_snp_dict
+        node_var_count = ctx.node_var_count
+        node_der_count = ctx.node_der_count
+        for snp_idx_list, allele in pos_hit_list:
+            user_derived = ord(allele) if compare_by_code else allele
+            for snp_idx in snp_idx_list:
+                node_idx = snp_node[snp_idx]
+
+                # 用户检测了此SNP，记录用户突变值
+                user_snp_dict[snp_idx] = allele
+                node_var_count[node_idx] = node_var_count.get(node_idx, 0) + 1
+                if user_derived == snp_derived_list[snp_idx]:
+                    node_der_count[node_idx] = node_der_count.get(node_idx, 0) + 1
+                    if not log_derived:
+                        continue
+                    snp_dict = self.__get_snp_dict(snp_idx)
+                    logging.info(
+                        "\t{} 单倍群 {}，SNP位点 {} 产生突变：{} -> {}".format(
+                            self.__is_y_mt.upper(),
+                            self.__node_name_list[node_idx],
+                            snp_dict[self.__snp_key],
+                            snp_dict[self.__ancestral_key],
+                            snp_dict[self.__derived_key],
+                        )
+                    )
+
+    # 找到以阳性节点为路径上最深阳性节点的第一个终端节点，在子树中按先序查找，遇到下游阳性节点则跳过其整个子树，没有时返回-1
+    def __find_end_node(self, node_idx: int, node_der_count: dict) -> int:
+        node_end = self.__node_end
+        if node_end[node_idx] == node_idx + 1:
+            return node_idx
+        child_idx = node_idx + 1
+        while child_idx < node_end[node_idx]:
+            if child_idx in node_der_count:
+                child_idx = node_end[child_idx]
+            elif node_end[child_idx] == child_idx + 1:
+                return child_idx
+            else:
+                child_idx += 1
+        return -1
+
+    # 以阳性节点为路径上最深阳性节点的全部终端节点，按先序返回，遇到下游阳性节点则跳过其整个子树
+    def __find_all_end_nodes(self, node_idx: int, node_der_count: dict) -> list:
+        node_end = self.__node_end
+        if node_end[node_idx] == node_idx + 1:
+            return [node_idx]
+        end_node_idx_list = []
+        child_idx = node_idx + 1
+        while child_idx < node_end[node_idx]:
+            if child_idx in node_der_count:
+                child_idx = node_end[child_idx]
+                continue
+            if node_end[child_idx] == child_idx + 1:
+                end_node_idx_list.append(child_idx)
+            child_idx += 1
+        return end_node_idx_list
+
+    # 阳性节点的候选终端节点。单倍群名唯一时，同一分型节点的候选结果只有第一个可能被选中，只需第一个终端节点；
+    # 名称不唯一时，同名结果被淘汰后，此节点之后的终端节点的候选结果可以再被选中，与优化前一样每个终端节点都是候选
+    def __candidate_end_nodes(self, node_idx: int, node_der_count: dict) -> list:
+        if not self.__unique_node_name:
+            return self.__find_all_end_nodes(node_idx, node_der_count)
+        end_node_idx = self.__find_end_node(node_idx, node_der_count)
+        return [end_node_idx] if end_node_idx != -1 else []
+
+    # 为每个有derived突变的单倍群节点找到候选终端节点，按终端节点先序返回(终端节点, 阳性节点)
+    def __find_end_nodes(self, node_der_count: dict) -> list:
+        end_node_list = []
+        for node_idx in node_der_count:
+            for end_node_idx in self.__candidate_end_nodes(node_idx, node_der_count):
+                end_node_list.append((end_node_idx, node_idx))
+        end_node_list.sort()
+        return end_node_list
+
+    # 沿先序把路径统计从上游阳性节点向下传递，计算以每个阳性节点为最深阳性节点时的分型结果。
+    # 从某个阳性节点向根节点的分型规则只依赖连续阳性单倍群数（达到阈值后不再变化），因此每个阳性节点按此状态缓存其上游的累计结果，总计算量与用户检测到的节点数成线性
+    # 分型结果的derived SNP数不超过路径上所有阳性节点的derived SNP数之和，子树的上界是祖先路径与子树内的derived SNP数之和。
+    # 没有derived SNP的子树不会有分型结果；上界小于当前第maxHaploCount个结果的derived SNP数的子树不可能进入最终结果，都整体跳过
+    # 返回阳性节点下标到(分型节点下标, derived SNP数, 分型深度, 已检测SNP数, 已检测单倍群数)的字典，没有分型结果的为None；有分型结果的(终端节点, 阳性节点)记录在上下文中。
+    # 按子树拆分时，split_depth为拆分的层级：node_range为None时只计算根部（深度小于split_depth）的节点；否则上下文中只有根部和node_range内子树的统计，只记录子树内节点的候选结果
+    # rank_state为多次调用共用的(derived SNP数小顶堆, 已计入的分型节点集合)，逐步分析时先搜索的子树的结果可以用于后搜索的子树剪枝
+    def __check_haplo_path(
+        self,
+        ctx: HaploContext,
+        split_depth: int = -1,
+        node_range: tuple = None,
+        rank_state: tuple = None,
+    ) -> dict:
+        node_var_count = ctx.node_var_count
+        node_der_count = ctx.node_der_count
+        node_parent = self.__node_parent
+        node_end = self.__node_end
+        node_depth = self.__node_depth
+        node_snp_depth = self.__node_snp_depth
+        confirmed_positive_haplo = self.__confirmed_positive_haplo
+        allowed_negative_haplo = self.__allowed_negative_haplo
+        max_haplo_count = self.__max_haplo_count
+        end_node_list = ctx.end_node_list
+
+        # 上游路径的累计结果，按连续阳性单倍群数状态缓存：(分型深度, 已检测单倍群数, 已检测SNP数, derived SNP数)，
+        # 如果上游判断为跳变假阳，则为重新分型的上游阳性节点下标，-1表示没有分型结果
+        upstream_dict = {}
+        haplo_result_dict = {}
+
+        # 已检测节点的祖先栈，以及每个已检测节点的最近阳性祖先（含自身）和从根节点起累计的已检测阴性单倍群数
+        hit_node_stack = []
+        nearest_positive_dict = {}
+        tested_negative_dict = {}
+
+        # 阳性节点按先序排列的derived SNP数前缀和，子树[idx, end)内的derived SNP数由二分查找得到；以及每个已检测节点（含）到根节点路径上的derived SNP数
+        positive_node_list = sorted(node_der_count)
+        der_prefix_list = [0]
+        for node_idx in positive_node_list:
+            der_prefix_list.append(der_prefix_list[-1] + node_der_count[node_idx])
+        path_der_dict = {}
+
+        # 已确定进入候选的不同分型节点中最大的maxHaploCount个derived SNP数，小顶堆
+        prune_by_rank = self.__unique_node_name and max_haplo_count > 0
+        top_der_heap, top_result_set = rank_state if rank_state != None else ([], set())
+
+        var_node_list = sorted(node_var_count)
+        if split_depth != -1 and node_range == None:
+            var_node_list = [
+                node_idx for node_idx in var_node_list if node_depth[node_idx] < split_depth
+            ]
+        var_node_pos = 0
+        while var_node_pos < len(var_node_list):
+            node_idx = var_node_list[var_node_pos]
+            var_node_pos += 1
+            while len(hit_node_stack) > 0 and node_end[hit_node_stack[-1]] <= node_idx:
+                hit_node_stack.pop()
+            if len(hit_node_stack) > 0:
+                upper_positive_idx = nearest_positive_dict[hit_node_stack[-1]]
+                upper_tested_negative = tested_negative_dict[hit_node_stack[-1]]
+                upper_path_der = path_der_dict[hit_node_stack[-1]]
+            else:
+                upper_positive_idx = -1
+                upper_tested_negative = 0
+                upper_path_der = 0
+
+            # 子树不可能产生进入最终结果的分型时，跳过子树中所有已检测节点，子树外的节点不依赖这些节点的统计
+            subtree_der = (
+                der_prefix_list[bisect_left(positive_node_list, node_end[node_idx])]
+                - der_prefix_list[bisect_left(positive_node_list, node_idx)]
+            )
+            if subtree_der == 0 or (
+                prune_by_rank
+                and len(top_der_heap) == max_haplo_count
+                and upper_path_der + subtree_der < top_der_heap[0]
+            ):
+                skip_pos = bisect_left(var_node_list, node_end[node_idx], var_node_pos)
+                ctx.pruned_node_count += skip_pos - var_node_pos + 1
+                var_node_pos = skip_pos
+                continue
+
+            hit_node_stack.append(node_idx)
+            path_der_dict[node_idx] = upper_path_der + node_der_count.get(node_idx, 0)
+
+            # 已检测但没有derived突变的节点只向下传递统计
+            if node_idx not in node_der_count:
+                nearest_positive_dict[node_idx] = upper_positive_idx
+                tested_negative_dict[node_idx] = upper_tested_negative + 1
+                continue
+            nearest_positive_dict[node_idx] = node_idx
+            tested_negative_dict[node_idx] = upper_tested_negative
+
+            # 此节点与最近阳性祖先之间的单倍群数和已检测单倍群数，这些单倍群都没有derived突变
+            parent_idx = node_parent[node_idx]
+            negative_haplo = node_snp_depth[parent_idx] if parent_idx != -1 else 0
+            tested_haplo = upper_tested_negative
+            if upper_positive_idx != -1:
+                negative_haplo -= node_snp_depth[upper_positive_idx]
+                tested_haplo -= tested_negative_dict[upper_positive_idx]
+
+            upstream_list = []
+            for positive_haplo_count in range(confirmed_positive_haplo + 1):
+                # 下游连续阳性单倍群数量小于阈值时，上游连续阴性单倍群数量大于阈值，则判断分型结果是跳变假阳，由上游阳性节点重新分型
+                if (
+                    positive_haplo_count < confirmed_positive_haplo
+                    and allowed_negative_haplo != -1
+                    and negative_haplo > allowed_negative_haplo
+                ):
+                    upstream_list.append(upper_positive_idx)
+                elif upper_positive_idx == -1:
+                    upstream_list.append((negative_haplo, tested_haplo, 0, 0))
+                else:
+                    # 连续阴性单倍群会把未达阈值的连续阳性单倍群数量重置0
+                    if positive_haplo_count < confirmed_positive_haplo and negative_haplo > 0:
+                        upper_positive_haplo_count = 1
+                    else:
+                        upper_positive_haplo_count = positive_haplo_count + 1
+                    upper_upstream = upstream_dict[upper_positive_idx][
+                        min(upper_positive_haplo_count, confirmed_positive_haplo)
+                    ]
+                    if isinstance(upper_upstream, int):
+                        upstream_list.append(upper_upstream)
+                    else:
+                        upstream_list.append(
+                            (
+                                negative_haplo + 1 + upper_upstream[0],
+                                tested_haplo + 1 + upper_upstream[1],
+                                node_var_count[upper_positive_idx] + upper_upstream[2],
+                                node_der_count[upper_positive_idx] + upper_upstream[3],
+                            )
+                        )
+            upstream_dict[node_idx] = upstream_list
+
+            # 以此节点暂定分型，连续阳性单倍群数量为1
+            upstream = upstream_list[min(1, confirmed_positive_haplo)]
+            if isinstance(upstream, int):
+                haplo_result_dict[node_idx] = (
+                    haplo_result_dict[upstream] if upstream != -1 else None
+                )
+            else:
+                haplo_result_dict[node_idx] = (
+                    node_idx,
+                    node_der_count[node_idx] + upstream[3],
+                    upstream[0] + 1,
+                    node_var_count[node_idx] + upstream[2],
+                    upstream[1] + 1,
+                )
+
+            # 有终端节点的分型结果才是候选结果，单倍群名唯一时每个分型节点只计入一次。按子树拆分时，根部节点的终端节点可能在其它子树中，只由根部计算
+            haplo_result = haplo_result_dict[node_idx]
+            if haplo_result == None:
+                continue
+            if node_range != None and node_depth[node_idx] < split_depth:
+                continue
+            candidate_end_node_list = self.__candidate_end_nodes(node_idx, node_der_count)
+            if len(candidate_end_node_list) == 0:
+                continue
+            for end_node_idx in candidate_end_node_list:
+                end_node_list.append((end_node_idx, node_idx))
+            if prune_by_rank and haplo_result[0] not in top_result_set:
+                top_result_set.add(haplo_result[0])
+                if len(top_der_heap) < max_haplo_count:
+                    heapq.heappush(top_der_heap, haplo_result[1])
+                elif haplo_result[1] > top_der_heap[0]:
+                    heapq.heapreplace(top_der_heap, haplo_result[1])
+
+        end_node_list.sort()
+        return haplo_result_dict
+
+    # 节点数不少于clade_count的最浅层级，都不足时取最深的层级，至少为1
+    def __auto_split_depth(self, clade_count: int) -> int:
+        depth_count_dict = {}
+        for depth in self.__node_depth:
+            depth_count_dict[depth] = depth_count_dict.get(depth, 0) + 1
+        for depth in sorted(depth_count_dict):
+            if depth >= 1 and depth_count_dict[depth] >= clade_count:
+                return depth
+        return max(max(depth_count_dict), 1)
+
+    # 把单倍群分型树在第splitDepth层拆分为rangeCount组先序相邻的子树，每组的SNP数尽量接近。splitDepth为None时取子树数不少于rangeCount*4的最浅层级。
+    # 返回(拆分层级, [(组的起始节点下标, 结束节点下标)], 每个SNP所属的组，根部（深度小于拆分层级）的SNP为-1)
+    def split_subtrees(self, rangeCount: int, splitDepth: int = None) -> tuple:
+        if rangeCount < 1:
+            raise Exception("子树组数至少为1")
+        node_depth = self.__node_depth
+        node_end = self.__node_end
+        node_snp_offset = self.__node_snp_offset
+        node_count = len(self.__node_name_list)
+
+        if splitDepth == None:
+            splitDepth = self.__auto_split_depth(rangeCount * 4)
+        if splitDepth < 1:
+            raise Exception("子树拆分层级至少为1")
+
+        # 拆分层级的节点按先序排列，各自的子树互不重叠
+        clade_list = [
+            node_idx for node_idx in range(node_count) if node_depth[node_idx] == splitDepth
+        ]
+        total_snp_count = sum(
+            node_snp_offset[node_end[node_idx]] - node_snp_offset[node_idx]
+            for node_idx in clade_list
+        )
+        # 每组的目标SNP数按剩余的SNP数和组数计算，一个很大的子树不会使后面的组过小
+        node_range_list = []
+        remain_snp_count = total_snp_count
+        range_snp_count = 0
+        range_start = -1
+        for node_idx in clade_list:
+            if range_start == -1:
+                range_start = node_idx
+            range_snp_count += node_snp_offset[node_end[node_idx]] - node_snp_offset[node_idx]
+            if range_snp_count * (rangeCount - len(node_range_list)) >= remain_snp_count:
+                node_range_list.append((range_start, node_end[node_idx]))
+                remain_snp_count -= range_snp_count
+                range_snp_count = 0
+                range_start = -1
+        if range_start != -1:
+            node_range_list.append((range_start, node_end[clade_list[-1]]))
+
+        snp_part = array("i", repeat(-1, len(self.__snp_node)))
+        for part, (range_start, range_end) in enumerate(node_range_list):
+            for node_idx in range(range_start, range_end):
+                if node_depth[node_idx] >= splitDepth:
+                    for snp_idx in range(
+                        node_snp_offset[node_idx], node_snp_offset[node_idx + 1]
+                    ):
+                        snp_part[snp_idx] = part
+        return splitDepth, node_range_list, snp_part
+
+    # 计算一组子树，在子树进程池的工作进程中调用。交集按SNP展开：snpIdxArray为根部和此组子树的交集SNP下标，alleles为对应的用户突变，每个SNP一个字符。
+    # 进程间只传递数组和字符串，返回此组子树（不含根部）的(已检测节点数组, 已检测SNP数数组, 阳性节点数组, 突变SNP数数组, 已检测SNP下标数组, 用户突变字符串,
+    # [(终端节点下标, 阳性节点下标, 分型结果)], 跳过的节点数)
+    def check_subtree(
+        self, nodeRange: tuple, splitDepth: int, snpIdxArray: array, alleles: str
+    ) -> tuple:
+        node_depth = self.__node_depth
+        snp_node = self.__snp_node
+        ctx = HaploContext(None, None)
+        ctx.pos_hit_list = [
+            ((snp_idx,), allele) for snp_idx, allele in zip(snpIdxArray, alleles)
+        ]
+        self.__check_snp(ctx)
+        haplo_result_dict = self.__check_haplo_path(ctx, splitDepth, nodeRange)
+
+        var_node_arr = array("i")
+        var_count_arr = array("i")
+        for node_idx, count in ctx.node_var_count.items():
+            if node_depth[node_idx] >= splitDepth:
+                var_node_arr.append(node_idx)
+                var_count_arr.append(count)
+        der_node_arr = array("i")
+        der_count_arr = array("i")
+        for node_idx, count in ctx.node_der_count.items():
+            if node_depth[node_idx] >= splitDepth:
+                der_node_arr.append(node_idx)
+                der_count_arr.append(count)
+        user_snp_arr = array("i")
+        user_allele_list = []
+        for snp_idx, allele in ctx.user_snp_dict.items():
+            if node_depth[snp_node[snp_idx]] >= splitDepth:
+                user_snp_arr.append(snp_idx)
+                user_allele_list.append(allele)
+        return (
+            var_node_arr,
+            var_count_arr,
+            der_node_arr,
+            der_count_arr,
+            user_snp_arr,
+            "".join(user_allele_list),
+            [
+                (end_node_idx, node_idx, haplo_result_dict[node_idx])
+                for end_node_idx, node_idx in ctx.end_node_list
+            ],
+            ctx.pruned_node_count,
+        )
+
+    # 用子树进程池计算分型候选结果：交集按SNP所属的子树组分发给工作进程，根部的交集发给每个工作进程，使子树的祖先路径统计完整；
+    # 工作进程计算时主进程计算根部的SNP，收到各组的统计后合并到上下文中，再用完整的统计计算根部节点的候选结果。返回按终端节点先序排列的(终端节点, 分型结果)
+    def __check_subtrees(self, ctx: HaploContext, subtree_pool) -> list:
+        snp_part = subtree_pool.SnpPart
+        split_depth = subtree_pool.SplitDepth
+        # 按SNP展开的交集，每组一个SNP下标数组和用户突变列表，最后一组（下标-1）是根部
+        part_count = len(subtree_pool.NodeRanges)
+        part_snp_list = [array("i") for _ in range(part_count + 1)]
+        part_allele_list = [[] for _ in range(part_count + 1)]
+        for snp_idx_list, allele in ctx.pos_hit_list:
+            for snp_idx in snp_idx_list:
+                part = snp_part[snp_idx]
+                part_snp_list[part].append(snp_idx)
+                part_allele_list[part].append(allele)
+
+        spine_snp_arr = part_snp_list[-1]
+        spine_alleles = "".join(part_allele_list[-1])
+        future_list = [
+            subtree_pool.submit(
+                part,
+                spine_snp_arr + part_snp_list[part],
+                spine_alleles + "".join(part_allele_list[part]),
+            )
+            for part in range(part_count)
+            if len(part_snp_list[part]) > 0
+        ]
+        self.__check_snp(
+            ctx,
+            [((snp_idx,), allele) for snp_idx, allele in zip(spine_snp_arr, spine_alleles)],
+        )
+
+        subtree_candidate_list = []
+        for future in future_list:
+            (
+                var_node_arr,
+                var_count_arr,
+                der_node_arr,
+                der_count_arr,
+                user_snp_arr,
+                user_alleles,
+                candidate_list,
+                pruned_count,
+            ) = future.result()
+            ctx.node_var_count.update(zip(var_node_arr, var_count_arr))
+            ctx.node_der_count.update(zip(der_node_arr, der_count_arr))
+            ctx.user_snp_dict.update(zip(user_snp_arr, user_alleles))
+            ctx.pruned_node_count += pruned_count
+            subtree_candidate_list.extend(candidate_list)
+
+        # 根部节点的分型结果只依赖根部的统计，终端节点和剪枝使用合并后的完整统计
+        haplo_result_dict = self.__check_haplo_path(ctx, split_depth)
+        end_result_list = [
+            (end_node_idx, haplo_result_dict[node_idx])
+            for end_node_idx, node_idx in ctx.end_node_list
+        ]
+        for end_node_idx, node_idx, haplo_result in subtree_candidate_list:
+            ctx.end_node_list.append((end_node_idx, node_idx))
+            end_result_list.append((end_node_idx, haplo_result))
+        ctx.end_node_list.sort()
+        end_result_list.sort(key=itemgetter(0))
+        return end_result_list
+
+    # 从按终端节点先序排列的(终端节点, 分型结果)中选出前maxHaploCount个，按分型结果规则排序后返回。
+    # 与优化前相同，候选结果与当前结果中的单倍群同名时不加入，同名结果被淘汰后之后的同名候选结果可以再加入；
+    # 用有界小顶堆保存当前最好的结果，堆顶是最差的结果，排序键相同时先出现的结果优先
+    def __select_haplogroups(self, end_result_iter) -> list:
+        max_haplo_count = self.__max_haplo_count
+        haplo_heap = []
+        haplo_name_set = set()
+        for seq, (end_node_idx, haplo_result) in enumerate(end_result_iter):
+            haplogroup = self.__node_name_list[haplo_result[0]]
+            if haplogroup in haplo_name_set:
+                continue
+            entry = (
+                haplo_result[1],
+                haplo_result[2],
+                self.__haplo_score(haplo_result),
+                -seq,
+                end_node_idx,
+                haplo_result,
+            )
+            if len(haplo_heap) < max_haplo_count:
+                heapq.heappush(haplo_heap, entry)
+            elif max_haplo_count > 0 and entry > haplo_heap[0]:
+                evicted_entry = heapq.heapreplace(haplo_heap, entry)
+                haplo_name_set.remove(self.__node_name_list[evicted_entry[5][0]])
+            else:
+                continue
+            haplo_name_set.add(haplogroup)
+
+        haplo_heap.sort(reverse=True)
+        return [(entry[4], entry[5]) for entry in haplo_heap]
+
+    # 根据分型路径突变情况，计算分型结果可靠性评分
+    @staticmethod
+    def __haplo_score(haplo_result: tuple) -> float:
+        _, total_user_der_count, haplo_depth, total_user_var_count, tested_haplo = (
+            haplo_result
+        )
+        haplo_score = 0
+        if total_user_var_count != 0 and haplo_depth != 0:
+            # 用户derived SNP突变数/用户所有检测SNP数 * 有突变的单倍群节点数/单倍群分型深度
+            haplo_score = (total_user_der_count / total_user_var_count) * (
+                tested_haplo / haplo_depth
+            )
+        return haplo_score
+
+    # 生成终端节点路径的分型结果，分型路径在使用时才生成
+    def __make_haplogroup(
+        self, ctx: HaploContext, end_node_idx: int, haplo_result: tuple
+    ) -> HaploResult:
+        return HaploResult(
+            self,
+            end_node_idx,
+            haplo_result,
+            self.__haplo_score(haplo_result),
+            ctx.user_snp_dict,
+        )
+
+    # 单倍群节点名
+    def node_name(self, node_idx: int) -> str:
+        return self.__node_name_list[node_idx]
+
+    # 终端节点路径上的每个单倍群和突变情况，从终端节点到根节点。突变列表是树上SNP的副本，用户已检测的SNP附带用户突变值
+    def make_haplo_path(self, end_node_idx: int, user_snp_dict: dict) -> list:
+        haplo_path_list = []
+        node_idx = end_node_idx
+        while node_idx != -1:
+            if self.__node_has_snp[node_idx]:
+                mutation_list = []
+                for snp_idx in range(
+                    self.__node_snp_offset[node_idx],
+                    self.__node_snp_offset[node_idx + 1],
+                ):
+                    snp_dict = dict(self.__get_snp_dict(snp_idx))
+                    if snp_idx in user_snp_dict:
+                        snp_dict[self.__user_geno_key] = user_snp_dict[snp_idx]
+                    mutation_list.append(snp_dict)
+                haplo_path_list.append(
+                    {
+                        "haplo": self.__node_name_list[node_idx],
+                        "mutation": mutation_list,
+                    }
+                )
+            node_idx = self.__node_parent[node_idx]
+        return haplo_path_list
+
+    # 终端节点路径上有snp列表键的单倍群名，从终端节点到根节点，与make_haplo_path的单倍群一致
+    def path_haplo(self, end_node_idx: int) -> list:
+        haplo_name_list = []
+        node_idx = end_node_idx
+        while node_idx != -1:
+            if self.__node_has_snp[node_idx]:
+                haplo_name_list.append(self.__node_name_list[node_idx])
+            node_idx = self.__node_parent[node_idx]
+        return haplo_name_list
+
+    # 单倍群节点的快照，用于比较两个版本的单倍群分型树。按先序返回[(单倍群名, 父节点下标, SNP列表)]，
+    # SNP列表中每个SNP为(SNP名, pos19, pos38, pos, ancestral突变, derived突变)，没有snp列表键的节点为None
+    def node_snapshot(self) -> list:
+        snapshot_list = []
+        for node_idx, node_name in enumerate(self.__node_name_list):
+            snp_list = None
+            if self.__node_has_snp[node_idx]:
+                snp_list = []
+                for snp_idx in range(
+                    self.__node_snp_offset[node_idx],
+                    self.__node_snp_offset[node_idx + 1],
+                ):
+                    snp_dict = self.__get_snp_dict(snp_idx)
+                    snp_list.append(
+                        (
+                            snp_dict.get(self.__snp_key),
+                            snp_dict.get(self.__pos19_key),
+                            snp_dict.get(self.__pos38_key),
+                            snp_dict.get(self.__pos_key),
+                            snp_dict.get(self.__ancestral_key),
+                            snp_dict.get(self.__derived_key),
+                        )
+                    )
+            snapshot_list.append(
+                (node_name, self.__node_parent[node_idx], snp_list)
+            )
+        return snapshot_list
 
     # 输出单倍群分型结果，HTML表格
-    def __str__(self):
-        if self.__haplogroup_list == None or len(self.__haplogroup_list) == 0:
+    def to_html(self, haplogroup_list: list) -> str:
+        if haplogroup_list == None or len(haplogroup_list) == 0:
             return ""
 
         haplo_table = []
@@ -382,26 +2225,36 @@ class Haplotyping:
             f"<thead><tr><th>{self.__is_y_mt.upper()} 单倍群</th><th>SNP突变数</th><th>层级</th><th>可信度</th></tr></thead>"
         )
         haplo_table.append("<tbody>")
-        for idx, haplo in enumerate(self.__haplogroup_list):
+        for idx, haplo in enumerate(haplogroup_list):
             haplo_table.append(
                 "<tr style='{}'><td><a href='https://geneu.xyz/haplo-tree/{}/{}/{}' target='_blank' title='在基因助手GeneU查看{} {}单倍群树'>{}</a></td><td>{}</td><td>{}</td><td>{:.2%}</td></tr>".format(
                     "color: red; font-size: larger;" if idx == 0 else "",
                     self.__source,
                     self.__is_y_mt,
-                    haplo["haplo"],
+                    haplo.Haplo,
                     self.__source.upper(),
                     self.__is_y_mt.upper(),
                     (
-                        "<span style='color: red;'>{}</span>".format(haplo["haplo"])
+                        "<span style='color: red;'>{}</span>".format(haplo.Haplo)
                         if idx == 0
-                        else haplo["haplo"]
+                        else haplo.Haplo
                     ),
-                    haplo["snp_derived_count"],
-                    haplo["haplo_depth"],
-                    haplo["haplo_score"],
+                    haplo.SNPDerivedCount,
+                    haplo.HaploDepth,
+                    haplo.HaploScore,
                 )
             )
         haplo_table.append("</tbody>")
         haplo_table.append("</table>")
+        if isinstance(haplogroup_list, HaploSnapshot) and haplogroup_list.Partial:
+            haplo_table.append(
+                "<p>分析时间有限，还有{}个分支未搜索，以上结果可能不是最终结果</p>".format(
+                    haplogroup_list.TotalClades - haplogroup_list.ExploredClades
+                )
+            )
         haplo_table.append("</div>")
         return "".join(haplo_table)
+
+    # 输出最近一次分析的单倍群分型结果，HTML表格，与to_html(HaplogroupList)相同
+    def __str__(self):
+        return self.to_html(self.__haplogroup_list)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import contextlib
+
+# 启用性能统计的环境变量，值不为空、0、false或no时启用
+INSTRUMENT_ENV = "HAPLO_INSTRUMENT"
+
+
+# 环境变量是否启用了性能统计
+def instrument_enabled() -> bool:
+    return os.environ.get(INSTRUMENT_ENV, "").strip().lower() not in (
+        "",
+        "0",
+        "false",
+        "no",
+    )
+
+
+# 一次请求的性能统计，记录每个阶段的耗时和计数，最后在stderr输出一行JSON，不影响stdout的输出结果。
+# 每个请求使用独立的对象，不在线程间共享
+class Instrument:
+    def __init__(self):
+        self.__start_time = time.perf_counter()
+        self.stage_dict = {}
+        self.counter_dict = {}
+
+    # 统计一个阶段的耗时，同名阶段的耗时累加
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stage_dict[name] = (
+                self.stage_dict.get(name, 0) + time.perf_counter() - start_time
+            )
+
+    # 累加计数
+    def count(self, name: str, value: int = 1):
+        self.counter_dict[name] = self.counter_dict.get(name, 0) + value
+
+    # 合并另一个统计对象的阶段耗时和计数，用于汇总并发执行的各部分各自记录的统计
+    def merge(self, other: "Instrument"):
+        for name, seconds in other.stage_dict.items():
+            self.stage_dict[name] = self.stage_dict.get(name, 0) + seconds
+        for name, value in other.counter_dict.items():
+            self.count(name, value)
+
+    def to_dict(self) -> dict:
+        return {
+            "total_ms": round((time.perf_counter() - self.__start_time) * 1000, 3),
+            "stages_ms": {
+                name: round(seconds * 1000, 3)
+                for name, seconds in self.stage_dict.items()
+            },
+            "counters": dict(self.counter_dict),
+        }
+
+    # 在stderr输出一行JSON
+    def emit(self, **extra):
+        record = {"instrument": self.to_dict()}
+        record.update(extra)
+        sys.stderr.write(
+            json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        )
+        sys.stderr.flush()
+
+
+# 统计阶段耗时，instrument为None时不做任何统计
+def timed(instrument: Instrument, name: str):
+    if instrument == None:
+        return contextlib.nullcontext()
+    return instrument.stage(name)
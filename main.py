@@ -1,198 +1,480 @@
-# -*- coding: utf-8 -*-
-import sys
-import json
-import warnings
-from os import cpu_count
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-# wegene_utils 库会包含在每个应用的环境当中，无需自行打包上传
-# 这里提供源代码以供应用完整运行
-import wegene_utils
-
-from haplotyping import *
-
-"""
-当输入是部分位点时, 基因位点数据以 json 形式输入:
-    {"inputs": {"RS671": "AA", "RS12203592": "CA", "format": "wegene_affy_2"}}
-当输入全部位点时，全部位点对应的字符串序列会被 gzip 压缩并以 base64 转码，
-转码前的数据在 data 域中
-    {"inputs": {"data": "xfgakljdflkja...", format: "wegene_affy_2"}}
-你需要解码并解压该数据，解压后的字符串如下:
-    AACCTACCCCCC...
-进一步，你需要利用相应格式的索引文件对每个位点进行解析
-我们提供了整个流程的示例代码以及索引文件
-"""
-
-warnings.filterwarnings("ignore")
-
-# 从 stdin 读取输入数据
-body = sys.stdin.read()
-
-try:
-    # 如果输入的数据是全部位点数据，可以使用 wegene_utils的方法进行解析后使用
-    inputs = json.loads(body)["inputs"]
-    # 使用 wegene_utils 解析以后，数据会被解析成下面这样的 json 格式:
-    #   {'rs123': {'genotype': 'AA', 'chromosome': '1', position: '1236'}, ...}
-    user_genome = wegene_utils.process_raw_genome_data(inputs)
-
-    # 筛选出用户的Y和mt-SNP的pos和genotype
-    user_y_dict = {}
-    user_mt_dict = {}
-    for values in user_genome.values():
-        if (
-            "chromosome" in values
-            and "position" in values
-            and "genotype" in values
-            and values["chromosome"] in {"Y", "MT"}
-            and values["genotype"][0]
-            in {
-                "A",
-                "T",
-                "G",
-                "C",
-            }
-        ):
-            if values["chromosome"] == "Y":
-                user_y_dict[values["position"]] = values["genotype"]
-            elif values["chromosome"] == "MT":
-                user_mt_dict[values["position"]] = values["genotype"]
-
-    # 使用23Mofang单倍群树
-    source = "mf"
-
-    # 单倍群可信度阈值
-    haplo_tol: float = 0.5
-
-    # 单倍群分型对象
-    yHaplo: Haplotyping = None
-    mtHaplo: Haplotyping = None
-
-    # 并发Y和mt单倍群分型，注：女性没有Y
-    cpu_count = cpu_count()
-    with ThreadPoolExecutor(
-        max_workers=cpu_count if cpu_count != None and cpu_count > 0 else 1
-    ) as t:
-        task_list = []
-        if len(user_y_dict) > 0:
-            yHaplo = Haplotyping(
-                "haplotree/{}_y_snp_tree.json".format(source.lower()), source, "y"
-            )
-            task_list.append(t.submit(yHaplo.analyse, user_y_dict))
-        if len(user_mt_dict) > 0:
-            mtHaplo = Haplotyping(
-                "haplotree/{}_mt_snp_tree.json".format(source.lower()), source, "mt"
-            )
-            task_list.append(t.submit(mtHaplo.analyse, user_mt_dict))
-
-        for task in as_completed(task_list):
-            task.result()
-
-    # 输出HTML
-    result = []
-    if (yHaplo != None and len(yHaplo.HaplogroupList) > 0) or (
-        mtHaplo != None and len(mtHaplo.HaplogroupList) > 0
-    ):
-        if yHaplo != None and len(yHaplo.HaplogroupList) > 0:
-            # 显示Y单倍群列表
-            result.append(str(yHaplo))
-
-            # 获取用户的Y家族信息
-            user_y_family_dict = {}
-            with open(
-                "haplotree/{}_y_dict.json".format(source.lower()),
-                "r",
-                encoding="utf-8-sig",
-            ) as y_dict_file:
-                y_dict = json.load(y_dict_file)
-                y_dict = y_dict if "dict" not in y_dict else y_dict["dict"]
-                for y_haplo_dict in yHaplo.HaplogroupList[0]["haplo_path"]:
-                    if "hf" in y_dict[y_haplo_dict["haplo"]]:
-                        user_y_family_dict[y_haplo_dict["haplo"]] = y_dict[
-                            y_haplo_dict["haplo"]
-                        ]
-
-        if mtHaplo != None and len(mtHaplo.HaplogroupList) > 0:
-            # 显示mt单倍群列表
-            result.append(str(mtHaplo))
-
-        result.append(
-            "<div class='alert alert-info' style='margin-top: 10px;' role='alert'><ul>"
-        )
-
-        if yHaplo != None and len(yHaplo.HaplogroupList) > 0:
-            y_family_str = ""
-            if len(user_y_family_dict) > 0:
-                y_family_str += "上下游关联家族：<ul>"
-                for y in user_y_family_dict.keys():
-                    y_family_str += "<li>{} (共祖{}年)".format(
-                        y, user_y_family_dict[y]["a"]
-                    )
-                    for family_dict in user_y_family_dict[y]["hf"]:
-                        y_family_str += " <a href='https://www.23mofang.com/ancestry/family/{}' target='_blank' title='查看家族详情'>{}</a>".format(
-                            family_dict["fi"],
-                            family_dict["ft"],
-                        )
-                    y_family_str += "</li>"
-                y_family_str += "</ul>"
-            result.append(
-                "<li>您的Y父系单倍群最有可能是<span style='color: red;'>{}</span>，{}。{}</li>".format(
-                    yHaplo.HaplogroupList[0]["haplo"],
-                    (
-                        "可信度较高"
-                        if yHaplo.HaplogroupList[0]["haplo_score"] >= haplo_tol
-                        else "可信度较低，可能是由于您的微基因数据有误，或不适用于此分型计算器"
-                    ),
-                    y_family_str,
-                )
-            )
-
-        if mtHaplo != None and len(mtHaplo.HaplogroupList) > 0:
-            result.append(
-                "<li>您的mt母系单倍群最有可能是<span style='color: red;'>{}</span>，{}。</li>".format(
-                    mtHaplo.HaplogroupList[0]["haplo"],
-                    (
-                        "可信度较高"
-                        if mtHaplo.HaplogroupList[0]["haplo_score"] >= haplo_tol
-                        else "可信度较低，可能是由于您的微基因数据有误，或不适用于此分型计算器"
-                    ),
-                )
-            )
-
-        result.append(
-            "<li>此单倍群分型计算器基于{}的{}{}{}。采用“均衡型策略”处理SNP假阳的情况。</li>".format(
-                source.upper(),
-                (
-                    "父系单倍群树（{:,}个单倍群）".format(yHaplo.HaploCount)
-                    if yHaplo != None
-                    else ""
-                ),
-                "，" if yHaplo != None and mtHaplo != None else "",
-                (
-                    "母系单倍群树（{:,}个单倍群）".format(mtHaplo.HaploCount)
-                    if mtHaplo != None
-                    else ""
-                ),
-            )
-        )
-        result.append(
-            "<li>此次分析使用您的微基因数据中{:,}个Y-SNP和{:,}个mt-SNP，不包含nocall和indel位点。</li>".format(
-                len(user_y_dict), len(user_mt_dict)
-            )
-        )
-        result.append(
-            "<li>非WeGene用户，可在<a href='http://geneu.xyz' target='_blank'>基因助手GeneU.xyz</a>上传样本使用此计算器。</li>"
-        )
-        result.append("</ul></div>")
-    else:
-        result.append(
-            "<div class='alert alert-warning' role='alert>您的微基因数据没有可用于单倍群分型的信息，请更换样本重试尝试。</div>"
-        )
-
-    # 输出给用户的结果只需要通过 print 输出即可，print只可调用一次
-    print("".join(result))
-
-except Exception as e:
-    # 错误信息需要被从 stderr 中输出，否则会作为正常结果输出
-    for msg in e.args:
-        sys.stderr.write(msg)
-    exit(2)
+# -*- coding: utf-8 -*-
+import sys
+import json
+import argparse
+import threading
+import warnings
+from os import cpu_count
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# wegene_utils 库会包含在每个应用的环境当中，无需自行打包上传
+# 这里提供源代码以供应用完整运行
+import wegene_utils
+
+from haplotyping import *
+from tree_registry import TreeRegistry
+from haplo_resource import HaploResource
+from result_cache import ResultCache
+from instrument import Instrument, instrument_enabled, timed
+
+"""
+当输入是部分位点时, 基因位点数据以 json 形式输入:
+    {"inputs": {"RS671": "AA", "RS12203592": "CA", "format": "wegene_affy_2"}}
+当输入全部位点时，全部位点对应的字符串序列会被 gzip 压缩并以 base64 转码，
+转码前的数据在 data 域中
+    {"inputs": {"data": "xfgakljdflkja...", format: "wegene_affy_2"}}
+你需要解码并解压该数据，解压后的字符串如下:
+    AACCTACCCCCC...
+进一步，你需要利用相应格式的索引文件对每个位点进行解析
+我们提供了整个流程的示例代码以及索引文件
+
+默认从 stdin 读取一个请求并输出 HTML，也可以常驻运行，单倍群树、家族字典和基因索引只加载一次:
+    python main.py --serve < requests.jsonl        每行一个请求，每行输出 {"result": HTML} 或 {"error": 错误信息}
+    python main.py --http 127.0.0.1:8080           POST 请求体与 stdin 输入相同，返回 HTML
+请求中可以用 "source" 指定一个或多个单倍群树数据源，多个数据源的结果依次输出:
+    {"inputs": {...}, "source": ["mf", "isogg"]}
+"""
+
+warnings.filterwarnings("ignore")
+
+# 使用23Mofang单倍群树
+source = "mf"
+
+# 单倍群可信度阈值
+haplo_tol: float = 0.5
+
+
+# 对一个请求的输入做Y和mt单倍群分型，返回HTML。instrument不为None时记录每个阶段的耗时和计数。
+# source_list为空时使用resource的数据源，否则用户基因数据只解析一次，依次输出每个数据源的分型结果
+def haplotype_inputs(
+    inputs: dict,
+    resource: HaploResource,
+    instrument: Instrument = None,
+    source_list: list = None,
+) -> str:
+    # 只需要Y和mt，直接筛选出用户的Y和mt-SNP的pos和genotype，不包含nocall和indel位点:
+    #   {'Y': {'2781': 'AA', ...}, 'MT': {'73': 'GG', ...}}
+    user_chrom_dict = wegene_utils.extract_positions(
+        inputs, chromosomes=("Y", "MT"), instrument=instrument
+    )
+
+    if source_list == None or len(source_list) == 0:
+        return haplotype_chromosomes(user_chrom_dict, resource, instrument)
+    # 各数据源的单倍群分型树同时加载和分析
+    with timed(instrument, "analyse_sources"):
+        haplo_list_dict = resource.analyse_sources(
+            user_chrom_dict, source_list, instrument
+        )
+    return "".join(
+        haplotype_chromosomes(
+            user_chrom_dict,
+            resource.with_source(source),
+            instrument,
+            {
+                is_y_mt: haplo_list_dict.get((source, is_y_mt), [])
+                for is_y_mt in ("y", "mt")
+            },
+        )
+        for source in source_list
+    )
+
+
+# 用一个数据源的单倍群分型树对用户的Y和mt基因数据分型，返回HTML。
+# haplo_list_dict为已有的分型结果 {y|mt: 分型结果列表}，不为None时不再分析
+def haplotype_chromosomes(
+    user_chrom_dict: dict,
+    resource: HaploResource,
+    instrument: Instrument = None,
+    haplo_list_dict: dict = None,
+) -> str:
+    source = resource.Source
+    user_y_dict = user_chrom_dict["Y"]
+    user_mt_dict = user_chrom_dict["MT"]
+
+    # 单倍群分型对象
+    yHaplo: Haplotyping = None
+    mtHaplo: Haplotyping = None
+
+    # 单倍群分型结果
+    y_haplo_list = []
+    mt_haplo_list = []
+
+    # Y和mt单倍群分型，注：女性没有Y。分型受GIL限制，线程并发没有收益，依次计算
+    if len(user_y_dict) > 0:
+        with timed(instrument, "y.tree_load"):
+            yHaplo = resource.get_haplo("y")
+        if haplo_list_dict != None:
+            y_haplo_list = haplo_list_dict["y"]
+        else:
+            y_haplo_list = resource.analyse(yHaplo, "y", user_y_dict, instrument)
+    if len(user_mt_dict) > 0:
+        with timed(instrument, "mt.tree_load"):
+            mtHaplo = resource.get_haplo("mt")
+        if haplo_list_dict != None:
+            mt_haplo_list = haplo_list_dict["mt"]
+        else:
+            mt_haplo_list = resource.analyse(mtHaplo, "mt", user_mt_dict, instrument)
+
+    with timed(instrument, "html"):
+        return _make_html(
+            source,
+            resource,
+            yHaplo,
+            mtHaplo,
+            y_haplo_list,
+            mt_haplo_list,
+            user_y_dict,
+            user_mt_dict,
+            instrument,
+        )
+
+
+# 输出分型结果的HTML
+def _make_html(
+    source: str,
+    resource: HaploResource,
+    yHaplo: Haplotyping,
+    mtHaplo: Haplotyping,
+    y_haplo_list: list,
+    mt_haplo_list: list,
+    user_y_dict: dict,
+    user_mt_dict: dict,
+    instrument: Instrument,
+) -> str:
+    result = []
+    if len(y_haplo_list) > 0 or len(mt_haplo_list) > 0:
+        if len(y_haplo_list) > 0:
+            # 显示Y单倍群列表
+            result.append(yHaplo.to_html(y_haplo_list))
+
+            # 获取用户的Y家族信息
+            user_y_family_dict = {}
+            with timed(instrument, "family_lookup"):
+                y_dict = resource.get_y_dict()
+                # 只需要分型路径上的单倍群名，不必生成突变列表
+                y_path_haplo_list = (
+                    y_haplo_list[0].PathHaplo if y_dict != None else []
+                )
+                for y_haplo in y_path_haplo_list:
+                    if "hf" in y_dict[y_haplo]:
+                        user_y_family_dict[y_haplo] = y_dict[y_haplo]
+            if instrument != None and y_dict != None:
+                instrument.count("family_lookup", len(y_path_haplo_list))
+
+        if len(mt_haplo_list) > 0:
+            # 显示mt单倍群列表
+            result.append(mtHaplo.to_html(mt_haplo_list))
+
+        result.append(
+            "<div class='alert alert-info' style='margin-top: 10px;' role='alert'><ul>"
+        )
+
+        if len(y_haplo_list) > 0:
+            y_family_str = ""
+            if len(user_y_family_dict) > 0:
+                y_family_str += "上下游关联家族：<ul>"
+                for y in user_y_family_dict.keys():
+                    y_family_str += "<li>{} (共祖{}年)".format(
+                        y, user_y_family_dict[y]["a"]
+                    )
+                    for family_dict in user_y_family_dict[y]["hf"]:
+                        y_family_str += " <a href='https://www.23mofang.com/ancestry/family/{}' target='_blank' title='查看家族详情'>{}</a>".format(
+                            family_dict["fi"],
+                            family_dict["ft"],
+                        )
+                    y_family_str += "</li>"
+                y_family_str += "</ul>"
+            result.append(
+                "<li>您的Y父系单倍群最有可能是<span style='color: red;'>{}</span>，{}。{}</li>".format(
+                    y_haplo_list[0].Haplo,
+                    (
+                        "可信度较高"
+                        if y_haplo_list[0].HaploScore >= haplo_tol
+                        else "可信度较低，可能是由于您的微基因数据有误，或不适用于此分型计算器"
+                    ),
+                    y_family_str,
+                )
+            )
+
+        if len(mt_haplo_list) > 0:
+            result.append(
+                "<li>您的mt母系单倍群最有可能是<span style='color: red;'>{}</span>，{}。</li>".format(
+                    mt_haplo_list[0].Haplo,
+                    (
+                        "可信度较高"
+                        if mt_haplo_list[0].HaploScore >= haplo_tol
+                        else "可信度较低，可能是由于您的微基因数据有误，或不适用于此分型计算器"
+                    ),
+                )
+            )
+
+        result.append(
+            "<li>此单倍群分型计算器基于{}的{}{}{}。采用“均衡型策略”处理SNP假阳的情况。</li>".format(
+                source.upper(),
+                (
+                    "父系单倍群树（{:,}个单倍群）".format(yHaplo.HaploCount)
+                    if yHaplo != None
+                    else ""
+                ),
+                "，" if yHaplo != None and mtHaplo != None else "",
+                (
+                    "母系单倍群树（{:,}个单倍群）".format(mtHaplo.HaploCount)
+                    if mtHaplo != None
+                    else ""
+                ),
+            )
+        )
+        result.append(
+            "<li>此次分析使用您的微基因数据中{:,}个Y-SNP和{:,}个mt-SNP，不包含nocall和indel位点。</li>".format(
+                len(user_y_dict), len(user_mt_dict)
+            )
+        )
+        result.append(
+            "<li>非WeGene用户，可在<a href='http://geneu.xyz' target='_blank'>基因助手GeneU.xyz</a>上传样本使用此计算器。</li>"
+        )
+        result.append("</ul></div>")
+    else:
+        result.append(
+            "<div class='alert alert-warning' role='alert>您的微基因数据没有可用于单倍群分型的信息，请更换样本重试尝试。</div>"
+        )
+
+    return "".join(result)
+
+
+# 异常的错误信息
+def error_message(e: Exception) -> str:
+    return "".join(str(msg) for msg in e.args)
+
+
+# 请求指定的数据源列表，"source"可以是一个数据源或数据源列表，未指定时为None
+def request_sources(request: dict) -> list:
+    source_list = request.get("source")
+    if source_list == None:
+        return None
+    if isinstance(source_list, str):
+        return [source_list]
+    if not isinstance(source_list, list) or not all(
+        isinstance(source, str) for source in source_list
+    ):
+        raise Exception("请求的source应为数据源名或数据源名列表")
+    return source_list
+
+
+# 处理一个JSON请求，返回HTML
+def handle_request(
+    body: str, resource: HaploResource, instrument: Instrument = None
+) -> str:
+    request = json.loads(body)
+    return haplotype_inputs(
+        request["inputs"], resource, instrument, request_sources(request)
+    )
+
+
+# 设置了性能统计环境变量时，为每个请求创建性能统计对象
+def new_instrument() -> Instrument:
+    return Instrument() if instrument_enabled() else None
+
+
+# 单次运行：从 stdin 读取一个请求
+def run_once(resource: HaploResource):
+    # 从 stdin 读取输入数据
+    body = sys.stdin.read()
+    instrument = new_instrument()
+
+    try:
+        # 输出给用户的结果只需要通过 print 输出即可，print只可调用一次
+        print(handle_request(body, resource, instrument))
+
+    except Exception as e:
+        # 错误信息需要被从 stderr 中输出，否则会作为正常结果输出
+        for msg in e.args:
+            sys.stderr.write(msg)
+        exit(2)
+
+    finally:
+        # 性能统计只输出到 stderr
+        if instrument != None:
+            instrument.emit()
+
+
+# 常驻运行：从 stdin 逐行读取请求，按输入顺序逐行输出结果，同时处理的请求数不超过 workers 的两倍
+def serve_stdin(resource: HaploResource, workers: int):
+    def handle_line(line: str) -> dict:
+        request_id = None
+        instrument = new_instrument()
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            response = {
+                "result": haplotype_inputs(
+                    request["inputs"], resource, instrument, request_sources(request)
+                )
+            }
+        except Exception as e:
+            response = {"error": error_message(e)}
+        if request_id != None:
+            response["id"] = request_id
+        if instrument != None:
+            instrument.emit(id=request_id)
+        return response
+
+    def write_response(task):
+        sys.stdout.write(json.dumps(task.result(), ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        task_queue = deque()
+        for line in sys.stdin:
+            if line.strip() == "":
+                continue
+            task_queue.append(executor.submit(handle_line, line))
+            while len(task_queue) > workers * 2:
+                write_response(task_queue.popleft())
+        while len(task_queue) > 0:
+            write_response(task_queue.popleft())
+
+
+# 常驻运行：监听本地HTTP端口，POST请求体与 stdin 输入相同，同时处理的请求数不超过 workers
+def serve_http(resource: HaploResource, workers: int, host: str, port: int):
+    worker_semaphore = threading.BoundedSemaphore(workers)
+
+    class HaploRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            instrument = new_instrument()
+            with worker_semaphore:
+                try:
+                    status = 200
+                    content_type = "text/html; charset=utf-8"
+                    content = handle_request(body.decode("utf-8"), resource, instrument)
+                except Exception as e:
+                    status = 400
+                    content_type = "text/plain; charset=utf-8"
+                    content = error_message(e)
+            if instrument != None:
+                instrument.emit()
+            content = content.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    with ThreadingHTTPServer((host, port), HaploRequestHandler) as server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Y/mtDNA单倍群分型")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="常驻运行，从stdin逐行读取JSON请求，向stdout逐行输出JSON结果",
+    )
+    parser.add_argument(
+        "--http", metavar="HOST:PORT", help="常驻运行，监听本地HTTP端口"
+    )
+    parser.add_argument(
+        "--source",
+        default=source,
+        help="请求未指定source时使用的单倍群树数据源，默认为" + source,
+    )
+    parser.add_argument(
+        "--preload",
+        default="",
+        metavar="SOURCES",
+        help="常驻运行时另外预先加载的数据源，多个数据源用逗号分隔",
+    )
+    parser.add_argument(
+        "--tree-config",
+        metavar="FILE",
+        help='单倍群树配置JSON文件：{来源: {"y"|"mt": {"file": 文件名, 键名等参数}}}，Y的配置中可以用"dict"指定Y家族字典文件名',
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=0,
+        metavar="MB",
+        help="已加载单倍群树的内存预算，超过时淘汰最久未使用的树，默认不限制",
+    )
+    parser.add_argument(
+        "--result-cache",
+        type=int,
+        default=1024,
+        metavar="N",
+        help="常驻运行时内存中缓存的分型结果数，相同的Y或mt位点不再重复分型，0表示不缓存，默认为1024",
+    )
+    parser.add_argument(
+        "--result-cache-dir",
+        metavar="DIR",
+        help="分型结果的磁盘缓存目录，单次运行也可使用，默认不使用磁盘缓存",
+    )
+    parser.add_argument(
+        "--shared-tree-dir",
+        metavar="DIR",
+        help="单倍群树共享映像目录，同一台机器上的多个进程映射同一份编译结果，如/dev/shm/haplotree",
+    )
+    parser.add_argument(
+        "--subtree-workers",
+        type=int,
+        default=0,
+        metavar="N",
+        help="单个样本的分型拆分到N个进程同时计算子树，缩短很大的单倍群树的单个样本分型时间；默认不拆分",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        metavar="MS",
+        help="每个单倍群树的分析时间预算，毫秒。超过时返回当前最好的结果并注明结果可能不完整，默认不限时间",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=cpu_count() or 1,
+        help="常驻运行时同时处理的请求数，以及一个请求指定多个数据源时同时分析的单倍群树数，默认为CPU核数",
+    )
+    args = parser.parse_args()
+
+    # 单次运行只分析一次，内存缓存没有用处
+    result_cache_entries = (
+        args.result_cache if args.serve or args.http != None else 0
+    )
+    result_cache = None
+    if result_cache_entries > 0 or args.result_cache_dir != None:
+        result_cache = ResultCache(max(result_cache_entries, 0), args.result_cache_dir)
+    registry = TreeRegistry(
+        args.memory_budget << 20,
+        resultCache=result_cache,
+        sharedTreeDir=args.shared_tree_dir,
+        subtreeWorkers=args.subtree_workers,
+    )
+    if args.tree_config != None:
+        registry.load_config(args.tree_config)
+    resource = HaploResource(
+        args.source,
+        registry,
+        args.time_budget / 1000 if args.time_budget != None else None,
+        max(args.workers, 1),
+    )
+
+    if args.serve or args.http != None:
+        # 常驻运行时预先加载单倍群分型树和家族字典
+        for src in [args.source] + [
+            src.strip() for src in args.preload.split(",") if src.strip() != ""
+        ]:
+            resource.with_source(src).get_haplo("y")
+            resource.with_source(src).get_haplo("mt")
+            resource.with_source(src).get_y_dict()
+        workers = max(args.workers, 1)
+        if args.http != None:
+            host, port = args.http.rsplit(":", 1)
+            serve_http(resource, workers, host, int(port))
+        else:
+            serve_stdin(resource, workers)
+    else:
+        run_once(resource)
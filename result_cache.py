@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+
+# 单倍群分型结果缓存。内存中按最近使用顺序保存有限数量的结果，可选把结果保存为缓存目录中的JSON文件，进程重启后仍可使用。
+# 同一个键同时只计算一次，其它并发请求等待其结果。缓存的结果被所有命中的请求共享，不可修改
+class ResultCache:
+    # 内存中保存的结果数量上限，0表示不在内存中缓存
+    __max_entries: int = 0
+    # 磁盘缓存目录，None表示不使用磁盘缓存
+    __cache_dir: str = None
+    # 内存中的结果，按最近使用顺序排列，{键: 结果}
+    __entry_dict: OrderedDict = None
+    # 正在计算的键，{键: [完成事件, 结果, 异常]}
+    __pending_dict: dict = None
+    __hit_count: int = 0
+    __miss_count: int = 0
+    __lock: threading.Lock = None
+
+    @property
+    def MaxEntries(self):
+        return self.__max_entries
+
+    @property
+    def CacheDir(self):
+        return self.__cache_dir
+
+    @property
+    def HitCount(self):
+        return self.__hit_count
+
+    @property
+    def MissCount(self):
+        return self.__miss_count
+
+    def __len__(self):
+        return len(self.__entry_dict)
+
+    def __init__(self, maxEntries: int = 1024, cacheDir: str = None):
+        if maxEntries < 0:
+            raise Exception("结果缓存数量不能为负数")
+
+        self.__max_entries = maxEntries
+        self.__cache_dir = cacheDir
+        self.__entry_dict = OrderedDict()
+        self.__pending_dict = {}
+        self.__lock = threading.Lock()
+        if cacheDir != None:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    # 获取键对应的结果，内存和磁盘中都没有时调用compute计算并缓存。返回(结果, 是否命中缓存)
+    def get_or_compute(self, key: str, compute) -> tuple:
+        with self.__lock:
+            if key in self.__entry_dict:
+                self.__entry_dict.move_to_end(key)
+                self.__hit_count += 1
+                return self.__entry_dict[key], True
+            pending = self.__pending_dict.get(key)
+            is_owner = pending == None
+            if is_owner:
+                pending = [threading.Event(), None, None]
+                self.__pending_dict[key] = pending
+
+        # 同一个键正在计算时等待其结果，计算出错时抛出同样的异常
+        if not is_owner:
+            pending[0].wait()
+            if pending[2] != None:
+                raise pending[2]
+            with self.__lock:
+                self.__hit_count += 1
+            return pending[1], True
+
+        is_hit = False
+        is_done = False
+        try:
+            result = self.__read_disk(key)
+            is_hit = result != None
+            if not is_hit:
+                result = compute()
+                self.__write_disk(key, result)
+            pending[1] = result
+            is_done = True
+        except Exception as e:
+            pending[2] = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__pending_dict[key]
+                if is_done:
+                    if is_hit:
+                        self.__hit_count += 1
+                    else:
+                        self.__miss_count += 1
+                    self.__put(key, result)
+            if not is_done and pending[2] == None:
+                pending[2] = Exception("分型结果计算被中断")
+            pending[0].set()
+        return result, is_hit
+
+    # 获取键对应的结果，内存和磁盘中都没有时返回None，不计算
+    def get(self, key: str):
+        with self.__lock:
+            if key in self.__entry_dict:
+                self.__entry_dict.move_to_end(key)
+                self.__hit_count += 1
+                return self.__entry_dict[key]
+
+        result = self.__read_disk(key)
+        with self.__lock:
+            if result != None:
+                self.__hit_count += 1
+                self.__put(key, result)
+            else:
+                self.__miss_count += 1
+        return result
+
+    # 缓存在别处计算好的结果
+    def put(self, key: str, result):
+        self.__write_disk(key, result)
+        with self.__lock:
+            self.__put(key, result)
+
+    # 加入内存缓存，超过数量上限时淘汰最久未使用的结果，调用时需持有锁
+    def __put(self, key: str, result):
+        if self.__max_entries == 0:
+            return
+        self.__entry_dict[key] = result
+        self.__entry_dict.move_to_end(key)
+        while len(self.__entry_dict) > self.__max_entries:
+            self.__entry_dict.popitem(last=False)
+
+    # 磁盘缓存文件按键的前两个字符分目录，避免单个目录中的文件过多
+    def __disk_file_name(self, key: str) -> str:
+        return os.path.join(self.__cache_dir, key[:2], key + ".json")
+
+    # 读取磁盘缓存，不存在或损坏时返回None
+    def __read_disk(self, key: str):
+        if self.__cache_dir == None:
+            return None
+        try:
+            with open(self.__disk_file_name(key), "r", encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.warning("分型结果缓存不可用：{}".format(self.__disk_file_name(key)))
+            return None
+
+    # 写入磁盘缓存，先写临时文件再替换，避免并发读到不完整的文件；无法写入时只使用内存缓存
+    def __write_disk(self, key: str, result):
+        if self.__cache_dir == None:
+            return
+        cache_file_name = self.__disk_file_name(key)
+        tmp_file_name = "{}.{}.{}.tmp".format(
+            cache_file_name, os.getpid(), threading.get_ident()
+        )
+        try:
+            os.makedirs(os.path.dirname(cache_file_name), exist_ok=True)
+            with open(tmp_file_name, "w", encoding="utf-8") as cache_file:
+                json.dump(result, cache_file, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_file_name, cache_file_name)
+        except OSError:
+            logging.warning("分型结果缓存无法保存：{}".format(cache_file_name))
+            if os.access(tmp_file_name, os.F_OK):
+                os.remove(tmp_file_name)
+
+    # 清空内存缓存，磁盘缓存不变
+    def clear(self):
+        with self.__lock:
+            self.__entry_dict.clear()
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import mmap
+import struct
+from array import array
+
+"""
+编译后的单倍群分型树的共享映像。一个进程把编译结果写入映像文件，其它进程用mmap只读映射同一个文件，不再解析和复制单倍群分型树:
+    Haplotyping("haplotree/mf_y_snp_tree.json", "mf", "y", sharedTreeFileName="/dev/shm/mf_y_snp_tree.shm")
+映像文件放在/dev/shm等内存文件系统中时即为共享内存，同一台机器上所有工作进程的单倍群分型树只占用一份物理内存。
+"""
+
+# 映像文件头：标识、格式版本、头部JSON长度，之后是头部JSON和按8字节对齐的各个数组段
+_SHARED_TREE_MAGIC = b"HAPLOSHM"
+_SHARED_TREE_VERSION = 1
+_SHARED_TREE_HEAD = struct.Struct("<8sIQ")
+_SECTION_ALIGN = 8
+# 位置散列表的乘法散列常数
+_POS_HASH_MULTIPLIER = 2654435761
+
+
+# 对齐到映像的数组段边界
+def _align(offset: int) -> int:
+    return (offset + _SECTION_ALIGN - 1) // _SECTION_ALIGN * _SECTION_ALIGN
+
+
+# 规范的十进制位置可以按整数保存和二分查找，"0012"等其它写法的位置按原字符串保存
+def _is_canonical_pos(pos: str) -> bool:
+    return (
+        pos.isascii()
+        and pos.isdecimal()
+        and (pos[0] != "0" or len(pos) == 1)
+        and len(pos) < 19
+    )
+
+
+# 把字符串列表编码为(起始偏移数组, UTF-8数据)，第idx个字符串是data[offset[idx]:offset[idx+1]]
+def encode_string_list(str_list) -> tuple:
+    offset_array = array("q", [0])
+    data = bytearray()
+    for str_value in str_list:
+        data += str_value.encode("utf-8")
+        offset_array.append(len(data))
+    return offset_array, bytes(data)
+
+
+# 位置散列表的散列函数，乘法散列取高位，shift为32减去散列表大小的位数
+def _pos_hash(pos: int, shift: int) -> int:
+    return (pos * _POS_HASH_MULTIPLIER & 0xFFFFFFFF) >> shift
+
+
+# 把str位置键的位置倒排索引编码为(位置数组, SNP起始下标数组, SNP下标数组, 散列表位置数组, 散列表条目数组, 其它位置字典)。
+# 规范的十进制位置按整数排序保存，并建立开放寻址的散列表，查找时不需要反序列化为字典。
+# 散列表条目非负时是位置唯一的SNP下标，多数位置只有一个SNP，一次读取即可；为负时按位取反是位置在位置数组中的下标
+def encode_pos_index(pos_index) -> tuple:
+    pos_list = []
+    extra_dict = {}
+    for pos, snp_idx_list in pos_index.items():
+        if _is_canonical_pos(pos):
+            pos_list.append((int(pos), list(snp_idx_list)))
+        else:
+            extra_dict[pos] = list(snp_idx_list)
+    pos_list.sort()
+
+    pos_array = array("q")
+    start_array = array("i", [0])
+    snp_array = array("i")
+    for pos, snp_idx_list in pos_list:
+        pos_array.append(pos)
+        snp_array.extend(snp_idx_list)
+        start_array.append(len(snp_array))
+
+    # 散列表大小为2的幂，装载率不超过一半
+    hash_bits = max((len(pos_list) * 2).bit_length(), 4)
+    hash_mask = (1 << hash_bits) - 1
+    hash_pos = array("q", [-1]) * (hash_mask + 1)
+    hash_entry = array("i", [-1]) * (hash_mask + 1)
+    for pos_idx, pos in enumerate(pos_array):
+        slot = _pos_hash(pos, 32 - hash_bits)
+        while hash_pos[slot] != -1:
+            slot = (slot + 1) & hash_mask
+        hash_pos[slot] = pos
+        if start_array[pos_idx + 1] == start_array[pos_idx] + 1:
+            hash_entry[slot] = snp_array[start_array[pos_idx]]
+        else:
+            hash_entry[slot] = ~pos_idx
+    return pos_array, start_array, snp_array, hash_pos, hash_entry, extra_dict
+
+
+# 把derived突变列表编码为码位数组，不是单字符的derived突变为-1，与任何用户突变的码位都不相同
+def encode_allele_code(allele_list) -> array:
+    return array(
+        "i",
+        [
+            ord(allele) if isinstance(allele, str) and len(allele) == 1 else -1
+            for allele in allele_list
+        ],
+    )
+
+
+# 写入映像文件，header为可JSON序列化的头部信息，section_dict为{段名: array或bytes}。先写临时文件再替换，已映射旧文件的进程不受影响
+def write_shared_tree(file_name: str, header: dict, section_dict: dict):
+    section_info_dict = {}
+    section_offset = 0
+    for section_name, section in section_dict.items():
+        if isinstance(section, array):
+            typecode = section.typecode
+            section_size = len(section) * section.itemsize
+        else:
+            typecode = "B"
+            section_size = len(section)
+        section_info_dict[section_name] = [section_offset, section_size, typecode]
+        section_offset = _align(section_offset + section_size)
+
+    header = dict(header)
+    header["sections"] = section_info_dict
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    data_start = _align(_SHARED_TREE_HEAD.size + len(header_bytes))
+
+    tmp_file_name = "{}.{}.tmp".format(file_name, os.getpid())
+    try:
+        with open(tmp_file_name, "wb") as tree_file:
+            tree_file.write(
+                _SHARED_TREE_HEAD.pack(
+                    _SHARED_TREE_MAGIC, _SHARED_TREE_VERSION, len(header_bytes)
+                )
+            )
+            tree_file.write(header_bytes)
+            for section_name, section in section_dict.items():
+                tree_file.seek(data_start + section_info_dict[section_name][0])
+                tree_file.write(section)
+            # 最后一段为空时文件长度仍需覆盖所有段
+            tree_file.truncate(data_start + section_offset)
+        os.replace(tmp_file_name, file_name)
+    finally:
+        if os.access(tmp_file_name, os.F_OK):
+            os.remove(tmp_file_name)
+
+
+# 只读映射的映像文件，数组段以memoryview访问，不复制数据
+class SharedTree:
+    # 映像文件名
+    __file_name: str = None
+    # 只读映射
+    __mmap: mmap.mmap = None
+    # 头部信息
+    __header: dict = None
+    # 数组段的起始位置
+    __data_start: int = 0
+
+    @property
+    def FileName(self):
+        return self.__file_name
+
+    @property
+    def Header(self):
+        return self.__header
+
+    @property
+    def Size(self):
+        return len(self.__mmap)
+
+    def __init__(self, fileName: str):
+        self.__file_name = fileName
+        with open(fileName, "rb") as tree_file:
+            self.__mmap = mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.__mmap) < _SHARED_TREE_HEAD.size:
+            raise Exception("单倍群树共享映像不完整：" + fileName)
+        magic, version, header_size = _SHARED_TREE_HEAD.unpack_from(self.__mmap, 0)
+        if magic != _SHARED_TREE_MAGIC or version != _SHARED_TREE_VERSION:
+            raise Exception("单倍群树共享映像的格式不支持：" + fileName)
+        header_end = _SHARED_TREE_HEAD.size + header_size
+        self.__header = json.loads(
+            self.__mmap[_SHARED_TREE_HEAD.size : header_end].decode("utf-8")
+        )
+        self.__data_start = _align(header_end)
+        for section_offset, section_size, _ in self.__header["sections"].values():
+            if self.__data_start + section_offset + section_size > len(self.__mmap):
+                raise Exception("单倍群树共享映像不完整：" + fileName)
+
+    # 数组段的只读视图，按写入时的array类型访问
+    def array(self, section_name: str) -> memoryview:
+        section_offset, section_size, typecode = self.__header["sections"][
+            section_name
+        ]
+        section_start = self.__data_start + section_offset
+        return memoryview(self.__mmap)[
+            section_start : section_start + section_size
+        ].cast(typecode)
+
+    # 由encode_string_list写入的两个段组成的字符串列表
+    def string_list(self, section_name: str) -> "SharedStringList":
+        return SharedStringList(
+            self.array(section_name + "_offset"), self.array(section_name + "_data")
+        )
+
+    # 由encode_pos_index写入的段和头部中的其它位置组成的位置倒排索引
+    def pos_index(self, section_name: str) -> "SharedPosIndex":
+        return SharedPosIndex(
+            self.array(section_name + "_pos"),
+            self.array(section_name + "_start"),
+            self.array(section_name + "_snp"),
+            self.array(section_name + "_hash_pos"),
+            self.array(section_name + "_hash_entry"),
+            self.__header["pos_extra"][section_name],
+        )
+
+
+# 映像中的只读字符串列表，访问时才解码
+class SharedStringList:
+    # 每个字符串的起始偏移，末尾多一个结束偏移
+    __offset: memoryview = None
+    # UTF-8数据
+    __data: memoryview = None
+
+    def __init__(self, offset: memoryview, data: memoryview):
+        self.__offset = offset
+        self.__data = data
+
+    def __len__(self):
+        return len(self.__offset) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self.__offset) - 1
+        return str(self.__data[self.__offset[idx] : self.__offset[idx + 1]], "utf-8")
+
+    def __iter__(self):
+        for idx in range(len(self.__offset) - 1):
+            yield self[idx]
+
+
+# 映像中的只读位置倒排索引，规范的十进制位置在映像的散列表中查找，其它位置在头部的小字典中查找。
+# key_type为用户基因数据的位置键类型，与Haplotyping的str和int位置索引的匹配规则一致
+class SharedPosIndex:
+    # 有序的整数位置
+    __pos: memoryview = None
+    # 每个位置的SNP下标在__snp中的起始下标，末尾多一个结束下标
+    __start: memoryview = None
+    # SNP下标
+    __snp: memoryview = None
+    # 散列表中的位置，空槽为-1
+    __hash_pos: memoryview = None
+    # 散列表条目，非负时是位置唯一的SNP下标，为负时按位取反是位置在__pos中的下标
+    __hash_entry: memoryview = None
+    # 散列函数的右移位数
+    __hash_shift: int = 0
+    # 不能按整数保存的位置，{位置: SNP下标列表}，int键时只保留十进制位置并转为整数
+    __extra_dict: dict = None
+    # 位置键类型
+    __key_type: type = str
+
+    def __init__(
+        self,
+        pos: memoryview,
+        start: memoryview,
+        snp: memoryview,
+        hashPos: memoryview,
+        hashEntry: memoryview,
+        extraDict: dict,
+        keyType: type = str,
+    ):
+        self.__pos = pos
+        self.__start = start
+        self.__snp = snp
+        self.__hash_pos = hashPos
+        self.__hash_entry = hashEntry
+        self.__hash_shift = 32 - (len(hashPos).bit_length() - 1)
+        self.__key_type = keyType
+        if keyType == str:
+            self.__extra_dict = extraDict
+            return
+
+        # 转换为int键时"0012"与"12"相同，与按str键索引的插入顺序转换一样，保留首个SNP下标较大的位置
+        self.__extra_dict = {}
+        for pos, snp_idx_list in extraDict.items():
+            if not pos.isdecimal():
+                continue
+            pos = keyType(pos)
+            pos_snp_list = self.__find(pos)
+            if pos_snp_list == None or pos_snp_list[0] < snp_idx_list[0]:
+                self.__extra_dict[pos] = snp_idx_list
+
+    # 相同映像、另一种位置键类型的索引
+    def with_key_type(self, key_type: type) -> "SharedPosIndex":
+        if key_type == self.__key_type:
+            return self
+        if self.__key_type != str:
+            raise Exception("只能由str位置键的索引转换")
+        return SharedPosIndex(
+            self.__pos,
+            self.__start,
+            self.__snp,
+            self.__hash_pos,
+            self.__hash_entry,
+            self.__extra_dict,
+            key_type,
+        )
+
+    def __len__(self):
+        return len(self.__pos) + len(self.__extra_dict)
+
+    # 散列表条目对应的SNP下标列表
+    def __entry_snp_list(self, entry: int) -> list:
+        if entry >= 0:
+            return [entry]
+        pos_idx = ~entry
+        return self.__snp[self.__start[pos_idx] : self.__start[pos_idx + 1]].tolist()
+
+    # 在散列表中查找整数位置的SNP下标列表，没有时返回None
+    def __find(self, pos: int) -> list:
+        if pos < 0:
+            return None
+        hash_pos = self.__hash_pos
+        hash_mask = len(hash_pos) - 1
+        slot = _pos_hash(pos, self.__hash_shift)
+        while hash_pos[slot] != pos:
+            if hash_pos[slot] == -1:
+                return None
+            slot = (slot + 1) & hash_mask
+        return self.__entry_snp_list(self.__hash_entry[slot])
+
+    # 位置的SNP下标列表，没有时返回default
+    def get(self, pos, default=None):
+        if pos in self.__extra_dict:
+            return self.__extra_dict[pos]
+        if self.__key_type == str:
+            if type(pos) != str or not _is_canonical_pos(pos):
+                return default
+            pos = int(pos)
+        elif type(pos) != self.__key_type:
+            return default
+        snp_idx_list = self.__find(pos)
+        return snp_idx_list if snp_idx_list != None else default
+
+    def __contains__(self, pos) -> bool:
+        return self.get(pos) != None
+
+    def __getitem__(self, pos) -> list:
+        snp_idx_list = self.get(pos)
+        if snp_idx_list == None:
+            raise KeyError(pos)
+        return snp_idx_list
+
+    def items(self):
+        key_type = self.__key_type
+        start = self.__start
+        extra_dict = self.__extra_dict
+        for pos_idx, pos in enumerate(self.__pos):
+            pos = key_type(pos)
+            if pos not in extra_dict:
+                yield pos, self.__snp[start[pos_idx] : start[pos_idx + 1]].tolist()
+        yield from extra_dict.items()
+
+    # 用户位置与索引位置的交集，[(SNP下标列表, 用户突变)]，从用户位置和索引位置中较少的一方查找。用户突变只取首字符，并统一为大写
+    def find_hits(self, user_genome: dict) -> list:
+        if len(user_genome) > len(self):
+            return [
+                (snp_idx_list, user_genome[pos][0].upper())
+                for pos, snp_idx_list in self.items()
+                if pos in user_genome
+            ]
+
+        extra_dict = self.__extra_dict
+        is_str_key = self.__key_type == str
+        hash_pos = self.__hash_pos
+        hash_entry = self.__hash_entry
+        hash_mask = len(hash_pos) - 1
+        hash_shift = self.__hash_shift
+        hit_list = []
+        # 散列函数内联在循环中。str位置先转为整数查找，找到后再确认是规范写法，"0012"、"+12"等只可能在其它位置字典中
+        for pos, genotype in user_genome.items():
+            if extra_dict and pos in extra_dict:
+                hit_list.append((extra_dict[pos], genotype[0].upper()))
+                continue
+            try:
+                pos_int = int(pos) if is_str_key else pos
+                slot = (pos_int * _POS_HASH_MULTIPLIER & 0xFFFFFFFF) >> hash_shift
+            except (TypeError, ValueError):
+                continue
+            if pos_int < 0:
+                continue
+            slot_pos = hash_pos[slot]
+            while slot_pos != pos_int:
+                if slot_pos == -1:
+                    break
+                slot = (slot + 1) & hash_mask
+                slot_pos = hash_pos[slot]
+            else:
+                if is_str_key and str(pos_int) != pos:
+                    continue
+                entry = hash_entry[slot]
+                hit_list.append(
+                    (
+                        [entry] if entry >= 0 else self.__entry_snp_list(entry),
+                        genotype[0].upper(),
+                    )
+                )
+        return hit_list
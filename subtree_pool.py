@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from haplotyping import Haplotyping
+
+"""
+单个样本分型的子树进程池，用于很大的单倍群分型树，缩短单个样本的分型时间:
+    pool = SubtreePool(haplo, workers=4)
+    haplo.analyse(user_genome, subtreePool=pool)
+单倍群分型树在第splitDepth层拆分为workers组先序相邻的子树，每个工作进程用相同的参数加载同一棵树（有共享映像时直接映射）。
+分析时各组子树的SNP检测和路径统计在工作进程中同时计算，根部的单倍群由主进程计算，合并后的结果与不拆分时相同。
+每次分析都要在进程间传递交集和统计，交集较小时比直接分析慢，交集位置数少于minHits的分析不使用进程池。
+"""
+
+# 工作进程的单倍群分型对象，每个进程只加载一次
+_worker_haplo: Haplotyping = None
+
+
+# 工作进程初始化，加载与主进程相同的单倍群分型树，版本不一致时无法合并结果
+def _init_worker(tree_option_dict: dict, timestamp: str, haplo_count: int):
+    global _worker_haplo
+    _worker_haplo = Haplotyping(**tree_option_dict, instrument=False)
+    if _worker_haplo.Timestamp != timestamp or _worker_haplo.HaploCount != haplo_count:
+        raise Exception("工作进程加载的单倍群树版本与主进程不一致")
+
+
+# 在工作进程中计算一组子树
+def _check_subtree(
+    node_range: tuple, split_depth: int, snp_idx_arr: array, alleles: str
+) -> tuple:
+    return _worker_haplo.check_subtree(node_range, split_depth, snp_idx_arr, alleles)
+
+
+class SubtreePool:
+    # 子树所属的单倍群分型对象
+    __haplo_obj: Haplotyping = None
+    # 工作进程数，也是子树的组数
+    __workers: int = 0
+    # 拆分的层级，深度小于此层级的根部单倍群由主进程计算
+    __split_depth: int = 0
+    # 每组子树的先序范围，[(起始节点下标, 结束节点下标)]
+    __node_range_list: list = None
+    # 每个SNP所属的组，根部的SNP为-1
+    __snp_part: array = None
+    # 使用进程池的最少交集位置数，交集较小时进程间传递的开销超过并行节省的时间，直接在本进程分析
+    __min_hits: int = 20000
+    __executor: ProcessPoolExecutor = None
+
+    @property
+    def HaploObj(self):
+        return self.__haplo_obj
+
+    @property
+    def Workers(self):
+        return self.__workers
+
+    @property
+    def SplitDepth(self):
+        return self.__split_depth
+
+    @property
+    def NodeRanges(self):
+        return self.__node_range_list
+
+    @property
+    def SnpPart(self):
+        return self.__snp_part
+
+    @property
+    def MinHits(self):
+        return self.__min_hits
+
+    def __init__(
+        self,
+        haploObj: Haplotyping,
+        workers: int = None,
+        splitDepth: int = None,
+        minHits: int = None,
+    ):
+        if workers == None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise Exception("工作进程数至少为1")
+
+        self.__haplo_obj = haploObj
+        if minHits != None:
+            self.__min_hits = minHits
+        self.__split_depth, self.__node_range_list, self.__snp_part = (
+            haploObj.split_subtrees(workers, splitDepth)
+        )
+        self.__workers = min(workers, max(len(self.__node_range_list), 1))
+        self.__executor = ProcessPoolExecutor(
+            max_workers=self.__workers,
+            initializer=_init_worker,
+            initargs=(haploObj.TreeOptions, haploObj.Timestamp, haploObj.HaploCount),
+        )
+
+    # 提交一组子树的计算，snpIdxArray和alleles为根部和此组子树的交集SNP下标和对应的用户突变。
+    # 进程池已关闭时（如树已被注册表淘汰，分析仍在进行）在本进程计算，返回已完成的Future
+    def submit(self, part: int, snpIdxArray: array, alleles: str) -> Future:
+        try:
+            return self.__executor.submit(
+                _check_subtree,
+                self.__node_range_list[part],
+                self.__split_depth,
+                snpIdxArray,
+                alleles,
+            )
+        except RuntimeError:
+            future = Future()
+            future.set_result(
+                self.__haplo_obj.check_subtree(
+                    self.__node_range_list[part],
+                    self.__split_depth,
+                    snpIdxArray,
+                    alleles,
+                )
+            )
+            return future
+
+    # 关闭工作进程，wait为False时不等待已提交的计算完成，已提交的计算仍会完成
+    def close(self, wait: bool = True):
+        self.__executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
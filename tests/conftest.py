@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# 测试直接导入仓库根目录的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
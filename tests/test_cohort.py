@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import json
+import random
+
+import pytest
+
+import cohort
+from haplotyping import Haplotyping
+from tree_factory import gen_genome, gen_tree
+
+pytest.importorskip("numpy")
+
+
+# 在临时目录中准备单倍群树和样本，单倍群树按相对路径查找。返回 (样本目录, {y|mt: 单倍群树JSON})
+@pytest.fixture
+def cohort_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(1)
+    tree_dict = {}
+    snp_list_dict = {}
+    for is_y_mt in ("y", "mt"):
+        tree_dict[is_y_mt], snp_list_dict[is_y_mt] = gen_tree(rng, node_count=300)
+    _write_trees("haplotree", tree_dict)
+
+    os.makedirs("samples")
+    for sample_idx in range(7):
+        with open("samples/s{}.txt".format(sample_idx), "w") as sample_file:
+            sample_file.write("# rsid\tchromosome\tposition\tgenotype\n")
+            for is_y_mt, chromosome in (("y", "Y"), ("mt", "MT")):
+                user_genome = gen_genome(rng, snp_list_dict[is_y_mt], cover=0.5)
+                for pos, genotype in user_genome.items():
+                    sample_file.write(
+                        "rs{}\t{}\t{}\t{}\n".format(pos, chromosome, pos, genotype)
+                    )
+    # 无法识别格式的样本记录为错误，不影响其它样本
+    with open("samples/broken.txt", "w") as sample_file:
+        sample_file.write("not a genome file\n")
+    return "samples", tree_dict
+
+
+def _write_trees(tree_dir: str, tree_dict: dict):
+    os.makedirs(tree_dir, exist_ok=True)
+    for is_y_mt, haplo_tree in tree_dict.items():
+        with open(
+            os.path.join(tree_dir, "mf_{}_snp_tree.json".format(is_y_mt)), "w"
+        ) as tree_file:
+            json.dump(haplo_tree, tree_file)
+
+
+def _run(sample_dir: str, output_file_name: str, result_format="jsonl", **kwargs):
+    cohort.run(
+        sample_dir,
+        output_file_name,
+        result_format,
+        workers=1,
+        source="mf",
+        genome_ref="hg19",
+        chunk_size=2,
+        checkpoint_every=1,
+        **kwargs
+    )
+
+
+def _read_lines(file_name: str) -> list:
+    with open(file_name, "r", encoding="utf-8") as result_file:
+        return result_file.read().splitlines()
+
+
+# 中断时最后一行只写了一半，重新运行去掉不完整的行，只分型未完成的样本，结果与一次完成的相同
+@pytest.mark.parametrize("result_format", ["jsonl", "csv"])
+def test_resume_after_interruption(cohort_dir, result_format):
+    sample_dir, _ = cohort_dir
+    _run(sample_dir, "full." + result_format, result_format)
+    full_line_list = _read_lines("full." + result_format)
+    assert len(full_line_list) == 8 + (result_format == "csv")
+    assert any(
+        "broken.txt" in line and "无法识别的基因数据文件格式" in line
+        for line in full_line_list
+    )
+
+    with open("resumed." + result_format, "w", encoding="utf-8") as result_file:
+        result_file.write("\n".join(full_line_list[:4]) + "\n")
+        result_file.write(full_line_list[4][: len(full_line_list[4]) // 2])
+    _run(sample_dir, "resumed." + result_format, result_format)
+    resumed_line_list = _read_lines("resumed." + result_format)
+    assert resumed_line_list[:4] == full_line_list[:4]
+    assert sorted(resumed_line_list) == sorted(full_line_list)
+
+    # 全部完成后再次运行不重复写入
+    _run(sample_dir, "resumed." + result_format, result_format)
+    assert _read_lines("resumed." + result_format) == resumed_line_list
+
+
+# 单倍群树更新后沿用上次的结果，只重新分型受影响的样本，结果与用新树全部重新分型的相同
+def test_previous_results(cohort_dir):
+    sample_dir, tree_dict = cohort_dir
+    _run(sample_dir, "old.jsonl")
+    _write_trees("old_haplotree", tree_dict)
+
+    rng = random.Random(2)
+    new_tree_dict = copy.deepcopy(tree_dict)
+    for is_y_mt in ("y", "mt"):
+        tree_node = new_tree_dict[is_y_mt]["tree"]
+        while len(tree_node.get("c", [])) > 0 and rng.random() < 0.9:
+            tree_node = rng.choice(tree_node["c"])
+        tree_node.setdefault("c", []).append(
+            {
+                "n": "NEW",
+                "m": [{"v": "X1", "p19": 1, "p38": 8, "p": 1, "a": "A", "d": "G"}],
+            }
+        )
+    _write_trees("haplotree", new_tree_dict)
+
+    _run(sample_dir, "new.jsonl")
+    _run(
+        sample_dir,
+        "reused.jsonl",
+        previous_file_name="old.jsonl",
+        old_tree_dir="old_haplotree",
+    )
+    assert sorted(_read_lines("reused.jsonl")) == sorted(_read_lines("new.jsonl"))
+
+    with pytest.raises(Exception):
+        _run(
+            sample_dir,
+            "old.jsonl",
+            previous_file_name="old.jsonl",
+            old_tree_dir="old_haplotree",
+        )
+
+
+# 一组样本中一个样本分型出错时，只有该样本记录错误，同组其它样本的结果不变
+def test_sample_error_in_chunk(cohort_dir, monkeypatch):
+    sample_dir, _ = cohort_dir
+    # 含有标记位点的样本分型时出错
+    marker_pos = "999999999"
+    with open(os.path.join(sample_dir, "s3.txt"), "a") as sample_file:
+        sample_file.write("rs{0}\tY\t{0}\tA\n".format(marker_pos))
+
+    for name in ("_worker_resource", "_worker_genome_ref", "_worker_tree_diff_dict"):
+        monkeypatch.setattr(cohort, name, getattr(cohort, name))
+    cohort._init_worker("mf", "hg19")
+    sample_list = [
+        (sample_name, file_path, None)
+        for sample_name, file_path in cohort.list_samples(sample_dir)
+    ]
+    expected_list, _ = cohort._type_samples(sample_list)
+
+    analyse_batch = Haplotyping.analyse_batch
+
+    def failing_analyse_batch(self, user_genome_list, *args, **kwargs):
+        if any(marker_pos in user_genome for user_genome in user_genome_list):
+            raise Exception("标记位点")
+        return analyse_batch(self, user_genome_list, *args, **kwargs)
+
+    monkeypatch.setattr(Haplotyping, "analyse_batch", failing_analyse_batch)
+    record_list, typed_count = cohort._type_samples(sample_list)
+    assert typed_count == len(sample_list)
+    assert len(record_list) == len(expected_list)
+    for record, expected in zip(
+        sorted(record_list, key=lambda record: record["sample"]),
+        sorted(expected_list, key=lambda record: record["sample"]),
+    ):
+        if record["sample"] == "s3.txt":
+            assert record == {"sample": "s3.txt", "error": "标记位点"}
+        else:
+            assert record == expected
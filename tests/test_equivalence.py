@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+import baseline_haplotyping
+from haplotyping import Haplotyping
+from subtree_pool import SubtreePool
+from tree_factory import gen_genome, gen_tree, result_key, write_tree
+
+"""
+各种分析方式的结果必须与优化前的递归深度优先分型完全相同，包括结果顺序、同分结果的先后、分型路径和路径上的用户突变。
+单倍群树、用户数据和分型规则参数都随机生成，相同的种子生成相同的数据。
+"""
+
+
+# 一组随机的单倍群树和分析：(单倍群树文件名, y|mt, 分型规则参数, [(用户基因数据, 参考基因组)])。
+# dup_name_rate不为0时，不同分支上有重名的单倍群
+def _gen_case(
+    tmp_path, seed: int, node_count_list: list = None, dup_name_rate: float = 0.0
+) -> tuple:
+    rng = random.Random(seed)
+    haplo_tree, snp_list = gen_tree(
+        rng,
+        node_count=rng.choice(node_count_list or [5, 30, 300, 1500]),
+        max_children=rng.choice([2, 4, 8]),
+        dup_name_rate=dup_name_rate,
+    )
+    tree_file_name = write_tree(tmp_path, "tree_{}.json".format(seed), haplo_tree)
+    is_y_mt = rng.choice(["y", "mt"])
+    option_dict = dict(
+        confirmedPositiveHaplo=rng.choice([0, 1, 3, 5]),
+        allowedNegativeHaplo=rng.choice([-1, 0, 1, 2, 4]),
+        maxHaploCount=rng.choice([1, 3, 5, 20]),
+    )
+    genome_list = []
+    for _ in range(3):
+        genome_ref = rng.choice(["hg19", "hg38"])
+        user_genome = gen_genome(
+            rng,
+            snp_list,
+            cover=rng.choice([0.1, 0.5, 1.0]),
+            der_rate=rng.choice([0.05, 0.3, 0.8]),
+            pos_shift=7 if is_y_mt == "y" and genome_ref == "hg38" else 0,
+        )
+        if len(user_genome) > 0:
+            genome_list.append((user_genome, genome_ref))
+    return tree_file_name, is_y_mt, option_dict, genome_list
+
+
+# 用一组分析的单倍群树和分型规则参数创建单倍群分型对象
+def _new_haplo(case: tuple, **options) -> Haplotyping:
+    tree_file_name, is_y_mt, option_dict, _ = case
+    return Haplotyping(tree_file_name, "mf", is_y_mt, **option_dict, **options)
+
+
+# 优化前的分型结果，每次分析用新的对象，旧实现会把用户突变写入单倍群树
+def _baseline(case: tuple, user_genome: dict, genome_ref: str) -> list:
+    tree_file_name, is_y_mt, option_dict, _ = case
+    baseline_haplo = baseline_haplotyping.Haplotyping(
+        tree_file_name, "mf", is_y_mt, **option_dict
+    )
+    return result_key(baseline_haplo.analyse(user_genome, genome_ref), True)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_analyse(tmp_path, seed):
+    case = _gen_case(tmp_path, seed)
+    haplo = _new_haplo(case)
+    # 第二个对象从预编译缓存加载
+    cached_haplo = _new_haplo(case)
+    for user_genome, genome_ref in case[3]:
+        expected = _baseline(case, user_genome, genome_ref)
+        assert result_key(haplo.analyse(user_genome, genome_ref), True) == expected
+        assert result_key(haplo.analyse(user_genome, genome_ref), True) == expected
+        assert (
+            result_key(cached_haplo.analyse(user_genome, genome_ref), True) == expected
+        )
+        int_genome = {int(pos): genotype for pos, genotype in user_genome.items()}
+        assert result_key(haplo.analyse(int_genome, genome_ref), True) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_analyse_batch(tmp_path, seed):
+    pytest.importorskip("numpy")
+    case = _gen_case(tmp_path, seed)
+    haplo = _new_haplo(case, useTreeCache=False)
+    for user_genome, genome_ref in case[3]:
+        expected = _baseline(case, user_genome, genome_ref)
+        haplo_list_list = haplo.analyse_batch(
+            [user_genome, {}, user_genome], genome_ref
+        )
+        assert haplo_list_list[1] == []
+        assert result_key(haplo_list_list[0], True) == expected
+        assert result_key(haplo_list_list[2], True) == expected
+
+
+# 单倍群名不唯一时，候选结果与当前结果中的单倍群同名才不加入，同名结果被淘汰后可以再加入同名的候选结果
+@pytest.mark.parametrize("seed", range(40))
+def test_duplicate_names(tmp_path, seed):
+    case = _gen_case(tmp_path, seed, dup_name_rate=0.3)
+    haplo = _new_haplo(case, useTreeCache=False)
+    for user_genome, genome_ref in case[3]:
+        expected = _baseline(case, user_genome, genome_ref)
+        assert result_key(haplo.analyse(user_genome, genome_ref), True) == expected
+        haplo_snapshot = haplo.analyse(user_genome, genome_ref, workBudget=10 ** 9)
+        assert result_key(haplo_snapshot, True) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_duplicate_names_batch(tmp_path, seed):
+    pytest.importorskip("numpy")
+    case = _gen_case(tmp_path, seed, dup_name_rate=0.3)
+    haplo = _new_haplo(case, useTreeCache=False)
+    for user_genome, genome_ref in case[3]:
+        expected = _baseline(case, user_genome, genome_ref)
+        haplo_list_list = haplo.analyse_batch([user_genome, {}], genome_ref)
+        assert result_key(haplo_list_list[0], True) == expected
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_duplicate_names_subtree_pool(tmp_path, seed):
+    case = _gen_case(tmp_path, seed, [300, 1500], dup_name_rate=0.3)
+    haplo = _new_haplo(case, useTreeCache=False)
+    with SubtreePool(haplo, 2, minHits=0) as subtree_pool:
+        for user_genome, genome_ref in case[3]:
+            expected = _baseline(case, user_genome, genome_ref)
+            haplo_list = haplo.analyse(user_genome, genome_ref, subtreePool=subtree_pool)
+            assert result_key(haplo_list, True) == expected
+
+
+# 单倍群P与已在结果中的X同名，P的第一个终端节点L1的候选结果不加入；X被P的下游单倍群淘汰后，P的最后一个终端节点L2的候选结果加入，分型路径经过L2
+def test_duplicate_name_later_end_node(tmp_path):
+    def node(name: str, pos_list: list, child_list: list = None) -> dict:
+        tree_node = {
+            "n": name,
+            "m": [
+                {"v": "s{}".format(pos), "p19": pos, "p38": pos, "p": pos}
+                for pos in pos_list
+            ],
+        }
+        for snp_dict in tree_node["m"]:
+            snp_dict.update({"a": "A", "d": "G"})
+        if child_list != None:
+            tree_node["c"] = child_list
+        return tree_node
+
+    haplo_tree = {
+        "timestamp": "t1",
+        "tree": node(
+            "R",
+            [1],
+            [
+                node("Q", [10, 11, 12]),
+                node("A", [20]),
+                node(
+                    "A",
+                    [30, 31, 32, 33, 34],
+                    [
+                        node("L1", [40]),
+                        node("Y", [50]),
+                        node("Z", [60]),
+                        node("L2", [70]),
+                    ],
+                ),
+            ],
+        ),
+    }
+    user_genome = {
+        str(pos): "GG" for pos in (10, 11, 12, 20, 30, 31, 32, 33, 34, 50, 60)
+    }
+    case = (
+        write_tree(tmp_path, "tree.json", haplo_tree),
+        "y",
+        dict(confirmedPositiveHaplo=1, allowedNegativeHaplo=-1, maxHaploCount=3),
+        [(user_genome, "hg19")],
+    )
+    expected = _baseline(case, user_genome, "hg19")
+    assert [haplo_key[0] for haplo_key in expected] == ["Y", "Z", "A"]
+    assert expected[2][4][0][0] == "L2"
+
+    haplo = _new_haplo(case, useTreeCache=False)
+    assert result_key(haplo.analyse(user_genome), True) == expected
+    haplo_snapshot = haplo.analyse(user_genome, workBudget=10 ** 9)
+    assert result_key(haplo_snapshot, True) == expected
+    with SubtreePool(haplo, 2, minHits=0) as subtree_pool:
+        haplo_list = haplo.analyse(user_genome, subtreePool=subtree_pool)
+        assert result_key(haplo_list, True) == expected
+    # 批量分析需要numpy
+    pytest.importorskip("numpy")
+    assert result_key(haplo.analyse_batch([user_genome])[0], True) == expected
+
+
+# 第一个对象发布共享映像，第二个对象直接映射
+@pytest.mark.parametrize("seed", range(20))
+def test_shared_tree(tmp_path, seed):
+    case = _gen_case(tmp_path, seed)
+    shared_tree_file_name = str(tmp_path / "tree.shm")
+    publisher = _new_haplo(case, sharedTreeFileName=shared_tree_file_name)
+    haplo = _new_haplo(case, sharedTreeFileName=shared_tree_file_name)
+    assert haplo.SharedTreeFileName == shared_tree_file_name
+    assert haplo.node_snapshot() == publisher.node_snapshot()
+    for user_genome, genome_ref in case[3]:
+        expected = _baseline(case, user_genome, genome_ref)
+        assert result_key(publisher.analyse(user_genome, genome_ref), True) == expected
+        assert result_key(haplo.analyse(user_genome, genome_ref), True) == expected
+        int_genome = {int(pos): genotype for pos, genotype in user_genome.items()}
+        assert result_key(haplo.analyse(int_genome, genome_ref), True) == expected
+
+
+# 每棵树创建一个进程池，不限制交集大小，使小树的分析也在工作进程中计算；进程池关闭后在本进程计算各组子树
+@pytest.mark.parametrize("seed", range(8))
+def test_subtree_pool(tmp_path, seed):
+    case = _gen_case(tmp_path, seed, [30, 300, 1500])
+    haplo = _new_haplo(case, useTreeCache=False)
+    subtree_pool = SubtreePool(haplo, 1 + seed % 3, minHits=0)
+    with subtree_pool:
+        for user_genome, genome_ref in case[3]:
+            expected = _baseline(case, user_genome, genome_ref)
+            haplo_list = haplo.analyse(user_genome, genome_ref, subtreePool=subtree_pool)
+            assert result_key(haplo_list, True) == expected
+    for user_genome, genome_ref in case[3]:
+        expected = _baseline(case, user_genome, genome_ref)
+        haplo_list = haplo.analyse(user_genome, genome_ref, subtreePool=subtree_pool)
+        assert result_key(haplo_list, True) == expected
+
+
+# 预算足够时最后的结果与完整分析相同，之前的结果都标记为不完整；没有预算时不搜索任何子树
+@pytest.mark.parametrize("seed", range(30))
+def test_progressive(tmp_path, seed):
+    case = _gen_case(tmp_path, seed)
+    haplo = _new_haplo(case, useTreeCache=False)
+    for user_genome, genome_ref in case[3]:
+        expected = _baseline(case, user_genome, genome_ref)
+        snapshot_list = list(
+            haplo.analyse_progressive(user_genome, genome_ref, timeBudget=1000)
+        )
+        assert not snapshot_list[-1].Partial
+        assert all(snapshot.Partial for snapshot in snapshot_list[:-1])
+        assert all(len(snapshot) <= haplo.MaxHaploCount for snapshot in snapshot_list)
+        assert result_key(snapshot_list[-1], True) == expected
+        haplo_snapshot = haplo.analyse(user_genome, genome_ref, workBudget=10 ** 9)
+        assert result_key(haplo_snapshot, True) == expected
+
+        haplo_snapshot = haplo.analyse(user_genome, genome_ref, workBudget=0)
+        assert haplo_snapshot.ExploredClades == 0
+        assert haplo_snapshot.Partial == (haplo_snapshot.TotalClades > 0)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import random
+
+import pytest
+
+from family_dict import YFamilyDict
+
+
+# 随机生成Y家族字典 {单倍群: {"a": 共祖年代, "hf": [{"fi": 家族ID, "ft": 家族名}]}}
+def _gen_y_dict(rng: random.Random, haplo_count: int = 200) -> dict:
+    y_dict = {}
+    for haplo_idx in range(haplo_count):
+        haplo = "H{}".format(haplo_idx + 1)
+        y_dict[haplo] = {"a": str(rng.randint(100, 5000))}
+        if rng.random() < 0.3:
+            y_dict[haplo]["hf"] = [
+                {"fi": rng.randint(1, 999), "ft": "家族{}".format(haplo_idx)}
+            ]
+    return y_dict
+
+
+def _write_dict(dict_file_name: str, dict_json: dict):
+    with open(dict_file_name, "w", encoding="utf-8") as dict_file:
+        json.dump(dict_json, dict_file, ensure_ascii=False)
+
+
+def _assert_same(family_dict: YFamilyDict, y_dict: dict):
+    for haplo, value in y_dict.items():
+        assert family_dict[haplo] == value
+        assert family_dict.get(haplo) == value
+        assert haplo in family_dict
+    for haplo in ("H0", "NOT_EXIST", ""):
+        assert family_dict.get(haplo) == None
+        assert haplo not in family_dict
+        with pytest.raises(KeyError):
+            family_dict[haplo]
+
+
+# 由JSON文件建立索引，查询结果与解析整个JSON文件的字典相同，字典可以包在"dict"中
+@pytest.mark.parametrize("wrapped", [True, False])
+def test_build_index(tmp_path, wrapped):
+    y_dict = _gen_y_dict(random.Random(1))
+    dict_file_name = str(tmp_path / "y_dict.json")
+    _write_dict(dict_file_name, {"dict": y_dict} if wrapped else y_dict)
+
+    _assert_same(YFamilyDict(dict_file_name), y_dict)
+    assert os.access(dict_file_name + ".sqlite", os.F_OK)
+    with pytest.raises(Exception):
+        YFamilyDict(str(tmp_path / "missing.json"))
+
+
+# Y家族字典文件更新后重新建立索引
+def test_rebuild_when_dict_changed(tmp_path):
+    rng = random.Random(2)
+    y_dict = _gen_y_dict(rng)
+    dict_file_name = str(tmp_path / "y_dict.json")
+    _write_dict(dict_file_name, y_dict)
+    _assert_same(YFamilyDict(dict_file_name), y_dict)
+    index_stat = os.stat(dict_file_name + ".sqlite")
+
+    # 未变化时使用已有的索引
+    _assert_same(YFamilyDict(dict_file_name), y_dict)
+    assert os.stat(dict_file_name + ".sqlite").st_mtime_ns == index_stat.st_mtime_ns
+
+    # 内容和大小都不变、只有修改时间变化也重新建立
+    dict_stat = os.stat(dict_file_name)
+    os.utime(
+        dict_file_name, ns=(dict_stat.st_atime_ns, dict_stat.st_mtime_ns + 10 ** 9)
+    )
+    _assert_same(YFamilyDict(dict_file_name), y_dict)
+    assert os.stat(dict_file_name + ".sqlite").st_ino != index_stat.st_ino
+
+    new_y_dict = _gen_y_dict(rng, 150)
+    new_y_dict["NEW"] = {"a": "1"}
+    _write_dict(dict_file_name, new_y_dict)
+    _assert_same(YFamilyDict(dict_file_name), new_y_dict)
+
+
+# 损坏的索引文件重新建立
+def test_corrupt_index(tmp_path):
+    y_dict = _gen_y_dict(random.Random(3))
+    dict_file_name = str(tmp_path / "y_dict.json")
+    _write_dict(dict_file_name, y_dict)
+    with open(dict_file_name + ".sqlite", "wb") as index_file:
+        index_file.write(b"not a sqlite file" * 100)
+    _assert_same(YFamilyDict(dict_file_name), y_dict)
+    _assert_same(YFamilyDict(dict_file_name), y_dict)
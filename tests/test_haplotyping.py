@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import random
+
+from haplotyping import Haplotyping
+from tree_factory import gen_genome, gen_tree, result_key, write_tree
+
+
+# 解析JSON并编译后不保留单倍群分型树，访问HaploTree时再加载，分析结果不变
+def test_compiled_tree_drops_parsed_json(tmp_path):
+    rng = random.Random(1)
+    haplo_tree, snp_list = gen_tree(rng, node_count=300)
+    haplo = Haplotyping(
+        write_tree(tmp_path, "tree.json", haplo_tree), "mf", "y", useTreeCache=False
+    )
+    user_genome = gen_genome(rng, snp_list)
+    expected = result_key(haplo.analyse(user_genome))
+    memory_size = haplo.MemorySize
+
+    assert haplo.HaploTree["n"] == haplo_tree["tree"]["n"]
+    assert haplo.MemorySize > memory_size
+    assert result_key(haplo.analyse(user_genome)) == expected
+
+
+# HaplogroupList和str()兼容旧接口，是最近一次分析的结果
+def test_last_result_shim(tmp_path):
+    rng = random.Random(2)
+    haplo_tree, snp_list = gen_tree(rng, node_count=300)
+    haplo = Haplotyping(
+        write_tree(tmp_path, "tree.json", haplo_tree), "mf", "y", useTreeCache=False
+    )
+    assert haplo.HaplogroupList == None
+    assert str(haplo) == ""
+
+    haplo_list = haplo.analyse(gen_genome(rng, snp_list))
+    assert haplo.HaplogroupList is haplo_list
+    assert str(haplo) == haplo.to_html(haplo_list)
+
+    haplo_snapshot = haplo.analyse(gen_genome(rng, snp_list), workBudget=10 ** 6)
+    assert haplo.HaplogroupList is haplo_snapshot
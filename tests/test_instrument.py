@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import json
+import random
+
+import pytest
+
+import main
+import wegene_utils
+from haplotyping import Haplotyping
+from instrument import INSTRUMENT_ENV, Instrument, instrument_enabled, timed
+from tree_factory import gen_genome, gen_tree, result_key, write_chip, write_tree
+
+# 测试用的基因数据格式名
+_TEST_FORMAT = "test_instrument_chip"
+
+
+# stderr中每行一个统计记录
+def _read_records(stderr: str) -> list:
+    return [json.loads(line) for line in stderr.splitlines()]
+
+
+@pytest.mark.parametrize(
+    "value, enabled",
+    [
+        ("1", True),
+        ("yes", True),
+        (" True ", True),
+        ("", False),
+        ("0", False),
+        ("false", False),
+        ("No", False),
+        (None, False),
+    ],
+)
+def test_instrument_enabled(monkeypatch, value, enabled):
+    if value == None:
+        monkeypatch.delenv(INSTRUMENT_ENV, raising=False)
+    else:
+        monkeypatch.setenv(INSTRUMENT_ENV, value)
+    assert instrument_enabled() == enabled
+
+
+# 同名阶段的耗时和计数都累加，instrument为None时不做任何统计
+def test_instrument_stages(capsys):
+    instrument = Instrument()
+    for _ in range(3):
+        with timed(instrument, "stage"):
+            instrument.count("counter", 2)
+    with pytest.raises(ValueError):
+        with timed(instrument, "failed"):
+            raise ValueError()
+    with timed(None, "stage"):
+        pass
+    instrument.emit(id=7)
+    record_list = _read_records(capsys.readouterr().err)
+    assert len(record_list) == 1
+    assert record_list[0]["id"] == 7
+    assert set(record_list[0]["instrument"]["stages_ms"]) == {"stage", "failed"}
+    assert record_list[0]["instrument"]["counters"] == {"counter": 6}
+    assert record_list[0]["instrument"]["total_ms"] >= 0
+
+
+# 启用性能统计时每次分析在stderr输出一行统计，分型结果不变；未启用时不输出
+def test_haplotyping_emit(tmp_path, monkeypatch, capsys):
+    rng = random.Random(1)
+    haplo_tree, snp_list = gen_tree(rng, node_count=300)
+    tree_file_name = write_tree(tmp_path, "tree.json", haplo_tree)
+    user_genome = gen_genome(rng, snp_list, cover=0.5)
+
+    monkeypatch.delenv(INSTRUMENT_ENV, raising=False)
+    haplo_list = Haplotyping(tree_file_name, "mf", "y").analyse(user_genome)
+    monkeypatch.setenv(INSTRUMENT_ENV, "0")
+    disabled_haplo = Haplotyping(tree_file_name, "mf", "y")
+    assert result_key(disabled_haplo.analyse(user_genome)) == result_key(haplo_list)
+    assert capsys.readouterr().err == ""
+
+    monkeypatch.setenv(INSTRUMENT_ENV, "1")
+    haplo = Haplotyping(tree_file_name, "mf", "y")
+    assert result_key(haplo.analyse(user_genome)) == result_key(haplo_list)
+    record_list = _read_records(capsys.readouterr().err)
+    assert len(record_list) == 1
+    assert record_list[0]["tree"] == tree_file_name
+    stage_dict = record_list[0]["instrument"]["stages_ms"]
+    assert {"y.check_snp", "y.check_haplo_path", "y.select_haplogroups"} <= set(
+        stage_dict
+    )
+    counter_dict = record_list[0]["instrument"]["counters"]
+    assert counter_dict["y.user_pos"] == len(user_genome)
+    assert counter_dict["y.result"] == len(haplo_list)
+    assert counter_dict["y.node_positive"] <= counter_dict["y.node_visited"]
+    assert counter_dict["y.candidate"] >= len(haplo_list)
+
+    # 调用方传入的统计对象由调用方输出
+    instrument = Instrument()
+    haplo.analyse(user_genome, instrument=instrument)
+    assert capsys.readouterr().err == ""
+    assert instrument.counter_dict == counter_dict
+
+    # 构造时指定的参数优先于环境变量
+    Haplotyping(tree_file_name, "mf", "y", instrument=False).analyse(user_genome)
+    assert capsys.readouterr().err == ""
+
+
+# 单次运行时整个请求输出一行统计，包括基因数据解码、单倍群树加载和HTML生成各阶段
+def test_run_once(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    wegene_utils._genome_index_cache.pop(_TEST_FORMAT, None)
+    rng = random.Random(2)
+    os.makedirs("haplotree")
+    sample = {}
+    y_dict = {}
+    for is_y_mt, chromosome in (("y", "Y"), ("mt", "MT")):
+        haplo_tree, snp_list = gen_tree(rng, node_count=300)
+        with open("haplotree/mf_{}_snp_tree.json".format(is_y_mt), "w") as tree_file:
+            json.dump(haplo_tree, tree_file)
+        sample[chromosome] = gen_genome(rng, snp_list, cover=0.5)
+        if is_y_mt == "y":
+            node_stack = [haplo_tree["tree"]]
+            while len(node_stack) > 0:
+                tree_node = node_stack.pop()
+                node_stack.extend(tree_node.get("c", []))
+                y_dict[tree_node["n"]] = {"a": "100"}
+    with open("haplotree/mf_y_dict.json", "w") as dict_file:
+        json.dump({"dict": y_dict}, dict_file)
+    body = json.dumps({"inputs": write_chip(_TEST_FORMAT, [sample])[0]})
+    resource = main.HaploResource("mf")
+
+    for enabled in (False, True):
+        if enabled:
+            monkeypatch.setenv(INSTRUMENT_ENV, "1")
+        else:
+            monkeypatch.delenv(INSTRUMENT_ENV, raising=False)
+        monkeypatch.setattr(sys, "stdin", io.StringIO(body))
+        main.run_once(resource)
+        captured = capsys.readouterr()
+        assert "<table" in captured.out
+        if not enabled:
+            assert captured.err == ""
+            continue
+        record_list = _read_records(captured.err)
+        assert len(record_list) == 1
+        stage_dict = record_list[0]["instrument"]["stages_ms"]
+        assert {
+            "genome_index",
+            "genome_decode",
+            "genome_filter",
+            "y.tree_load",
+            "y.check_snp",
+            "mt.check_snp",
+            "html",
+            "family_lookup",
+        } <= set(stage_dict)
+        counter_dict = record_list[0]["instrument"]["counters"]
+        assert counter_dict["y.user_pos"] == len(sample["Y"])
+        assert counter_dict["mt.user_pos"] == len(sample["MT"])
+    wegene_utils._genome_index_cache.pop(_TEST_FORMAT, None)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import json
+import random
+
+import pytest
+
+import main
+import wegene_utils
+from haplo_resource import HaploResource
+from instrument import Instrument
+from tree_registry import TreeRegistry
+from tree_factory import gen_genome, gen_tree, write_chip
+
+# 测试用的基因数据格式名
+_TEST_FORMAT = "test_main_chip"
+
+
+# 在临时目录中准备mf的Y和mt单倍群树、Y家族字典和芯片数据，都按相对路径查找。返回 (HaploResource, [每个样本的输入])
+@pytest.fixture
+def resource(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    wegene_utils._genome_index_cache.pop(_TEST_FORMAT, None)
+    rng = random.Random(1)
+    os.makedirs("haplotree")
+    snp_list_dict = {}
+    y_dict = {}
+    for is_y_mt in ("y", "mt"):
+        haplo_tree, snp_list_dict[is_y_mt] = gen_tree(rng, node_count=300)
+        with open("haplotree/mf_{}_snp_tree.json".format(is_y_mt), "w") as tree_file:
+            json.dump(haplo_tree, tree_file)
+        if is_y_mt == "y":
+            node_stack = [haplo_tree["tree"]]
+            while len(node_stack) > 0:
+                tree_node = node_stack.pop()
+                node_stack.extend(tree_node.get("c", []))
+                y_dict[tree_node["n"]] = {"a": str(rng.randint(100, 5000))}
+                if rng.random() < 0.3:
+                    y_dict[tree_node["n"]]["hf"] = [
+                        {"fi": rng.randint(1, 999), "ft": "F" + tree_node["n"]}
+                    ]
+    with open("haplotree/mf_y_dict.json", "w") as dict_file:
+        json.dump({"dict": y_dict}, dict_file)
+
+    sample_list = [
+        {
+            "Y": gen_genome(rng, snp_list_dict["y"], cover=0.5),
+            "MT": gen_genome(rng, snp_list_dict["mt"], cover=0.5),
+        }
+        for _ in range(3)
+    ]
+    # 女性样本没有Y
+    sample_list[1]["Y"] = {}
+    inputs_list = write_chip(_TEST_FORMAT, sample_list)
+    yield main.HaploResource("mf"), inputs_list
+    wegene_utils._genome_index_cache.pop(_TEST_FORMAT, None)
+
+
+# 常驻运行每行一个请求，按输入顺序每行输出一个结果；无法解析的请求输出错误信息，不影响后面的请求
+def test_serve_stdin(resource, monkeypatch):
+    haplo_resource, inputs_list = resource
+    expected_list = [
+        main.haplotype_inputs(inputs, haplo_resource) for inputs in inputs_list
+    ]
+    assert all("<table" in expected for expected in expected_list)
+
+    line_list = [
+        json.dumps({"id": 1, "inputs": inputs_list[0]}),
+        "{not json",
+        "",
+        json.dumps({"id": "b", "inputs": inputs_list[1]}),
+        json.dumps({"id": 3}),
+        json.dumps({"inputs": inputs_list[2]}),
+        json.dumps({"id": 5, "inputs": inputs_list[0]}),
+    ]
+    stdout = io.StringIO()
+    monkeypatch.setattr(sys, "stdin", io.StringIO("\n".join(line_list) + "\n"))
+    monkeypatch.setattr(sys, "stdout", stdout)
+    main.serve_stdin(haplo_resource, 2)
+
+    response_list = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert len(response_list) == 6
+    assert response_list[0] == {"id": 1, "result": expected_list[0]}
+    assert set(response_list[1]) == {"error"}
+    assert response_list[2] == {"id": "b", "result": expected_list[1]}
+    assert set(response_list[3]) == {"id", "error"} and response_list[3]["id"] == 3
+    assert response_list[4] == {"result": expected_list[2]}
+    assert response_list[5] == {"id": 5, "result": expected_list[0]}
+
+
+# 一个请求指定多个数据源时各棵树同时分析，结果与逐个数据源分析的相同
+@pytest.mark.parametrize("source_workers", [1, 4])
+def test_multiple_sources(resource, monkeypatch, source_workers):
+    _, inputs_list = resource
+    registry = TreeRegistry()
+    # 另一个数据源使用同样的单倍群树，但只输出一个单倍群
+    for is_y_mt in ("y", "mt"):
+        registry.register(
+            "lab",
+            is_y_mt,
+            "haplotree/mf_{}_snp_tree.json".format(is_y_mt),
+            maxHaploCount=1,
+        )
+    haplo_resource = HaploResource("mf", registry, sourceWorkers=source_workers)
+    source_list = ["mf", "lab"]
+    expected_list = [
+        "".join(
+            main.haplotype_inputs(inputs, haplo_resource.with_source(source))
+            for source in source_list
+        )
+        for inputs in inputs_list
+    ]
+
+    workers_list = []
+    analyse_sources = TreeRegistry.analyse_sources
+
+    def recording_analyse_sources(self, *args, **kwargs):
+        workers_list.append(kwargs["workers"])
+        return analyse_sources(self, *args, **kwargs)
+
+    monkeypatch.setattr(TreeRegistry, "analyse_sources", recording_analyse_sources)
+    for inputs, expected in zip(inputs_list, expected_list):
+        instrument = Instrument()
+        assert (
+            main.handle_request(
+                json.dumps({"inputs": inputs, "source": source_list}),
+                haplo_resource,
+                instrument,
+            )
+            == expected
+        )
+        assert "analyse_sources" in instrument.stage_dict
+        assert instrument.counter_dict["mt.user_pos"] > 0
+    assert workers_list == [source_workers] * len(inputs_list)
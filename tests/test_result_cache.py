@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import random
+import threading
+
+import pytest
+
+from haplotyping import Haplotyping
+from result_cache import ResultCache
+from tree_factory import gen_genome, gen_tree, result_key, write_tree
+
+
+# 同一个键并发请求时只计算一次，其它请求等待并共享其结果；计算出错时等待的请求得到同样的异常
+def test_coalescing():
+    result_cache = ResultCache()
+    started = threading.Event()
+    release = threading.Event()
+    compute_count = [0]
+
+    def compute():
+        compute_count[0] += 1
+        started.set()
+        release.wait()
+        return {"value": 1}
+
+    result_list = []
+
+    def request():
+        result_list.append(result_cache.get_or_compute("key", compute))
+
+    thread_list = [threading.Thread(target=request) for _ in range(8)]
+    thread_list[0].start()
+    started.wait()
+    for thread in thread_list[1:]:
+        thread.start()
+    release.set()
+    for thread in thread_list:
+        thread.join()
+
+    assert compute_count[0] == 1
+    assert len(result_list) == 8
+    assert all(result is result_list[0][0] for result, _ in result_list)
+    assert sorted(is_hit for _, is_hit in result_list) == [False] + [True] * 7
+    assert result_cache.MissCount == 1
+    assert result_cache.HitCount == 7
+
+    def failed_compute():
+        started.set()
+        release.wait()
+        raise ValueError("计算失败")
+
+    started.clear()
+    release.clear()
+    error_list = []
+
+    def failed_request():
+        try:
+            result_cache.get_or_compute("failed", failed_compute)
+        except ValueError as e:
+            error_list.append(e)
+
+    thread_list = [threading.Thread(target=failed_request) for _ in range(4)]
+    thread_list[0].start()
+    started.wait()
+    for thread in thread_list[1:]:
+        thread.start()
+    release.set()
+    for thread in thread_list:
+        thread.join()
+    assert len(error_list) == 4
+    # 出错的结果不缓存，之后的请求重新计算
+    assert result_cache.get_or_compute("failed", lambda: [2]) == ([2], False)
+
+
+# 内存中只保留最近使用的结果
+def test_lru_eviction():
+    result_cache = ResultCache(maxEntries=3)
+    for key in ("a", "b", "c"):
+        result_cache.get_or_compute(key, lambda: [key])
+    # 使用a之后最久未使用的是b
+    assert result_cache.get_or_compute("a", lambda: None) == (["a"], True)
+    result_cache.get_or_compute("d", lambda: ["d"])
+    assert len(result_cache) == 3
+    assert result_cache.get_or_compute("b", lambda: ["b2"]) == (["b2"], False)
+    assert result_cache.get_or_compute("a", lambda: None) == (["a"], True)
+    assert result_cache.get_or_compute("d", lambda: None) == (["d"], True)
+
+    no_memory_cache = ResultCache(maxEntries=0)
+    no_memory_cache.get_or_compute("a", lambda: ["a"])
+    assert len(no_memory_cache) == 0
+    assert no_memory_cache.get_or_compute("a", lambda: ["a2"]) == (["a2"], False)
+    with pytest.raises(Exception):
+        ResultCache(maxEntries=-1)
+
+
+# 磁盘缓存在新的缓存对象中仍然可用，损坏的缓存文件重新计算
+def test_disk_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    result_cache = ResultCache(maxEntries=2, cacheDir=cache_dir)
+    for key_idx in range(5):
+        key = "{:02x}key".format(key_idx)
+        result_cache.get_or_compute(key, lambda: {"result": [key_idx, "单倍群"]})
+    assert len(result_cache) == 2
+    assert os.access(os.path.join(cache_dir, "00", "00key.json"), os.F_OK)
+
+    reloaded_cache = ResultCache(maxEntries=2, cacheDir=cache_dir)
+    for key_idx in range(5):
+        key = "{:02x}key".format(key_idx)
+        assert reloaded_cache.get_or_compute(key, lambda: None) == (
+            {"result": [key_idx, "单倍群"]},
+            True,
+        )
+    assert reloaded_cache.HitCount == 5 and reloaded_cache.MissCount == 0
+
+    # 清空内存缓存后从磁盘读取
+    reloaded_cache.clear()
+    assert len(reloaded_cache) == 0
+    assert reloaded_cache.get_or_compute("04key", lambda: None)[1]
+
+    with open(os.path.join(cache_dir, "01", "01key.json"), "w") as cache_file:
+        cache_file.write("{broken")
+    assert ResultCache(cacheDir=cache_dir).get_or_compute("01key", lambda: [1]) == (
+        [1],
+        False,
+    )
+    with open(os.path.join(cache_dir, "01", "01key.json"), "r") as cache_file:
+        assert json.load(cache_file) == [1]
+
+
+# 单倍群分型对象使用结果缓存时结果不变；单倍群分型树文件的修改时间或大小变化后不再使用之前的结果
+def test_haplotyping_cache(tmp_path):
+    rng = random.Random(1)
+    haplo_tree, snp_list = gen_tree(rng, node_count=300)
+    tree_file_name = write_tree(tmp_path, "tree.json", haplo_tree)
+    genome_list = [gen_genome(rng, snp_list, cover=0.5) for _ in range(3)]
+    expected_list = [
+        result_key(
+            Haplotyping(tree_file_name, "mf", "y", useTreeCache=False).analyse(
+                user_genome
+            ),
+            True,
+        )
+        for user_genome in genome_list
+    ]
+
+    result_cache = ResultCache(cacheDir=str(tmp_path / "cache"))
+
+    def analyse_all() -> list:
+        haplo = Haplotyping(tree_file_name, "mf", "y", resultCache=result_cache)
+        return [
+            result_key(haplo.analyse(user_genome), True) for user_genome in genome_list
+        ]
+
+    assert analyse_all() == expected_list
+    assert result_cache.MissCount == 3 and result_cache.HitCount == 0
+    # 重新加载的单倍群分型对象使用之前的结果
+    assert analyse_all() == expected_list
+    assert result_cache.MissCount == 3 and result_cache.HitCount == 3
+
+    # 内容不变、只有修改时间变化
+    tree_stat = os.stat(tree_file_name)
+    os.utime(
+        tree_file_name, ns=(tree_stat.st_atime_ns, tree_stat.st_mtime_ns + 10 ** 9)
+    )
+    assert analyse_all() == expected_list
+    assert result_cache.MissCount == 6 and result_cache.HitCount == 3
+
+    # 修改时间不变、只有大小变化
+    tree_stat = os.stat(tree_file_name)
+    with open(tree_file_name, "a", encoding="utf-8") as tree_file:
+        tree_file.write("\n")
+    os.utime(tree_file_name, ns=(tree_stat.st_atime_ns, tree_stat.st_mtime_ns))
+    assert analyse_all() == expected_list
+    assert result_cache.MissCount == 9 and result_cache.HitCount == 3
+
+    # 单倍群分型树更新后的结果与不使用缓存的相同
+    new_haplo_tree, _ = gen_tree(random.Random(2), node_count=300)
+    write_tree(tmp_path, "tree.json", new_haplo_tree)
+    new_haplo = Haplotyping(tree_file_name, "mf", "y", useTreeCache=False)
+    assert analyse_all() == [
+        result_key(new_haplo.analyse(user_genome), True) for user_genome in genome_list
+    ]
+    assert result_cache.MissCount == 12 and result_cache.HitCount == 3
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import copy
+import random
+
+import pytest
+
+from haplotyping import Haplotyping
+from tree_diff import diff_trees
+from tree_factory import gen_genome, gen_tree, result_key, write_tree
+
+
+# 先序排列的(节点, 父节点)
+def _node_list(root: dict) -> list:
+    node_list = []
+    node_stack = [(root, None)]
+    while len(node_stack) > 0:
+        tree_node, parent = node_stack.pop()
+        node_list.append((tree_node, parent))
+        node_stack.extend((child, tree_node) for child in tree_node.get("c", []))
+    return node_list
+
+
+# 随机修改单倍群树：新增、删除、移动单倍群，修改SNP，调整兄弟节点顺序
+def _mutate(rng: random.Random, haplo_tree: dict, counter: list) -> str:
+    node_list = _node_list(haplo_tree["tree"])
+    tree_node, parent = rng.choice(node_list[1:])
+    kind = rng.choice(["add", "remove", "move", "snp", "reorder", "pos"])
+    if kind == "add":
+        counter[0] += 1
+        pos = rng.randint(1, 3000)
+        ancestral, derived = rng.sample("ATGC", 2)
+        child_list = tree_node.setdefault("c", [])
+        child_list.insert(
+            rng.randint(0, len(child_list)),
+            {
+                "n": "NEW{}".format(counter[0]),
+                "m": [
+                    {
+                        "v": "X{}".format(counter[0]),
+                        "p19": pos,
+                        "p38": pos + 7,
+                        "p": pos,
+                        "a": ancestral,
+                        "d": derived,
+                    }
+                ],
+            },
+        )
+    elif kind == "remove":
+        node_pos = parent["c"].index(tree_node)
+        parent["c"][node_pos : node_pos + 1] = tree_node.get("c", [])
+    elif kind == "move":
+        subtree_set = set(id(node) for node, _ in _node_list(tree_node))
+        new_parent = rng.choice(
+            [node for node, _ in node_list if id(node) not in subtree_set]
+        )
+        parent["c"].remove(tree_node)
+        new_parent.setdefault("c", []).append(tree_node)
+    elif kind == "snp":
+        if len(tree_node.get("m", [])) > 0:
+            snp_dict = rng.choice(tree_node["m"])
+            snp_dict["d"] = rng.choice([a for a in "ATGC" if a != snp_dict["d"]])
+        else:
+            tree_node["m"] = []
+    elif kind == "reorder":
+        rng.shuffle(parent["c"])
+    elif len(tree_node.get("m", [])) > 0:
+        snp_dict = rng.choice(tree_node["m"])
+        snp_dict["p19"] = snp_dict["p"] = rng.randint(1, 3000)
+        snp_dict["p38"] = snp_dict["p19"] + 7
+    return kind
+
+
+# 不需要重新分型的样本，沿用的旧结果必须与用新树重新分型的结果相同
+@pytest.mark.parametrize("seed", range(0, 200, 20))
+def test_reused_result_matches_new_tree(tmp_path, seed):
+    for seed in range(seed, seed + 20):
+        rng = random.Random(seed)
+        old_tree, snp_list = gen_tree(
+            rng,
+            node_count=rng.choice([30, 300]),
+            max_children=rng.choice([2, 4, 8]),
+        )
+        new_tree = copy.deepcopy(old_tree)
+        counter = [0]
+        for _ in range(rng.choice([1, 1, 3])):
+            _mutate(rng, new_tree, counter)
+
+        is_y_mt = rng.choice(["y", "mt"])
+        option_dict = dict(
+            confirmedPositiveHaplo=rng.choice([1, 3]),
+            allowedNegativeHaplo=rng.choice([0, 2]),
+            maxHaploCount=rng.choice([3, 5]),
+            useTreeCache=False,
+        )
+        old_haplo = Haplotyping(
+            write_tree(tmp_path, "old_{}.json".format(seed), old_tree),
+            "mf",
+            is_y_mt,
+            **option_dict
+        )
+        new_haplo = Haplotyping(
+            write_tree(tmp_path, "new_{}.json".format(seed), new_tree),
+            "mf",
+            is_y_mt,
+            **option_dict
+        )
+        tree_diff = diff_trees(old_haplo, new_haplo)
+        for _ in range(10):
+            user_genome = gen_genome(
+                rng,
+                snp_list,
+                cover=rng.choice([0.02, 0.1, 0.5]),
+                der_rate=rng.choice([0.05, 0.3]),
+            )
+            if len(user_genome) == 0:
+                continue
+            old_list = old_haplo.analyse(user_genome)
+            if tree_diff.needs_retyping(
+                [haplo["haplo"] for haplo in old_list], user_genome
+            ):
+                continue
+            assert result_key(old_list) == result_key(
+                new_haplo.analyse(user_genome)
+            ), seed
+
+
+# 在有多个子节点的单倍群C下新增单倍群D，C的祖先A因此有了终端节点，成为新的分型结果。用户在A有derived突变，需要重新分型
+def test_added_leaf_under_derived_ancestor(tmp_path):
+    def snp(name: str, pos: int) -> dict:
+        return {"v": name, "p19": pos, "p38": pos, "p": pos, "a": "A", "d": "G"}
+
+    old_tree = {
+        "timestamp": "t1",
+        "tree": {
+            "n": "R",
+            "m": [snp("r", 1)],
+            "c": [
+                {
+                    "n": "A",
+                    "m": [snp("a", 2)],
+                    "c": [
+                        {"n": "B", "m": [snp("b", 3)]},
+                        {"n": "C", "m": [snp("c", 4)], "c": [{"n": "C1", "m": [snp("c1", 5)]}]},
+                    ],
+                }
+            ],
+        },
+    }
+    new_tree = copy.deepcopy(old_tree)
+    new_tree["tree"]["c"][0]["c"][1]["c"].append({"n": "D", "m": [snp("d", 6)]})
+
+    old_haplo = Haplotyping(
+        write_tree(tmp_path, "old.json", old_tree), "mf", "y", useTreeCache=False
+    )
+    new_haplo = Haplotyping(
+        write_tree(tmp_path, "new.json", new_tree), "mf", "y", useTreeCache=False
+    )
+    user_genome = {"1": "GG", "2": "GG", "3": "GG", "5": "GG"}
+    old_list = old_haplo.analyse(user_genome)
+    assert [haplo.Haplo for haplo in old_list] == ["C1", "B"]
+    assert [haplo.Haplo for haplo in new_haplo.analyse(user_genome)] == ["C1", "B", "A"]
+    assert diff_trees(old_haplo, new_haplo).needs_retyping(
+        [haplo.Haplo for haplo in old_list], user_genome
+    )
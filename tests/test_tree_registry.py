@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import random
+
+import pytest
+
+from tree_factory import gen_genome, gen_tree, result_key, write_tree
+from tree_registry import TreeRegistry
+
+
+# 单倍群分型树首次使用时加载，估算内存超过预算时淘汰最久未使用的树，被淘汰的树再次使用时重新加载，结果不变
+def test_lazy_load_and_eviction(tmp_path):
+    rng = random.Random(1)
+    tree_dir = tmp_path / "haplotree"
+    os.makedirs(str(tree_dir))
+    snp_list_dict = {}
+    for source in ("a", "b", "c"):
+        haplo_tree, snp_list_dict[source] = gen_tree(rng, node_count=300)
+        write_tree(tree_dir, "{}_y_snp_tree.json".format(source), haplo_tree)
+
+    # 首次加载时编译并保存预编译缓存，之后从缓存加载的估算内存较小
+    for source in ("a", "b", "c"):
+        TreeRegistry(treeDir=str(tree_dir)).get_haplo(source, "y")
+    unlimited_registry = TreeRegistry(treeDir=str(tree_dir))
+    assert unlimited_registry.LoadedTrees == []
+    memory_size_list = []
+    for source in ("a", "b", "c"):
+        memory_size = unlimited_registry.MemorySize
+        haplo = unlimited_registry.get_haplo(source.upper(), "Y")
+        assert unlimited_registry.get_haplo(source, "y") is haplo
+        memory_size_list.append(unlimited_registry.MemorySize - memory_size)
+        assert memory_size_list[-1] > 0
+    assert unlimited_registry.LoadedTrees == [("a", "y"), ("b", "y"), ("c", "y")]
+    expected_dict = {}
+    for source in ("a", "b", "c"):
+        user_genome = gen_genome(rng, snp_list_dict[source], cover=0.5)
+        haplo = unlimited_registry.get_haplo(source, "y")
+        expected_dict[source] = (user_genome, result_key(haplo.analyse(user_genome)))
+
+    # 预算只够保留两棵树
+    registry = TreeRegistry(
+        memoryBudget=sum(memory_size_list) - min(memory_size_list) // 2,
+        treeDir=str(tree_dir),
+    )
+    haplo_a = registry.get_haplo("a", "y")
+    registry.get_haplo("b", "y")
+    registry.get_haplo("a", "y")
+    registry.get_haplo("c", "y")
+    assert registry.LoadedTrees == [("a", "y"), ("c", "y")]
+    assert registry.MemorySize <= registry.MemoryBudget
+    assert registry.get_haplo("a", "y") is haplo_a
+    for source, (user_genome, expected) in expected_dict.items():
+        assert result_key(registry.get_haplo(source, "y").analyse(user_genome)) == (
+            expected
+        )
+    assert registry.LoadedTrees == [("b", "y"), ("c", "y")]
+
+    # 最近使用的树总是保留
+    small_registry = TreeRegistry(memoryBudget=1, treeDir=str(tree_dir))
+    small_registry.get_haplo("a", "y")
+    small_registry.get_haplo("b", "y")
+    assert small_registry.LoadedTrees == [("b", "y")]
+
+    with pytest.raises(Exception):
+        registry.get_haplo("a", "x")
+    with pytest.raises(Exception):
+        registry.get_haplo("missing", "y")
+    with pytest.raises(Exception):
+        TreeRegistry(memoryBudget=-1)
+
+
+# 配置文件中的相对路径相对于配置文件所在目录，其它参数传给单倍群分型对象；重新注册的树在下次使用时按新参数加载
+def test_load_config(tmp_path, monkeypatch):
+    rng = random.Random(2)
+    os.makedirs(str(tmp_path / "conf" / "trees"))
+    tree_file_dict = {}
+    timestamp_dict = {}
+    for is_y_mt in ("y", "mt"):
+        haplo_tree, _ = gen_tree(rng, node_count=30)
+        timestamp_dict[is_y_mt] = haplo_tree["timestamp"]
+        tree_file_dict[is_y_mt] = write_tree(
+            tmp_path / "conf" / "trees", is_y_mt + ".json", haplo_tree
+        )
+    with open(str(tmp_path / "conf" / "trees.json"), "w") as config_file:
+        json.dump(
+            {
+                "Lab": {
+                    "y": {
+                        "file": "trees/y.json",
+                        "dict": "trees/y_dict.json",
+                        "maxHaploCount": 3,
+                    },
+                    "mt": {"file": "trees/mt.json"},
+                }
+            },
+            config_file,
+        )
+    # 相对路径与当前目录无关
+    monkeypatch.chdir(tmp_path)
+    registry = TreeRegistry(treeDir="no_such_dir")
+    registry.load_config(str(tmp_path / "conf" / "trees.json"))
+
+    haplo = registry.get_haplo("lab", "y")
+    assert haplo.Timestamp == timestamp_dict["y"]
+    assert haplo.MaxHaploCount == 3
+    assert registry.get_haplo("LAB", "mt").Timestamp == timestamp_dict["mt"]
+    # 家族字典文件不存在时为None，创建后重新注册即可使用
+    assert registry.get_y_dict("lab") == None
+    with open(str(tmp_path / "conf" / "trees" / "y_dict.json"), "w") as dict_file:
+        json.dump({"dict": {"H1": {"a": "100"}}}, dict_file)
+    assert registry.get_y_dict("lab") == None
+    registry.load_config(str(tmp_path / "conf" / "trees.json"))
+    assert registry.get_y_dict("LAB")["H1"] == {"a": "100"}
+    haplo = registry.get_haplo("lab", "y")
+    registry.get_haplo("lab", "mt")
+    with pytest.raises(Exception):
+        registry.register("lab", "mt", tree_file_dict["mt"], "y_dict.json")
+
+    registry.register("lab", "y", tree_file_dict["y"], maxHaploCount=5)
+    assert registry.LoadedTrees == [("lab", "mt")]
+    new_haplo = registry.get_haplo("lab", "y")
+    assert new_haplo is not haplo
+    assert new_haplo.MaxHaploCount == 5
+
+
+# 淘汰或重新注册的树的子树进程池被关闭并移除，仍持有旧进程池的分析在本进程计算，结果不变
+def test_evicted_tree_closes_subtree_pool(tmp_path):
+    rng = random.Random(1)
+    registry = TreeRegistry(memoryBudget=1, subtreeWorkers=2)
+    tree_file_dict = {}
+    snp_list_dict = {}
+    for source in ("a", "b"):
+        haplo_tree, snp_list_dict[source] = gen_tree(rng, node_count=300)
+        tree_file_dict[source] = write_tree(tmp_path, source + ".json", haplo_tree)
+        registry.register(source, "y", tree_file_dict[source], useTreeCache=False)
+
+    subtree_pool = registry.get_subtree_pool("a", "y")
+    haplo = subtree_pool.HaploObj
+    user_genome = gen_genome(rng, snp_list_dict["a"], cover=0.5)
+    expected = result_key(haplo.analyse(user_genome))
+    assert result_key(haplo.analyse(user_genome, subtreePool=subtree_pool)) == expected
+
+    registry.get_haplo("b", "y")
+    assert registry.LoadedTrees == [("b", "y")]
+    assert result_key(haplo.analyse(user_genome, subtreePool=subtree_pool)) == expected
+
+    new_pool = registry.get_subtree_pool("a", "y")
+    assert new_pool is not subtree_pool
+    registry.register("a", "y", tree_file_dict["a"], useTreeCache=False)
+    assert registry.LoadedTrees == []
+    assert (
+        result_key(new_pool.HaploObj.analyse(user_genome, subtreePool=new_pool))
+        == expected
+    )
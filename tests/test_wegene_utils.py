@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import base64
+import random
+
+import pytest
+
+import wegene_utils
+
+# 测试用的基因数据格式名
+_TEST_FORMAT = "test_chip"
+
+
+# 在临时目录中准备基因索引目录，基因索引按相对路径查找
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("indexes")
+    wegene_utils._genome_index_cache.pop(_TEST_FORMAT, None)
+    yield tmp_path
+    wegene_utils._genome_index_cache.pop(_TEST_FORMAT, None)
+
+
+# 生成随机的文本基因索引和基因数据字符串，位点序号乱序，包含NA行、空行、未检出和未排序的基因型
+def _gen_chip(rng: random.Random, record_count: int) -> tuple:
+    index_pos_list = list(range(record_count))
+    rng.shuffle(index_pos_list)
+    index_lines = ["NA\tNA\tNA\tNA"]
+    for rs_num, index_pos in enumerate(index_pos_list):
+        chromosome = rng.choice(["1", "2", "X", "Y", "MT"])
+        index_lines.append(
+            "{}\trs{}\t{}\t{}".format(
+                index_pos, rs_num + 1, chromosome, rng.randint(1, 10 ** 6)
+            )
+        )
+        if rng.random() < 0.05:
+            index_lines.append("")
+    genome_str = "".join(
+        rng.choice(["AA", "AG", "GA", "CT", "TT", "--", "__", "DI", "II"])
+        for _ in range(record_count)
+    )
+    return "\n".join(index_lines) + "\n", genome_str
+
+
+def _write_index(index_text: str):
+    with open("indexes/index_{}.idx".format(_TEST_FORMAT), "w") as idx_file:
+        idx_file.write(index_text)
+
+
+# 按文本基因索引逐行解析，与预编译基因索引之前的实现相同
+def _parse_text(index_text: str, genome_str: str) -> dict:
+    genome_dict = {}
+    for line in index_text.split("\n"):
+        if not line.startswith("NA") and line.strip() != "":
+            fields = line.strip().split("\t")
+            start_pos = int(fields[0]) * 2
+            genome_dict[fields[1]] = {
+                "genotype": wegene_utils.sort_genotype(
+                    genome_str[start_pos : start_pos + 2]
+                ),
+                "chromosome": fields[2],
+                "position": fields[3],
+            }
+    return genome_dict
+
+
+def test_parse_genome_string(index_dir):
+    index_text, genome_str = _gen_chip(random.Random(1), 2000)
+    _write_index(index_text)
+    expected = _parse_text(index_text, genome_str)
+
+    assert wegene_utils.parse_genome_string(genome_str, _TEST_FORMAT) == expected
+    assert os.access("indexes/index_{}.idx.bin".format(_TEST_FORMAT), os.F_OK)
+
+    # 进程内缓存清空后映射已保存的预编译文件
+    wegene_utils._genome_index_cache.clear()
+    genome_index = wegene_utils.load_genome_index(_TEST_FORMAT)
+    assert genome_index.header["version"] == wegene_utils.GENOME_INDEX_VERSION
+    assert wegene_utils.parse_genome_string(genome_str, _TEST_FORMAT) == expected
+
+    with pytest.raises(Exception):
+        wegene_utils.parse_genome_string(genome_str[:-2], _TEST_FORMAT)
+
+
+# 文本基因索引变化或预编译文件损坏时重新生成
+def test_stale_or_corrupt_index(index_dir):
+    rng = random.Random(2)
+    index_text, genome_str = _gen_chip(rng, 500)
+    _write_index(index_text)
+    wegene_utils.load_genome_index(_TEST_FORMAT)
+
+    index_text, genome_str = _gen_chip(rng, 800)
+    _write_index(index_text)
+    assert wegene_utils.parse_genome_string(genome_str, _TEST_FORMAT) == _parse_text(
+        index_text, genome_str
+    )
+
+    wegene_utils._genome_index_cache.clear()
+    with open("indexes/index_{}.idx.bin".format(_TEST_FORMAT), "wb") as bin_file:
+        bin_file.write(b"WGIDX\x00\x00\x00garbage")
+    assert wegene_utils.parse_genome_string(genome_str, _TEST_FORMAT) == _parse_text(
+        index_text, genome_str
+    )
+
+
+# 只提取Y和mt位置，未检出和插入缺失的基因型不保留
+def test_extract_positions(index_dir):
+    index_text, genome_str = _gen_chip(random.Random(3), 3000)
+    _write_index(index_text)
+    raw_inputs = {
+        "data": base64.b64encode(gzip.compress(genome_str.encode("utf-8"))).decode(
+            "ascii"
+        ),
+        "format": _TEST_FORMAT,
+    }
+
+    expected = {"Y": {}, "MT": {}}
+    for record in _parse_text(index_text, genome_str).values():
+        if record["chromosome"] in expected and record["genotype"][0] in "ATGC":
+            expected[record["chromosome"]][record["position"]] = record["genotype"]
+    assert wegene_utils.extract_positions(raw_inputs) == expected
+    assert wegene_utils.process_raw_genome_data(raw_inputs) == _parse_text(
+        index_text, genome_str
+    )
+
+
+def _encode(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+# 流式解码芯片数据，返回基因型字符串
+def _decode(data: str, index_count: int) -> str:
+    genome = wegene_utils._decode_genome_buffer(
+        {"data": data, "format": _TEST_FORMAT}, _TEST_FORMAT, index_count
+    )
+    return genome if isinstance(genome, str) else str(bytes(genome), "utf-8")
+
+
+# base64分块很小时，解码要跨多个分块；多段拼接的gzip依次解压
+def test_decode_genome_buffer(monkeypatch):
+    monkeypatch.setattr(wegene_utils, "_BASE64_CHUNK_SIZE", 64)
+    _, genome_str = _gen_chip(random.Random(4), 3000)
+    genome_bytes = genome_str.encode("utf-8")
+
+    genome = wegene_utils._decode_genome_buffer(
+        {"data": _encode(gzip.compress(genome_bytes))}, _TEST_FORMAT, 3000
+    )
+    assert isinstance(genome, memoryview) and genome.readonly
+    assert bytes(genome) == genome_bytes
+
+    multi_member = b"".join(
+        gzip.compress(genome_bytes[start:end])
+        for start, end in ((0, 1001), (1001, 1002), (1002, 4321), (4321, 6000))
+    )
+    assert _decode(_encode(multi_member), 3000) == genome_str
+
+
+# 一段gzip恰好在解压输出达到上限时结束，之后的数据仍属于下一段
+def test_decode_genome_buffer_member_at_inflate_limit(monkeypatch):
+    monkeypatch.setattr(wegene_utils, "_INFLATE_CHUNK_SIZE", 100)
+    _, genome_str = _gen_chip(random.Random(7), 3000)
+    genome_bytes = genome_str.encode("utf-8")
+    for boundary_list in ((0, 3000, 6000), (0, 100, 200, 2500, 6000)):
+        multi_member = b"".join(
+            gzip.compress(genome_bytes[start:end])
+            for start, end in zip(boundary_list, boundary_list[1:])
+        )
+        assert _decode(_encode(multi_member), 3000) == genome_str
+
+
+# 分块边界不是完整的base64单元（如每76个字符换行）时，按原方式整体解码
+def test_decode_genome_buffer_fallback(monkeypatch):
+    monkeypatch.setattr(wegene_utils, "_BASE64_CHUNK_SIZE", 64)
+    fallback_list = []
+    decode_genome_data = wegene_utils._decode_genome_data
+
+    def spy_decode_genome_data(raw_inputs):
+        fallback_list.append(raw_inputs["data"])
+        return decode_genome_data(raw_inputs)
+
+    monkeypatch.setattr(wegene_utils, "_decode_genome_data", spy_decode_genome_data)
+    _, genome_str = _gen_chip(random.Random(5), 3000)
+    compressed = gzip.compress(genome_str.encode("utf-8"))
+
+    assert _decode(_encode(compressed), 3000) == genome_str
+    assert fallback_list == []
+    wrapped = base64.encodebytes(compressed).decode("ascii")
+    assert _decode(wrapped, 3000) == genome_str
+    assert fallback_list == [wrapped]
+
+
+# 截断的数据，以及位点数与基因索引不一致（包括远超基因索引）的数据都报错
+def test_decode_genome_buffer_errors(monkeypatch):
+    monkeypatch.setattr(wegene_utils, "_INFLATE_CHUNK_SIZE", 100)
+    _, genome_str = _gen_chip(random.Random(6), 3000)
+    compressed = gzip.compress(genome_str.encode("utf-8"))
+
+    for truncated in (compressed[:-8], compressed[: len(compressed) // 2]):
+        with pytest.raises(Exception, match="基因数据不完整"):
+            _decode(_encode(truncated), 3000)
+    with pytest.raises(Exception, match="不一致"):
+        _decode(_encode(compressed), 2999)
+    with pytest.raises(Exception, match="不一致"):
+        _decode(_encode(compressed), 3001)
+    with pytest.raises(Exception, match="不一致"):
+        _decode(_encode(gzip.compress(genome_str.encode("utf-8") * 50)), 3000)
+
+
+# 原始基因数据文件的记录：(rsid, 染色体, 位置, 基因型)，包括其它染色体、未检出和插入缺失
+_RAW_RECORD_LIST = [
+    ("rs1", "1", "1000", "AG"),
+    ("rs2", "X", "2000", "CC"),
+    ("rs3", "Y", "2781", "AA"),
+    ("rs4", "Y", "2782", "--"),
+    ("rs5", "Y", "2783", "GG"),
+    ("rs6", "Y", "2784", "DD"),
+    ("rs7", "MT", "73", "GG"),
+    ("rs8", "MT", "150", "TT"),
+    ("rs9", "MT", "151", "--"),
+    ("rs10", "2", "3000", "TT"),
+]
+# 只保留Y和mt的已检出位置
+_RAW_EXPECTED = {
+    "Y": {"2781": "AA", "2783": "GG"},
+    "MT": {"73": "GG", "150": "TT"},
+}
+
+
+def _write_23andme(file_name: str):
+    with open(file_name, "w") as raw_file:
+        raw_file.write("# This data file generated by 23andMe\n")
+        raw_file.write("# rsid\tchromosome\tposition\tgenotype\n")
+        for record in _RAW_RECORD_LIST:
+            raw_file.write("\t".join(record) + "\n")
+
+
+def _write_ancestry(file_name: str):
+    chromosome_dict = {"X": "23", "Y": "24", "MT": "26"}
+    with open(file_name, "w") as raw_file:
+        raw_file.write("#AncestryDNA raw data download\n")
+        raw_file.write("rsid\tchromosome\tposition\tallele1\tallele2\n")
+        for rsid, chromosome, position, genotype in _RAW_RECORD_LIST:
+            if genotype == "--":
+                genotype = "00"
+            raw_file.write(
+                "\t".join(
+                    [
+                        rsid,
+                        chromosome_dict.get(chromosome, chromosome),
+                        position,
+                        genotype[0],
+                        genotype[1],
+                    ]
+                )
+                + "\r\n"
+            )
+
+
+def _write_ftdna(file_name: str):
+    with open(file_name, "w") as raw_file:
+        raw_file.write("RSID,CHROMOSOME,POSITION,RESULT\n")
+        for record in _RAW_RECORD_LIST:
+            raw_file.write(",".join('"{}"'.format(field) for field in record) + "\n")
+
+
+def _write_vcf(file_name: str):
+    with open(file_name, "w") as raw_file:
+        raw_file.write("##fileformat=VCFv4.2\n")
+        raw_file.write(
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n"
+        )
+        for rsid, chromosome, position, genotype in _RAW_RECORD_LIST:
+            chromosome = "chr" + ("M" if chromosome == "MT" else chromosome)
+            if genotype == "--":
+                ref, alt, gt = "A", ".", "./."
+            elif genotype == "DD":
+                ref, alt, gt = "AT", "A", "1/1"
+            else:
+                ref = genotype[0]
+                alt = genotype[1] if genotype[1] != ref else "C" if ref != "C" else "T"
+                gt = "0/1" if genotype[1] != ref else "0/0"
+            field_list = [chromosome, position, rsid, ref, alt, ".", "PASS", "."]
+            raw_file.write("\t".join(field_list + ["GT:DP", gt + ":9"]) + "\n")
+
+
+# 各种格式的原始基因数据文件，普通和gzip压缩的都按文件内容检测格式，只读取Y和mt位置
+@pytest.mark.parametrize(
+    "genome_format,write_func",
+    [
+        (wegene_utils.GENOME_FILE_23ANDME, _write_23andme),
+        (wegene_utils.GENOME_FILE_ANCESTRY, _write_ancestry),
+        (wegene_utils.GENOME_FILE_FTDNA, _write_ftdna),
+        (wegene_utils.GENOME_FILE_VCF, _write_vcf),
+    ],
+)
+@pytest.mark.parametrize("compressed", [False, True])
+def test_raw_genome_file(tmp_path, genome_format, write_func, compressed):
+    file_name = str(tmp_path / "raw.txt")
+    write_func(file_name)
+    if compressed:
+        with open(file_name, "rb") as raw_file:
+            raw_data = raw_file.read()
+        file_name = str(tmp_path / "raw.txt.gz")
+        with gzip.open(file_name, "wb") as gz_file:
+            gz_file.write(raw_data)
+
+    assert wegene_utils.detect_genome_file_format(file_name) == genome_format
+    assert wegene_utils.get_positions_from_file(file_name) == _RAW_EXPECTED
+    assert list(wegene_utils.iter_positions_from_file(file_name, ("MT",))) == [
+        ("MT", "73", "GG"),
+        ("MT", "150", "TT"),
+    ]
+
+
+# 单倍体的Y和mt基因型保留为单个碱基，VCF的单倍体GT也一样
+def test_haploid_genotype(tmp_path):
+    file_name = str(tmp_path / "raw.vcf")
+    with open(file_name, "w") as raw_file:
+        raw_file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS\n")
+        raw_file.write("Y\t2781\t.\tG\tA\t.\t.\t.\tGT\t1\n")
+        raw_file.write("MT\t73\t.\tA\tG,T\t.\t.\t.\tGT\t2\n")
+        raw_file.write("M\t150\t.\tC\tT\t.\t.\t.\tGT\t.\n")
+    assert wegene_utils.get_positions_from_file(file_name) == {
+        "Y": {"2781": "A"},
+        "MT": {"73": "T"},
+    }
+
+
+def test_unknown_file_format(tmp_path):
+    file_name = str(tmp_path / "raw.txt")
+    with open(file_name, "w") as raw_file:
+        raw_file.write("rsid chromosome position genotype\n")
+    with pytest.raises(Exception):
+        wegene_utils.detect_genome_file_format(file_name)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import json
+import base64
+import random
+
+"""
+测试用的小型随机单倍群树和用户基因数据。SNP位置集中在很小的范围内，同一位置常被多个SNP共用，
+用户数据在树上的命中、derived突变和剪枝情况都比真实数据密集，容易覆盖分型规则的边界情况。
+"""
+
+
+# 生成随机单倍群树，键名与真实的单倍群树一致。返回 (单倍群树JSON, [(位置, ancestral, derived)])
+# dup_name_rate是与先序在前的其它分支上的单倍群重名的节点比例，同一条根路径上的单倍群不重名
+def gen_tree(
+    rng: random.Random,
+    node_count: int = 300,
+    max_children: int = 4,
+    max_snps: int = 3,
+    pos_max: int = 3000,
+    dup_name_rate: float = 0.0,
+) -> tuple:
+    counter = [0]
+    snp_list_all = []
+
+    def new_node() -> dict:
+        counter[0] += 1
+        tree_node = {"n": "H{}".format(counter[0])}
+        r = rng.random()
+        # 少量节点没有SNP列表或SNP列表为空
+        if r < 0.05:
+            return tree_node
+        tree_node["m"] = []
+        if r < 0.1:
+            return tree_node
+        for _ in range(rng.randint(1, max_snps)):
+            pos = rng.randint(1, pos_max)
+            ancestral, derived = rng.sample("ATGC", 2)
+            tree_node["m"].append(
+                {
+                    "v": "S{}".format(len(snp_list_all) + 1),
+                    "p19": pos,
+                    "p38": pos + 7,
+                    "p": pos,
+                    "a": ancestral,
+                    "d": derived,
+                }
+            )
+            snp_list_all.append((pos, ancestral, derived))
+        return tree_node
+
+    root = new_node()
+    frontier = [root]
+    while counter[0] < node_count and len(frontier) > 0:
+        tree_node = frontier.pop(rng.randrange(len(frontier)))
+        # 部分节点是空的子节点列表
+        tree_node["c"] = []
+        if rng.random() < 0.3 and len(frontier) > 0:
+            continue
+        for _ in range(rng.randint(1, max_children)):
+            child = new_node()
+            tree_node["c"].append(child)
+            frontier.append(child)
+    if dup_name_rate > 0:
+        name_list = []
+        node_stack = [(root, frozenset())]
+        while len(node_stack) > 0:
+            tree_node, ancestor_name_set = node_stack.pop()
+            if rng.random() < dup_name_rate:
+                dup_name_list = [
+                    name for name in name_list if name not in ancestor_name_set
+                ]
+                if len(dup_name_list) > 0:
+                    tree_node["n"] = rng.choice(dup_name_list)
+            name_list.append(tree_node["n"])
+            node_stack.extend(
+                (child, ancestor_name_set | {tree_node["n"]})
+                for child in reversed(tree_node.get("c", []))
+            )
+    haplo_tree = {"timestamp": "t{}".format(rng.randint(0, 10 ** 6)), "tree": root}
+    return haplo_tree, snp_list_all
+
+
+# 生成用户在部分树上位置的基因型 {位置: 基因型}，cover是检测的SNP比例，der_rate是derived突变的比例，
+# pos_shift是位置的偏移，hg38的位置比hg19大7
+def gen_genome(
+    rng: random.Random,
+    snp_list: list,
+    cover: float = 0.5,
+    der_rate: float = 0.3,
+    pos_shift: int = 0,
+) -> dict:
+    user_genome = {}
+    for pos, ancestral, derived in snp_list:
+        if rng.random() < cover:
+            allele = derived if rng.random() < der_rate else ancestral
+            user_genome[str(pos + pos_shift)] = allele + allele
+    return user_genome
+
+
+# 保存单倍群树JSON文件，返回文件名
+def write_tree(tmp_path, name: str, haplo_tree: dict) -> str:
+    tree_file_name = str(tmp_path / name)
+    with open(tree_file_name, "w", encoding="utf-8") as tree_file:
+        json.dump(haplo_tree, tree_file)
+    return tree_file_name
+
+
+# 分型结果中用于比较的部分，with_path为True时包括分型路径和路径上的用户突变
+def result_key(haplo_list: list, with_path: bool = False) -> list:
+    if with_path:
+        return [
+            (
+                haplo["haplo"],
+                haplo["snp_derived_count"],
+                haplo["haplo_depth"],
+                round(haplo["haplo_score"], 12),
+                [
+                    (
+                        path_haplo["haplo"],
+                        json.dumps(path_haplo["mutation"], sort_keys=True),
+                    )
+                    for path_haplo in haplo["haplo_path"]
+                ],
+            )
+            for haplo in haplo_list
+        ]
+    return [
+        (
+            haplo["haplo"],
+            haplo["snp_derived_count"],
+            haplo["haplo_depth"],
+            haplo["haplo_score"],
+        )
+        for haplo in haplo_list
+    ]
+
+
+# 把多个样本的{染色体: {位置: 基因型}}写成WeGene格式的芯片数据：基因索引保存为indexes/index_{genome_format}.idx，
+# 每个样本检测过的(染色体, 位置)都是一个位点。返回每个样本的输入{"data": gzip压缩并base64编码的基因型字符串, "format": genome_format}，样本未检测的位点为"--"
+def write_chip(genome_format: str, sample_list: list) -> list:
+    record_list = sorted(
+        set(
+            (chromosome, pos)
+            for chrom_genome_dict in sample_list
+            for chromosome, user_genome in chrom_genome_dict.items()
+            for pos in user_genome
+        )
+    )
+    os.makedirs("indexes", exist_ok=True)
+    with open("indexes/index_{}.idx".format(genome_format), "w") as idx_file:
+        idx_file.write("NA\tNA\tNA\tNA\n")
+        for index_pos, (chromosome, pos) in enumerate(record_list):
+            idx_file.write(
+                "{}\trs{}\t{}\t{}\n".format(index_pos, index_pos + 1, chromosome, pos)
+            )
+
+    inputs_list = []
+    for chrom_genome_dict in sample_list:
+        genome_str = "".join(
+            chrom_genome_dict.get(chromosome, {}).get(pos, "--")
+            for chromosome, pos in record_list
+        )
+        inputs_list.append(
+            {
+                "data": base64.b64encode(
+                    gzip.compress(genome_str.encode("utf-8"))
+                ).decode("ascii"),
+                "format": genome_format,
+            }
+        )
+    return inputs_list
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import argparse
+
+from haplotyping import Haplotyping
+
+"""
+比较两个版本的单倍群分型树，找出新增、删除、移动的单倍群和SNP有变化的单倍群:
+    python tree_diff.py old/mf_y_snp_tree.json haplotree/mf_y_snp_tree.json --type y
+单倍群树更新后，cohort.py 可以用 --previous 和 --old-tree-dir 只重新分型受影响的样本。
+"""
+
+
+# 先序排列的节点快照的子树结束下标（不含），子树范围是[idx, end)
+def _subtree_end(snapshot_list: list) -> list:
+    node_end = list(range(1, len(snapshot_list) + 1))
+    for node_idx in range(len(snapshot_list) - 1, 0, -1):
+        parent_idx = snapshot_list[node_idx][1]
+        if node_end[node_idx] > node_end[parent_idx]:
+            node_end[parent_idx] = node_end[node_idx]
+    return node_end
+
+
+# 每个节点的(父节点名, 在兄弟节点中的顺序, SNP列表)，兄弟节点的顺序决定先序，会影响同分结果的先后
+def _node_info(snapshot_list: list) -> dict:
+    child_count = {}
+    node_info_dict = {}
+    for node_name, parent_idx, snp_list in snapshot_list:
+        sibling_rank = child_count.get(parent_idx, 0)
+        child_count[parent_idx] = sibling_rank + 1
+        node_info_dict[node_name] = (
+            snapshot_list[parent_idx][0] if parent_idx != -1 else None,
+            sibling_rank,
+            snp_list,
+        )
+    return node_info_dict
+
+
+# 两个版本的单倍群分型树的差异，以及判断一个样本的已有分型结果是否可能变化
+class TreeDiff:
+    # 单倍群分型树是否为Y树
+    __is_y: bool = False
+    # 是否需要全部重新分型，单倍群名不唯一时无法按单倍群名比较
+    __full: bool = False
+    # 新增的单倍群名
+    __added_set: set = None
+    # 删除的单倍群名
+    __removed_set: set = None
+    # 父节点或兄弟节点中的顺序变化的单倍群名
+    __moved_set: set = None
+    # SNP有变化的单倍群名，包括增加或去掉snp列表键
+    __changed_set: set = None
+    # 分型结果可能变化的单倍群名：变化的单倍群，以及它们在新旧树中的子树中的单倍群。祖先的分型结果只取决于根节点到它的路径，不受影响
+    __touched_set: set = None
+    # 变化的单倍群子树中的SNP位置，{hg19|hg38|mt: {位置}}，位置为字符串
+    __changed_pos_dict: dict = None
+    # 新增、删除或移动的单倍群的所有祖先的SNP，{hg19|hg38|mt: {位置: {derived突变}}}。
+    # 用户在这些单倍群有derived突变时，这些单倍群可能因子树结构变化而新增、失去或改变终端节点
+    __structure_der_dict: dict = None
+
+    @property
+    def IsFull(self):
+        return self.__full
+
+    @property
+    def AddedHaplo(self):
+        return self.__added_set
+
+    @property
+    def RemovedHaplo(self):
+        return self.__removed_set
+
+    @property
+    def MovedHaplo(self):
+        return self.__moved_set
+
+    @property
+    def ChangedHaplo(self):
+        return self.__changed_set
+
+    @property
+    def IsEmpty(self):
+        return not self.__full and len(self.__touched_set) == 0
+
+    def __init__(self, oldSnapshot: list, newSnapshot: list, isY: bool):
+        self.__is_y = isY
+        self.__touched_set = set()
+        self.__changed_pos_dict = (
+            {"hg19": set(), "hg38": set()} if isY else {"mt": set()}
+        )
+        self.__structure_der_dict = {
+            genome_ref: {} for genome_ref in self.__changed_pos_dict
+        }
+
+        old_info_dict = _node_info(oldSnapshot)
+        new_info_dict = _node_info(newSnapshot)
+        if len(old_info_dict) != len(oldSnapshot) or len(new_info_dict) != len(
+            newSnapshot
+        ):
+            self.__full = True
+
+        self.__added_set = set(new_info_dict) - set(old_info_dict)
+        self.__removed_set = set(old_info_dict) - set(new_info_dict)
+        self.__moved_set = set()
+        self.__changed_set = set()
+        for node_name, (parent_name, sibling_rank, snp_list) in old_info_dict.items():
+            if node_name not in new_info_dict:
+                continue
+            new_parent_name, new_sibling_rank, new_snp_list = new_info_dict[node_name]
+            if parent_name != new_parent_name or sibling_rank != new_sibling_rank:
+                self.__moved_set.add(node_name)
+            if snp_list != new_snp_list:
+                self.__changed_set.add(node_name)
+
+        structure_set = self.__added_set | self.__removed_set | self.__moved_set
+        dirty_set = structure_set | self.__changed_set
+        self.__mark_touched(oldSnapshot, dirty_set, structure_set)
+        self.__mark_touched(newSnapshot, dirty_set, structure_set)
+
+    # 在一个版本的树中标记变化的单倍群的子树，并收集子树中的SNP位置和结构变化处的祖先SNP
+    def __mark_touched(self, snapshot_list: list, dirty_set: set, structure_set: set):
+        node_end = _subtree_end(snapshot_list)
+
+        pos_slot_list = [("hg19", 1), ("hg38", 2)] if self.__is_y else [("mt", 3)]
+        # 子树用差分数组标记，嵌套的子树不重复遍历
+        subtree_mark = [0] * (len(snapshot_list) + 1)
+        for node_idx, (node_name, parent_idx, _) in enumerate(snapshot_list):
+            if node_name not in dirty_set:
+                continue
+            subtree_mark[node_idx] += 1
+            subtree_mark[node_end[node_idx]] -= 1
+
+            # 任何一个祖先的终端节点都在它的整个子树中查找，子树结构变化后，用户有derived突变的祖先都可能新增、失去或改变终端节点，一直记录到根节点
+            if node_name in structure_set:
+                structure_idx = parent_idx
+                while structure_idx != -1:
+                    self.__add_structure_snp(
+                        snapshot_list[structure_idx][2], pos_slot_list
+                    )
+                    structure_idx = snapshot_list[structure_idx][1]
+
+        dirty_depth = 0
+        for node_idx, (node_name, _, snp_list) in enumerate(snapshot_list):
+            dirty_depth += subtree_mark[node_idx]
+            if dirty_depth > 0:
+                self.__touched_set.add(node_name)
+                for snp in snp_list if snp_list != None else []:
+                    for genome_ref, pos_slot in pos_slot_list:
+                        if snp[pos_slot] != None:
+                            self.__changed_pos_dict[genome_ref].add(str(snp[pos_slot]))
+
+    # 记录结构变化处的祖先单倍群SNP的位置和derived突变
+    def __add_structure_snp(self, snp_list: list, pos_slot_list: list):
+        for snp in snp_list if snp_list != None else []:
+            if not isinstance(snp[5], str):
+                continue
+            for genome_ref, pos_slot in pos_slot_list:
+                if snp[pos_slot] != None:
+                    self.__structure_der_dict[genome_ref].setdefault(
+                        str(snp[pos_slot]), set()
+                    ).add(snp[5].upper())
+
+    # 判断样本是否需要重新分型：已有分型结果的单倍群在变化的单倍群子树中，用户检测的位置在变化的单倍群子树中，或用户在结构变化处的祖先有derived突变。
+    # haplo_name_list是已有分型结果的单倍群名，保存了分型路径时也可以包括路径上的单倍群名；user_genome是用户的{位置: 基因型}
+    def needs_retyping(
+        self, haplo_name_list: list, user_genome: dict, genome_ref: str = "hg19"
+    ) -> bool:
+        if self.__full:
+            return True
+
+        for haplo_name in haplo_name_list:
+            if haplo_name in self.__touched_set:
+                return True
+
+        if user_genome == None or len(user_genome) == 0:
+            return False
+
+        if not self.__is_y:
+            pos_index_ref = "mt"
+        elif genome_ref[:4].lower() == "hg19":
+            pos_index_ref = "hg19"
+        else:
+            pos_index_ref = "hg38"
+        changed_pos_set = self.__changed_pos_dict[pos_index_ref]
+
+        # 从用户位置和变化位置中较少的一方查找交集，用户位置可以是str或int
+        if len(user_genome) <= len(changed_pos_set):
+            if any(str(pos) in changed_pos_set for pos in user_genome):
+                return True
+        elif any(
+            pos in user_genome or (pos.isdecimal() and int(pos) in user_genome)
+            for pos in changed_pos_set
+        ):
+            return True
+
+        # 结构变化处的祖先SNP只需检查用户突变是否为derived
+        key_type = int if type(next(iter(user_genome))) == int else str
+        for pos, derived_set in self.__structure_der_dict[pos_index_ref].items():
+            if key_type == int:
+                if not pos.isdecimal():
+                    continue
+                pos = int(pos)
+            genotype = user_genome.get(pos)
+            if genotype and genotype[0].upper() in derived_set:
+                return True
+        return False
+
+    # 差异摘要
+    def to_dict(self) -> dict:
+        return {
+            "full": self.__full,
+            "added": sorted(self.__added_set),
+            "removed": sorted(self.__removed_set),
+            "moved": sorted(self.__moved_set),
+            "changed": sorted(self.__changed_set),
+            "touched_haplo_count": len(self.__touched_set),
+            "changed_pos_count": {
+                genome_ref: len(pos_set)
+                for genome_ref, pos_set in self.__changed_pos_dict.items()
+            },
+        }
+
+
+# 比较两个版本的单倍群分型树，两棵树必须同为Y或同为mt
+def diff_trees(old_haplo: Haplotyping, new_haplo: Haplotyping) -> TreeDiff:
+    if old_haplo.IsYorMt[:1] != new_haplo.IsYorMt[:1]:
+        raise Exception("两个单倍群树的类型不同，无法比较")
+    return TreeDiff(
+        old_haplo.node_snapshot(),
+        new_haplo.node_snapshot(),
+        old_haplo.IsYorMt.startswith("Y"),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="比较两个版本的单倍群分型树")
+    parser.add_argument("old_tree", help="旧版本的单倍群树文件")
+    parser.add_argument("new_tree", help="新版本的单倍群树文件")
+    parser.add_argument(
+        "--type", choices=["y", "mt"], required=True, help="单倍群树是Y或mt"
+    )
+    parser.add_argument("--source", default="mf", help="单倍群树数据源，默认为mf")
+    args = parser.parse_args()
+
+    try:
+        tree_diff = diff_trees(
+            Haplotyping(args.old_tree, args.source, args.type),
+            Haplotyping(args.new_tree, args.source, args.type),
+        )
+    except Exception as e:
+        for msg in e.args:
+            sys.stderr.write(str(msg))
+        exit(2)
+    print(json.dumps(tree_diff.to_dict(), ensure_ascii=False, indent=2))
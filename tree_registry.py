@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from haplotyping import Haplotyping
+from family_dict import YFamilyDict
+from result_cache import ResultCache
+from subtree_pool import SubtreePool
+from instrument import Instrument, timed
+
+
+# 多数据源的单倍群分型树注册表，同时管理多个来源的Y和mt单倍群分型树。
+# 单倍群分型树首次使用时加载，已加载的树按最近使用顺序排列，估算内存超过预算时淘汰最久未使用的树；被淘汰的树仍可被正在进行的分析使用，之后再次使用时重新加载（有预编译缓存时加载很快）
+class TreeRegistry:
+    # 单倍群分型树的内存预算，字节，0表示不限制
+    __memory_budget: int = 0
+    # 未注册的数据源使用的单倍群分型树目录，文件名为 {来源}_{y|mt}_snp_tree.json
+    __tree_dir: str = "haplotree"
+    # 注册的单倍群分型树参数，{(来源, y|mt): {"file": 文件名, "dict": Y家族字典文件名, Haplotyping的其它参数}}
+    __tree_option_dict: dict = None
+    # 已加载的单倍群分型树，按最近使用顺序排列，{(来源, y|mt): (Haplotyping, 估算内存)}
+    __tree_dict: OrderedDict = None
+    # 已加载的单倍群分型树的估算内存总和，字节。只包括本进程内的分型对象，不包括子树进程池的工作进程各自加载的树
+    __memory_size: int = 0
+    # 每个单倍群分型树的加载锁，同一棵树只加载一次，不同的树可以同时加载
+    __load_lock_dict: dict = None
+    # 每个数据源的Y家族字典，没有字典文件的数据源为None
+    __y_dict_dict: dict = None
+    # 所有单倍群分型树共用的分型结果缓存，缓存键包括数据源和树版本，None表示不缓存
+    __result_cache: ResultCache = None
+    # 单倍群分型树共享映像目录，文件名为 {来源}_{y|mt}_snp_tree.shm，多个进程使用同一目录时共享编译结果，None表示不共享
+    __shared_tree_dir: str = None
+    # 单个样本分型拆分子树的工作进程数，小于2表示不拆分
+    __subtree_workers: int = 0
+    # 已加载的单倍群分型树的子树进程池，{(来源, y|mt): SubtreePool}，树被淘汰或重新注册时关闭，树重新加载后重新创建
+    __subtree_pool_dict: dict = None
+    __lock: threading.Lock = None
+
+    @property
+    def MemoryBudget(self):
+        return self.__memory_budget
+
+    @property
+    def MemorySize(self):
+        return self.__memory_size
+
+    @property
+    def ResultCache(self):
+        return self.__result_cache
+
+    @property
+    def SubtreeWorkers(self):
+        return self.__subtree_workers
+
+    @property
+    def LoadedTrees(self):
+        with self.__lock:
+            return list(self.__tree_dict.keys())
+
+    def __init__(
+        self,
+        memoryBudget: int = 0,
+        treeDir: str = "haplotree",
+        resultCache: ResultCache = None,
+        sharedTreeDir: str = None,
+        subtreeWorkers: int = 0,
+    ):
+        if memoryBudget < 0:
+            raise Exception("内存预算不能为负数")
+
+        self.__memory_budget = memoryBudget
+        self.__tree_dir = treeDir
+        self.__result_cache = resultCache
+        self.__shared_tree_dir = sharedTreeDir
+        self.__subtree_workers = subtreeWorkers
+        self.__subtree_pool_dict = {}
+        if sharedTreeDir != None:
+            os.makedirs(sharedTreeDir, exist_ok=True)
+        self.__tree_option_dict = {}
+        self.__tree_dict = OrderedDict()
+        self.__load_lock_dict = {}
+        self.__y_dict_dict = {}
+        self.__lock = threading.Lock()
+
+    # 单倍群分型树的注册键，来源不区分大小写
+    @staticmethod
+    def __tree_key(source: str, isYorMt: str) -> tuple:
+        is_y_mt = isYorMt.lower()
+        if is_y_mt not in ("y", "mt"):
+            raise Exception("请指定单倍群树是：y或mt")
+        return (source.lower(), is_y_mt)
+
+    # 注册一个数据源的Y或mt单倍群分型树，options为Haplotyping的其它参数，如键名和分型阈值。已加载的同名树会在下次使用时按新参数重新加载。
+    # yDictFileName为Y家族字典文件名，只能随Y单倍群树注册，未指定时使用默认目录和文件名
+    def register(
+        self,
+        source: str,
+        isYorMt: str,
+        haploTreeFileName: str = None,
+        yDictFileName: str = None,
+        **options
+    ):
+        tree_key = self.__tree_key(source, isYorMt)
+        if yDictFileName != None and tree_key[1] != "y":
+            raise Exception("Y家族字典只能随Y单倍群树注册")
+        tree_option = dict(options)
+        tree_option["file"] = haploTreeFileName
+        tree_option["dict"] = yDictFileName
+        with self.__lock:
+            self.__tree_option_dict[tree_key] = tree_option
+            if tree_key[1] == "y":
+                self.__y_dict_dict.pop(tree_key[0], None)
+            if tree_key in self.__tree_dict:
+                _, memory_size = self.__tree_dict.pop(tree_key)
+                self.__memory_size -= memory_size
+                self.__close_subtree_pool(tree_key)
+
+    # 从JSON配置文件注册单倍群分型树：{来源: {"y"|"mt": {"file": 文件名, "dict": Y家族字典文件名, Haplotyping的其它参数}}}，相对路径相对于配置文件所在目录
+    def load_config(self, configFileName: str):
+        with open(configFileName, "r", encoding="utf-8-sig") as config_file:
+            config_dict = json.load(config_file)
+        config_dir = os.path.dirname(os.path.abspath(configFileName))
+        for source, source_config in config_dict.items():
+            for is_y_mt, tree_option in source_config.items():
+                tree_option = dict(tree_option)
+                tree_file_name = tree_option.pop("file", None)
+                if tree_file_name != None:
+                    tree_file_name = os.path.join(config_dir, tree_file_name)
+                dict_file_name = tree_option.pop("dict", None)
+                if dict_file_name != None:
+                    dict_file_name = os.path.join(config_dir, dict_file_name)
+                self.register(
+                    source, is_y_mt, tree_file_name, dict_file_name, **tree_option
+                )
+
+    # 单倍群分型树文件名，未注册或未指定文件名时使用默认目录和文件名
+    def __tree_file_name(self, source: str, is_y_mt: str, tree_option: dict) -> str:
+        if tree_option.get("file") != None:
+            return tree_option["file"]
+        return os.path.join(
+            self.__tree_dir, "{}_{}_snp_tree.json".format(source, is_y_mt)
+        )
+
+    # 获取数据源的Y或mt单倍群分型对象，未加载时加载，并淘汰超出内存预算的最久未使用的树
+    def get_haplo(self, source: str, isYorMt: str) -> Haplotyping:
+        tree_key = self.__tree_key(source, isYorMt)
+        with self.__lock:
+            if tree_key in self.__tree_dict:
+                self.__tree_dict.move_to_end(tree_key)
+                return self.__tree_dict[tree_key][0]
+            load_lock = self.__load_lock_dict.setdefault(tree_key, threading.Lock())
+
+        # 加载时不持有注册表的锁，其它已加载的树可以继续使用，不同的树可以同时加载
+        with load_lock:
+            with self.__lock:
+                if tree_key in self.__tree_dict:
+                    self.__tree_dict.move_to_end(tree_key)
+                    return self.__tree_dict[tree_key][0]
+                tree_option = dict(self.__tree_option_dict.get(tree_key, {}))
+
+            tree_file_name = self.__tree_file_name(
+                tree_key[0], tree_key[1], tree_option
+            )
+            tree_option.pop("file", None)
+            tree_option.pop("dict", None)
+            tree_option.setdefault("resultCache", self.__result_cache)
+            if self.__shared_tree_dir != None:
+                tree_option.setdefault(
+                    "sharedTreeFileName",
+                    os.path.join(
+                        self.__shared_tree_dir,
+                        "{}_{}_snp_tree.shm".format(tree_key[0], tree_key[1]),
+                    ),
+                )
+            haplo = Haplotyping(tree_file_name, source, tree_key[1], **tree_option)
+            memory_size = haplo.MemorySize
+
+            with self.__lock:
+                self.__tree_dict[tree_key] = (haplo, memory_size)
+                self.__memory_size += memory_size
+                self.__evict()
+            return haplo
+
+    # 获取数据源的Y或mt单倍群分型树的子树进程池，未指定子树工作进程数，或树刚被淘汰时返回None。
+    # 树被淘汰或重新注册时关闭它的进程池，正在进行的分析改为在本进程计算未提交的子树
+    def get_subtree_pool(self, source: str, isYorMt: str) -> SubtreePool:
+        if self.__subtree_workers < 2:
+            return None
+        tree_key = self.__tree_key(source, isYorMt)
+        haplo = self.get_haplo(source, isYorMt)
+        with self.__lock:
+            loaded_tree = self.__tree_dict.get(tree_key)
+            if loaded_tree == None or loaded_tree[0] is not haplo:
+                return None
+            subtree_pool = self.__subtree_pool_dict.get(tree_key)
+            if subtree_pool == None or subtree_pool.HaploObj is not haplo:
+                self.__close_subtree_pool(tree_key)
+                subtree_pool = SubtreePool(haplo, self.__subtree_workers)
+                self.__subtree_pool_dict[tree_key] = subtree_pool
+            return subtree_pool
+
+    # 关闭并移除单倍群分型树的子树进程池，不等待已提交的计算，调用时持有注册表的锁
+    def __close_subtree_pool(self, tree_key: tuple):
+        subtree_pool = self.__subtree_pool_dict.pop(tree_key, None)
+        if subtree_pool != None:
+            subtree_pool.close(wait=False)
+
+    # 淘汰最久未使用的树，直到估算内存不超过预算，最近使用的树总是保留
+    def __evict(self):
+        if self.__memory_budget == 0:
+            return
+        while (
+            self.__memory_size > self.__memory_budget and len(self.__tree_dict) > 1
+        ):
+            tree_key, (_, memory_size) = self.__tree_dict.popitem(last=False)
+            self.__memory_size -= memory_size
+            self.__close_subtree_pool(tree_key)
+
+    # 获取数据源的Y家族字典，未注册字典文件时使用默认目录和文件名，没有字典文件时返回None
+    def get_y_dict(self, source: str) -> YFamilyDict:
+        source = source.lower()
+        with self.__lock:
+            if source not in self.__y_dict_dict:
+                dict_file_name = self.__tree_option_dict.get((source, "y"), {}).get(
+                    "dict"
+                )
+                if dict_file_name == None:
+                    dict_file_name = os.path.join(
+                        self.__tree_dir, "{}_y_dict.json".format(source)
+                    )
+                self.__y_dict_dict[source] = (
+                    YFamilyDict(dict_file_name)
+                    if os.access(dict_file_name, os.F_OK)
+                    else None
+                )
+            return self.__y_dict_dict[source]
+
+    # 用多个数据源的单倍群分型树分析同一个用户的Y和mt基因数据，user_chrom_dict为extract_positions的结果，只需准备一次。
+    # 返回 {(来源, y|mt): 分型结果列表}，没有基因数据的染色体不分析。workers大于1时各棵树同时加载和分析，未加载的树的加载时间可以与其它树的分析重叠。
+    # 有时间预算时每棵树逐步分析，预算用完时返回当前最好的结果；否则使用子树进程池（如有）。instrument不为None时汇总各棵树的统计
+    def analyse_sources(
+        self,
+        user_chrom_dict: dict,
+        source_list: list,
+        genome_ref: str = "hg19",
+        workers: int = 1,
+        timeBudget: float = None,
+        instrument: Instrument = None,
+    ) -> dict:
+        task_list = []
+        for source in source_list:
+            for is_y_mt, chromosome in (("y", "Y"), ("mt", "MT")):
+                user_genome = user_chrom_dict.get(chromosome)
+                if user_genome != None and len(user_genome) > 0:
+                    task_list.append((source, is_y_mt, user_genome))
+
+        # 统计对象不在线程间共享，每棵树使用独立的对象，分析完成后汇总
+        task_instrument_list = [
+            Instrument() if instrument != None else None for _ in task_list
+        ]
+
+        def analyse_task(task_idx: int) -> list:
+            source, is_y_mt, user_genome = task_list[task_idx]
+            task_instrument = task_instrument_list[task_idx]
+            with timed(task_instrument, is_y_mt + ".tree_load"):
+                haplo = self.get_haplo(source, is_y_mt)
+            if timeBudget != None:
+                return haplo.analyse(
+                    user_genome,
+                    genome_ref,
+                    instrument=task_instrument,
+                    timeBudget=timeBudget,
+                )
+            return haplo.analyse(
+                user_genome,
+                genome_ref,
+                instrument=task_instrument,
+                subtreePool=self.get_subtree_pool(source, is_y_mt),
+            )
+
+        if workers > 1 and len(task_list) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(task_list))) as executor:
+                haplo_list_list = list(executor.map(analyse_task, range(len(task_list))))
+        else:
+            haplo_list_list = [analyse_task(task_idx) for task_idx in range(len(task_list))]
+
+        if instrument != None:
+            for task_instrument in task_instrument_list:
+                instrument.merge(task_instrument)
+        return {
+            (source, is_y_mt): haplo_list
+            for (source, is_y_mt, _), haplo_list in zip(task_list, haplo_list_list)
+        }
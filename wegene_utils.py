@@ -1,116 +1,681 @@
-# -*- coding: utf-8 -*-
-
-__all__ = [
-    "process_raw_genome_data",
-    "is_genotype_exist",
-    "is_wegene_format",
-    "get_genome_from_tsv",
-    "get_genome_from_json",
-]
-
-import sys
-import gzip
-import base64
-from io import BytesIO
-import json
-
-
-def sort_genotype(genotyope):
-    return "".join(sorted(genotyope))
-
-
-"""
-Reads the genome string anmd format and parse into a dict of
-    {'rs1234': {'genotype': 'AA', 'chromosome': '1', position: '123456'}, ...}
-"""
-
-
-def parse_genome_string(genome_str, genome_format):
-    try:
-        genome_dict = {}
-        # Index files for all posible formats will be provided automatically
-        # Do not change the default path below if you wish to use those
-        with open("./indexes/index_" + genome_format + ".idx", "r") as idx_f:
-            # 统计基因数据模板的行数，
-            tmpl_line_count = 0
-            for line in idx_f:
-                if not line.startswith("NA") and line.strip() != "":
-                    tmpl_line_count += 1
-                    fields = line.strip().split("\t")
-                    index_pos = fields[0].strip()
-                    rsid = fields[1].strip()
-                    chromosome = fields[2].strip()
-                    position = fields[3].strip()
-                    start_pos = int(index_pos) * 2
-                    genome_dict[rsid] = {
-                        "genotype": sort_genotype(
-                            genome_str[start_pos : start_pos + 2]
-                        ),
-                        "chromosome": chromosome,
-                        "position": position,
-                    }
-
-            # 校验用户分型的位点数和基因索引是否一致
-            if len(genome_str) // 2 != tmpl_line_count:
-                raise Exception(
-                    "您的基因样本位点数：{:,}，基因模板（{}）位点数：{:,}，两者不一致无法解析！".format(
-                        len(genome_str) // 2, genome_format, tmpl_line_count
-                    )
-                )
-
-        return genome_dict
-    except Exception as e:
-        raise e
-
-
-def process_raw_genome_data(raw_inputs):
-    try:
-        genome = str(
-            gzip.GzipFile(fileobj=BytesIO(base64.b64decode(raw_inputs["data"]))).read(),
-            encoding="utf8",
-        )
-        genome_format = raw_inputs["format"]
-        return parse_genome_string(genome, genome_format)
-    except Exception as e:
-        raise e
-
-
-def is_genotype_exist(input, rsid):
-    return rsid in input and input[rsid] != "--" and input[rsid] != "__"
-
-
-def is_wegene_format(format_str):
-    return "wegene_" in format_str
-
-
-# 从TSV格式文件加载基因数据
-def get_genome_from_tsv(tsvFileName):
-    user_genome = {}
-    with open(tsvFileName, "r", encoding="utf-8") as tsvFile:
-        for tsvLine in tsvFile.readlines():
-            if len(tsvLine) > 0 and not tsvLine.startswith(("#", "\n", "\t", '"')):
-                tsvLineArray = tsvLine.split("\t")
-                if len(tsvLineArray) == 4 and tsvLineArray[3][0] in [
-                    "A",
-                    "T",
-                    "G",
-                    "C",
-                ]:
-                    user_genome[tsvLineArray[0]] = {
-                        "chromosome": tsvLineArray[1].strip(),
-                        "position": tsvLineArray[2].strip(),
-                        "genotype": tsvLineArray[3].strip(),
-                    }
-
-    return user_genome
-
-
-# 从JSON格式文件加载基因数据
-def get_genome_from_json(jsonFileName):
-    user_genome = {}
-    with open(jsonFileName, "r", encoding="utf-8") as jsonFile:
-        jFile = jsonFile.read()
-        if len(jFile) > 0:
-            user_genome = json.loads(jFile)
-
-    return user_genome
+# -*- coding: utf-8 -*-
+
+__all__ = [
+    "process_raw_genome_data",
+    "is_genotype_exist",
+    "is_wegene_format",
+    "get_genome_from_tsv",
+    "get_genome_from_json",
+    "detect_genome_file_format",
+    "iter_positions_from_file",
+    "get_positions_from_file",
+    "load_genome_index",
+    "extract_positions",
+]
+
+import os
+import sys
+import gzip
+import mmap
+import zlib
+import base64
+import struct
+import binascii
+import threading
+import contextlib
+from io import BytesIO
+from array import array
+import json
+
+
+def sort_genotype(genotyope):
+    return "".join(sorted(genotyope))
+
+
+# 原始基因型到排序后基因型的缓存，基因型种类很少，避免每个位点都排序
+_sorted_genotype_cache = {}
+
+
+# 从基因数据中读取排序后的基因型，基因数据可以是字符串，也可以是解压后的只读字节缓冲区
+def _read_genotype(genome, start_pos):
+    if isinstance(genome, str):
+        genotype = genome[start_pos : start_pos + 2]
+    else:
+        genotype = bytes(genome[start_pos : start_pos + 2])
+    sorted_genotype = _sorted_genotype_cache.get(genotype)
+    if sorted_genotype == None:
+        sorted_genotype = sort_genotype(
+            genotype if isinstance(genotype, str) else str(genotype, "utf-8")
+        )
+        if len(_sorted_genotype_cache) < 4096:
+            _sorted_genotype_cache[genotype] = sorted_genotype
+    return sorted_genotype
+
+
+# 校验用户分型的位点数和基因索引是否一致
+def _check_genome_size(genome_size, genome_format, index_count):
+    if genome_size // 2 != index_count:
+        raise Exception(
+            "您的基因样本位点数：{:,}，基因模板（{}）位点数：{:,}，两者不一致无法解析！".format(
+                genome_size // 2, genome_format, index_count
+            )
+        )
+
+
+# 预编译基因索引文件的格式版本，格式变化时需要增加，使旧的预编译文件重新生成
+GENOME_INDEX_VERSION = 2
+_GENOME_INDEX_MAGIC = b"WGIDX\x00\x00\x00"
+# 进程内已加载的预编译基因索引，{基因数据格式: GenomeIndex}
+_genome_index_cache = {}
+_genome_index_lock = threading.Lock()
+
+
+def _genome_index_file_name(genome_format):
+    # Index files for all posible formats will be provided automatically
+    # Do not change the default path below if you wish to use those
+    return "./indexes/index_" + genome_format + ".idx"
+
+
+"""
+Compiled chip index, one record per genome position in index file order:
+    index_pos     int32 column, offset of the genotype in the genome string / 2
+    chrom_code    uint8 column, code into the header's chromosome list
+    rsid/position string tables (uint32 offsets + utf-8 blob)
+    chrom_record  int32 record numbers grouped by chromosome, each group in
+                  index file order; the header maps chromosome -> [start, end)
+The file is a magic, a length-prefixed JSON header and 8-byte aligned sections,
+memory-mapped so the numeric columns are used in place without parsing.
+"""
+
+
+class GenomeIndex:
+    # 索引记录数
+    count: int = 0
+    # 染色体名称表
+    chromosomes: list = None
+    # 每条记录在基因数据字符串中的位点序号
+    index_pos: memoryview = None
+    # 每条记录的染色体编码
+    chrom_code: memoryview = None
+
+    def __init__(self, buffer):
+        self.__buffer = buffer
+        if bytes(buffer[: len(_GENOME_INDEX_MAGIC)]) != _GENOME_INDEX_MAGIC:
+            raise ValueError("预编译基因索引文件格式错误")
+        header_start = len(_GENOME_INDEX_MAGIC) + 4
+        header_len = struct.unpack("<I", buffer[len(_GENOME_INDEX_MAGIC) : header_start])[0]
+        header = json.loads(bytes(buffer[header_start : header_start + header_len]))
+        if header["version"] != GENOME_INDEX_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError("预编译基因索引文件版本不一致")
+
+        self.header = header
+        self.count = header["count"]
+        self.chromosomes = header["chromosomes"]
+        self.index_pos = self.__section("index_pos", "i")
+        self.chrom_code = self.__section("chrom_code", "B")
+        self.chrom_record = self.__section("chrom_record", "i")
+        self.__rsid_offset = self.__section("rsid_offset", "I")
+        self.__rsid_blob = self.__section("rsid_blob")
+        self.__position_offset = self.__section("position_offset", "I")
+        self.__position_blob = self.__section("position_blob")
+        self.__rsid_list = None
+        self.__position_list = None
+
+    def __len__(self):
+        return self.count
+
+    def __section(self, name, fmt=None):
+        start, end = self.header["sections"][name]
+        view = memoryview(self.__buffer)[start:end]
+        return view.cast(fmt) if fmt != None else view
+
+    def __string_table(self, name):
+        # 整块解码后一次切分，比逐条按偏移解码更快
+        if self.count == 0:
+            return []
+        return str(self.__section(name + "_blob"), "utf-8")[:-1].split("\n")
+
+    # 全部rsid，按索引文件顺序
+    @property
+    def rsid_list(self):
+        if self.__rsid_list == None:
+            self.__rsid_list = self.__string_table("rsid")
+        return self.__rsid_list
+
+    # 全部位置，按索引文件顺序
+    @property
+    def position_list(self):
+        if self.__position_list == None:
+            self.__position_list = self.__string_table("position")
+        return self.__position_list
+
+    # 第i条记录的rsid
+    def rsid(self, i):
+        offset = self.__rsid_offset
+        return str(self.__rsid_blob[offset[i] : offset[i + 1] - 1], "utf-8")
+
+    # 第i条记录的位置
+    def position(self, i):
+        offset = self.__position_offset
+        return str(self.__position_blob[offset[i] : offset[i + 1] - 1], "utf-8")
+
+    # 第i条记录的染色体
+    def chromosome(self, i):
+        return self.chromosomes[self.chrom_code[i]]
+
+    # 指定染色体的全部记录序号，按索引文件顺序
+    def chromosome_records(self, chromosome):
+        if chromosome not in self.header["chrom_ranges"]:
+            return self.chrom_record[0:0]
+        start, end = self.header["chrom_ranges"][chromosome]
+        return self.chrom_record[start:end]
+
+
+# 解析文本格式的基因索引文件，按原有规则跳过NA和空行，返回(位点序号, rsid, 染色体, 位置)列表
+def _read_text_genome_index(idx_file_name):
+    record_list = []
+    with open(idx_file_name, "r") as idx_f:
+        for line in idx_f:
+            if not line.startswith("NA") and line.strip() != "":
+                fields = line.strip().split("\t")
+                record_list.append(
+                    (
+                        int(fields[0].strip()),
+                        fields[1].strip(),
+                        fields[2].strip(),
+                        fields[3].strip(),
+                    )
+                )
+    return record_list
+
+
+# 把基因索引记录打包为预编译基因索引的二进制内容
+def _pack_genome_index(record_list, source_stat):
+    chromosomes = []
+    chrom_code_dict = {}
+    index_pos = array("i")
+    chrom_code = array("B")
+    for record in record_list:
+        if record[2] not in chrom_code_dict:
+            chrom_code_dict[record[2]] = len(chromosomes)
+            chromosomes.append(record[2])
+        index_pos.append(record[0])
+        chrom_code.append(chrom_code_dict[record[2]])
+
+    # 按染色体分组的记录序号，按染色体筛选时只需访问这些记录
+    chrom_record = array("i")
+    chrom_ranges = {}
+    chrom_record_list = [[] for _ in chromosomes]
+    for i, code in enumerate(chrom_code):
+        chrom_record_list[code].append(i)
+    for code, record_list_of_chrom in enumerate(chrom_record_list):
+        chrom_ranges[chromosomes[code]] = [
+            len(chrom_record),
+            len(chrom_record) + len(record_list_of_chrom),
+        ]
+        chrom_record.extend(record_list_of_chrom)
+
+    section_list = [
+        ("index_pos", index_pos.tobytes()),
+        ("chrom_code", chrom_code.tobytes()),
+        ("chrom_record", chrom_record.tobytes()),
+    ]
+    for name, field in (("rsid", 1), ("position", 3)):
+        # 每个字符串以\n结尾，整块可以一次切分，单条可以按偏移读取
+        encoded_list = [record[field].encode("utf-8") + b"\n" for record in record_list]
+        offset = array("I", [0])
+        for encoded in encoded_list:
+            offset.append(offset[-1] + len(encoded))
+        section_list.append((name + "_offset", offset.tobytes()))
+        section_list.append((name + "_blob", b"".join(encoded_list)))
+
+    header = {
+        "version": GENOME_INDEX_VERSION,
+        "byteorder": sys.byteorder,
+        "count": len(record_list),
+        "source_mtime_ns": source_stat.st_mtime_ns,
+        "source_size": source_stat.st_size,
+        "chromosomes": chromosomes,
+        "chrom_ranges": chrom_ranges,
+        "sections": {},
+    }
+    # 节区偏移依赖头部长度，反复生成头部直到数据起始位置不再变化
+    data_start = 0
+    while True:
+        offset = data_start
+        for name, data in section_list:
+            header["sections"][name] = [offset, offset + len(data)]
+            offset = (offset + len(data) + 7) // 8 * 8
+        header_bytes = json.dumps(header).encode("utf-8")
+        header_end = (len(_GENOME_INDEX_MAGIC) + 4 + len(header_bytes) + 7) // 8 * 8
+        if header_end == data_start:
+            break
+        data_start = header_end
+
+    packed = bytearray(_GENOME_INDEX_MAGIC)
+    packed += struct.pack("<I", len(header_bytes))
+    packed += header_bytes
+    for name, data in section_list:
+        packed += b"\x00" * (header["sections"][name][0] - len(packed))
+        packed += data
+    return bytes(packed)
+
+
+# 加载基因数据格式对应的预编译基因索引，不存在或过期时由文本索引文件重新生成。
+# 预编译文件与文本索引文件放在一起，目录不可写时只在内存中使用
+def load_genome_index(genome_format):
+    idx_file_name = _genome_index_file_name(genome_format)
+    source_stat = os.stat(idx_file_name)
+    with _genome_index_lock:
+        genome_index = _genome_index_cache.get(genome_format)
+        if (
+            genome_index != None
+            and genome_index.header["source_mtime_ns"] == source_stat.st_mtime_ns
+            and genome_index.header["source_size"] == source_stat.st_size
+        ):
+            return genome_index
+
+        bin_file_name = idx_file_name + ".bin"
+        genome_index = None
+        try:
+            with open(bin_file_name, "rb") as bin_f:
+                genome_index = GenomeIndex(
+                    mmap.mmap(bin_f.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+            if (
+                genome_index.header["source_mtime_ns"] != source_stat.st_mtime_ns
+                or genome_index.header["source_size"] != source_stat.st_size
+            ):
+                genome_index = None
+        except (OSError, ValueError, KeyError, struct.error):
+            genome_index = None
+
+        if genome_index == None:
+            packed = _pack_genome_index(
+                _read_text_genome_index(idx_file_name), source_stat
+            )
+            tmp_file_name = "{}.{}.tmp".format(bin_file_name, os.getpid())
+            try:
+                with open(tmp_file_name, "wb") as bin_f:
+                    bin_f.write(packed)
+                os.replace(tmp_file_name, bin_file_name)
+            except OSError:
+                if os.access(tmp_file_name, os.F_OK):
+                    os.remove(tmp_file_name)
+            genome_index = GenomeIndex(packed)
+
+        _genome_index_cache[genome_format] = genome_index
+        return genome_index
+
+
+"""
+Reads the genome string anmd format and parse into a dict of
+    {'rs1234': {'genotype': 'AA', 'chromosome': '1', position: '123456'}, ...}
+"""
+
+
+def parse_genome_string(genome_str, genome_format):
+    try:
+        genome_dict = {}
+        # 使用预编译基因索引，不再逐行读取和切分文本索引文件
+        genome_index = load_genome_index(genome_format)
+
+        # 校验用户分型的位点数和基因索引是否一致
+        _check_genome_size(len(genome_str), genome_format, len(genome_index))
+
+        chromosomes = genome_index.chromosomes
+        for index_pos, rsid, chrom_code, position in zip(
+            genome_index.index_pos,
+            genome_index.rsid_list,
+            genome_index.chrom_code,
+            genome_index.position_list,
+        ):
+            genome_dict[rsid] = {
+                "genotype": _read_genotype(genome_str, index_pos * 2),
+                "chromosome": chromosomes[chrom_code],
+                "position": position,
+            }
+
+        return genome_dict
+    except Exception as e:
+        raise e
+
+
+def _decode_genome_data(raw_inputs):
+    return str(
+        gzip.GzipFile(fileobj=BytesIO(base64.b64decode(raw_inputs["data"]))).read(),
+        encoding="utf8",
+    )
+
+
+# 每次base64解码的字符数，必须是4的倍数
+_BASE64_CHUNK_SIZE = 1 << 16
+# 每次解压输出的最大字节数
+_INFLATE_CHUNK_SIZE = 1 << 20
+
+
+"""
+Streams the base64 text through gzip inflation straight into one preallocated
+buffer of the size given by the chip index, so neither the full compressed
+bytes nor a decoded str copy of the genome are ever held in memory. Returns a
+read-only memoryview; genotypes are read from it by offset.
+"""
+
+
+def _decode_genome_buffer(raw_inputs, genome_format, index_count):
+    data = raw_inputs["data"]
+    genome_size = index_count * 2
+    genome_buffer = bytearray(genome_size)
+    genome_view = memoryview(genome_buffer)
+    write_pos = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        for chunk_start in range(0, len(data), _BASE64_CHUNK_SIZE):
+            compressed = binascii.a2b_base64(
+                data[chunk_start : chunk_start + _BASE64_CHUNK_SIZE]
+            )
+            while len(compressed) > 0:
+                # gzip可以由多段拼接而成，上一段结束后的数据属于下一段
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                inflated = decompressor.decompress(compressed, _INFLATE_CHUNK_SIZE)
+                # 超出基因索引的部分只计数，用于提示位点数不一致
+                if write_pos < genome_size:
+                    copy_size = min(len(inflated), genome_size - write_pos)
+                    genome_view[write_pos : write_pos + copy_size] = inflated[:copy_size]
+                write_pos += len(inflated)
+
+                # 一段恰好在输出达到上限时结束，unconsumed_tail也不为空，其中是下一段的数据，与unused_data相同
+                compressed = (
+                    decompressor.unused_data
+                    if decompressor.eof
+                    else decompressor.unconsumed_tail
+                )
+    except (binascii.Error, zlib.error):
+        # 无法流式解码的数据（如base64中有换行）按原方式整体解码
+        genome = _decode_genome_data(raw_inputs)
+        _check_genome_size(len(genome), genome_format, index_count)
+        return genome
+
+    if not decompressor.eof:
+        raise Exception("基因数据不完整，无法解压")
+
+    _check_genome_size(write_pos, genome_format, index_count)
+    return genome_view.toreadonly()
+
+
+def process_raw_genome_data(raw_inputs):
+    try:
+        genome_format = raw_inputs["format"]
+        genome_index = load_genome_index(genome_format)
+        genome = _decode_genome_buffer(raw_inputs, genome_format, len(genome_index))
+        return parse_genome_string(genome, genome_format)
+    except Exception as e:
+        raise e
+
+
+# 统计阶段耗时，instrument为None时不做任何统计
+def _timed(instrument, name):
+    if instrument == None:
+        return contextlib.nullcontext()
+    return instrument.stage(name)
+
+
+"""
+Extracts only the given chromosomes from the raw inputs into
+    {'Y': {'2781': 'AA', ...}, 'MT': {'73': 'GG', ...}}
+using the per-chromosome record lists of the compiled index, without building
+the full rsid dict. No-call and indel genotypes are dropped in the same pass.
+When an instrument is given, index load, decode and filtering are timed
+separately and the record/position counts are added to it.
+"""
+
+
+def extract_positions(raw_inputs, chromosomes=("Y", "MT"), instrument=None):
+    try:
+        genome_format = raw_inputs["format"]
+        with _timed(instrument, "genome_index"):
+            genome_index = load_genome_index(genome_format)
+        with _timed(instrument, "genome_decode"):
+            genome = _decode_genome_buffer(
+                raw_inputs, genome_format, len(genome_index)
+            )
+
+        chrom_genome_dict = {}
+        index_pos = genome_index.index_pos
+        with _timed(instrument, "genome_filter"):
+            for chromosome in chromosomes:
+                position_dict = {}
+                for i in genome_index.chromosome_records(chromosome):
+                    genotype = _read_genotype(genome, index_pos[i] * 2)
+                    if genotype[0] in {"A", "T", "G", "C"}:
+                        position_dict[genome_index.position(i)] = genotype
+                chrom_genome_dict[chromosome] = position_dict
+
+        if instrument != None:
+            instrument.count("genome_record", len(genome_index))
+            for chromosome in chromosomes:
+                instrument.count(
+                    "genome_{}_pos".format(chromosome.lower()),
+                    len(chrom_genome_dict[chromosome]),
+                )
+
+        return chrom_genome_dict
+    except Exception as e:
+        raise e
+
+
+def is_genotype_exist(input, rsid):
+    return rsid in input and input[rsid] != "--" and input[rsid] != "__"
+
+
+def is_wegene_format(format_str):
+    return "wegene_" in format_str
+
+
+# 从TSV格式文件加载基因数据
+def get_genome_from_tsv(tsvFileName):
+    user_genome = {}
+    with open(tsvFileName, "r", encoding="utf-8") as tsvFile:
+        for tsvLine in tsvFile:
+            if len(tsvLine) > 0 and not tsvLine.startswith(("#", "\n", "\t", '"')):
+                tsvLineArray = tsvLine.split("\t")
+                if len(tsvLineArray) == 4 and tsvLineArray[3][0] in [
+                    "A",
+                    "T",
+                    "G",
+                    "C",
+                ]:
+                    user_genome[tsvLineArray[0]] = {
+                        "chromosome": tsvLineArray[1].strip(),
+                        "position": tsvLineArray[2].strip(),
+                        "genotype": tsvLineArray[3].strip(),
+                    }
+
+    return user_genome
+
+
+# 从JSON格式文件加载基因数据
+def get_genome_from_json(jsonFileName):
+    user_genome = {}
+    with open(jsonFileName, "r", encoding="utf-8") as jsonFile:
+        jFile = jsonFile.read()
+        if len(jFile) > 0:
+            user_genome = json.loads(jFile)
+
+    return user_genome
+
+
+# 基因数据文件格式
+GENOME_FILE_23ANDME = "23andme"
+GENOME_FILE_ANCESTRY = "ancestry"
+GENOME_FILE_FTDNA = "ftdna"
+GENOME_FILE_VCF = "vcf"
+
+# 检测格式时最多读取的文件头行数
+_DETECT_LINE_COUNT = 1000
+# AncestryDNA用数字表示性染色体和线粒体
+_ANCESTRY_CHROMOSOME_DICT = {"23": "X", "24": "Y", "25": "XY", "26": "MT"}
+
+
+# 打开基因数据文件，按文件头识别gzip压缩，不依赖扩展名
+def _open_genome_file(fileName):
+    with open(fileName, "rb") as genome_file:
+        is_gzip = genome_file.read(2) == b"\x1f\x8b"
+    if is_gzip:
+        return gzip.open(fileName, "rt", encoding="utf-8-sig", errors="replace")
+    return open(fileName, "r", encoding="utf-8-sig", errors="replace")
+
+
+# 染色体名统一为大写，去掉chr前缀，M统一为MT
+def _normalize_chromosome(chromosome, genome_format):
+    chromosome = chromosome.strip().strip('"').upper()
+    if genome_format == GENOME_FILE_ANCESTRY:
+        chromosome = _ANCESTRY_CHROMOSOME_DICT.get(chromosome, chromosome)
+    if chromosome.startswith("CHR"):
+        chromosome = chromosome[3:]
+    return "MT" if chromosome == "M" else chromosome
+
+
+# 按文件头的前几行检测格式：VCF以##fileformat=VCF或#CHROM开头，逗号分隔的是FTDNA/MyHeritage的CSV，
+# 制表符分隔的5列是AncestryDNA（两个等位基因分列），4列是23andMe（也包括get_genome_from_tsv读取的TSV）
+def _detect_format_from_lines(line_list):
+    for line in line_list:
+        if line.startswith("##fileformat=VCF") or line.startswith("#CHROM"):
+            return GENOME_FILE_VCF
+        if len(line.strip()) == 0 or line.startswith("#"):
+            continue
+        if "\t" in line:
+            column_count = len(line.rstrip("\r\n").split("\t"))
+            if column_count == 5:
+                return GENOME_FILE_ANCESTRY
+            if column_count == 4:
+                return GENOME_FILE_23ANDME
+        elif line.count(",") == 3:
+            return GENOME_FILE_FTDNA
+        break
+    raise Exception("无法识别的基因数据文件格式")
+
+
+# 检测基因数据文件的格式，支持gzip压缩的文件
+def detect_genome_file_format(fileName):
+    line_list = []
+    with _open_genome_file(fileName) as genome_file:
+        for line in genome_file:
+            line_list.append(line)
+            if len(line_list) >= _DETECT_LINE_COUNT or not line.startswith("#"):
+                break
+    return _detect_format_from_lines(line_list)
+
+
+# 解析一行VCF记录的第一个样本的基因型（GT），等位基因按REF和ALT转为碱基，nocall和indel返回None
+def _parse_vcf_genotype(field_list):
+    format_list = field_list[8].split(":")
+    if "GT" not in format_list:
+        return None
+    sample_list = field_list[9].split(":")
+    gt_index = format_list.index("GT")
+    if gt_index >= len(sample_list):
+        return None
+
+    # REF不是单个碱基的是缺失或多碱基变异
+    if len(field_list[3]) != 1:
+        return None
+    allele_list = [field_list[3].upper()]
+    if field_list[4] != ".":
+        allele_list.extend(field_list[4].upper().split(","))
+    genotype = ""
+    for allele_index in sample_list[gt_index].replace("|", "/").split("/"):
+        if not allele_index.isdigit() or int(allele_index) >= len(allele_list):
+            return None
+        allele = allele_list[int(allele_index)]
+        if len(allele) != 1:
+            return None
+        genotype += allele
+    return genotype
+
+
+"""
+Streams a raw genome file (23andMe, AncestryDNA, FTDNA/MyHeritage CSV or VCF,
+plain or gzipped) line by line and yields
+    (chromosome, position, genotype)
+for the given chromosomes only, e.g. ('Y', '2781', 'A'). Chromosome names are
+normalized (chrY/24 -> Y, chrM/M/26 -> MT); no-call and indel genotypes are
+dropped. Other chromosomes are skipped after reading the chromosome column,
+so memory stays constant whatever the file size.
+"""
+
+
+def iter_positions_from_file(fileName, chromosomes=("Y", "MT")):
+    chromosome_set = set(chromosomes)
+    with _open_genome_file(fileName) as genome_file:
+        # 格式由文件头检测，文件头的行缓存后再和其余行一起解析
+        head_list = []
+        for line in genome_file:
+            head_list.append(line)
+            if len(head_list) >= _DETECT_LINE_COUNT or not line.startswith("#"):
+                break
+        genome_format = _detect_format_from_lines(head_list)
+
+        if genome_format == GENOME_FILE_VCF:
+            separator, chrom_col, pos_col = "\t", 0, 1
+        elif genome_format == GENOME_FILE_FTDNA:
+            separator, chrom_col, pos_col = ",", 1, 2
+        else:
+            separator, chrom_col, pos_col = "\t", 1, 2
+
+        # 原始染色体名到统一名称的缓存，不需要的染色体为None，染色体种类很少
+        chromosome_dict = {}
+        for line_list in (head_list, genome_file):
+            for line in line_list:
+                if line.startswith("#") or len(line.strip()) == 0:
+                    continue
+                field_list = line.rstrip("\r\n").split(separator)
+                if len(field_list) <= pos_col:
+                    continue
+
+                raw_chromosome = field_list[chrom_col]
+                chromosome = chromosome_dict.get(raw_chromosome, "")
+                if chromosome == "":
+                    chromosome = _normalize_chromosome(raw_chromosome, genome_format)
+                    if chromosome not in chromosome_set:
+                        chromosome = None
+                    chromosome_dict[raw_chromosome] = chromosome
+                if chromosome == None:
+                    continue
+
+                # 位置不是数字的是列名行
+                position = field_list[pos_col].strip().strip('"')
+                if not position.isdigit():
+                    continue
+
+                if genome_format == GENOME_FILE_VCF:
+                    if len(field_list) < 10:
+                        continue
+                    genotype = _parse_vcf_genotype(field_list)
+                elif genome_format == GENOME_FILE_ANCESTRY:
+                    genotype = (field_list[3] + field_list[4]).strip().upper()
+                elif genome_format == GENOME_FILE_FTDNA:
+                    genotype = field_list[3].strip().strip('"').upper()
+                else:
+                    genotype = field_list[3].strip().upper()
+
+                if genotype and genotype[0] in {"A", "T", "G", "C"}:
+                    yield chromosome, position, genotype
+
+
+"""
+Reads only the given chromosomes of a raw genome file into
+    {'Y': {'2781': 'A', ...}, 'MT': {'73': 'G', ...}}
+in one streaming pass, the same shape extract_positions returns for WeGene
+inputs, without building the full rsid dict.
+"""
+
+
+def get_positions_from_file(fileName, chromosomes=("Y", "MT")):
+    chrom_genome_dict = {chromosome: {} for chromosome in chromosomes}
+    for chromosome, position, genotype in iter_positions_from_file(
+        fileName, chromosomes
+    ):
+        chrom_genome_dict[chromosome][position] = genotype
+    return chrom_genome_dict